@@ -0,0 +1,181 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# asyncio front-end for the Vibrometer class. The acquisition keeps running in the Vibrometer's own acquisition thread; this
+# class only bridges its signals (ready for data, finished blocks, end of run) into the event loop with
+# call_soon_threadsafe, so waiting for them costs no executor thread at all. Device round-trips (settings, autofocus,
+# writing) do need a thread, but they are batched into a single job on an executor with one worker per device. That keeps
+# access to a DeviceCommunication serialized, while several vibrometers (and other devices) can be driven from one loop.
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Empty
+from threading import Lock
+
+from .Vibrometer import Vibrometer
+from .BlockDispatcher import BlockDispatcher
+
+
+class _LoopBlockQueue:
+    """Feeds blocks from the acquisition thread into an asyncio.Queue, with the put_nowait/get_nowait interface that
+    BlockDispatcher.subscribe expects. At most maxsize blocks wait for the consumer, the end-of-run marker is always let in.
+    Once the loop is closed, the queue unsubscribes itself through unsubscribe(queue), and takes everything without a word."""
+
+    def __init__(self,loop,maxsize,unsubscribe=None):
+        self._loop        = loop
+        self._queue       = asyncio.Queue()
+        self._maxsize     = maxsize
+        self._pending     = 0
+        self._lock        = Lock()
+        self._unsubscribe = unsubscribe
+
+    def put_nowait(self,item):
+        with self._lock:
+            if item is not BlockDispatcher.END_OF_RUN and self._pending >= self._maxsize:
+                raise Full
+            self._pending += 1
+
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait,item)
+        except RuntimeError:
+            # The loop is closed, nobody is listening anymore. Raising Full would make the dispatcher try to make room for
+            # the end-of-run marker, which can never succeed.
+            with self._lock:
+                self._pending -= 1
+            if self._unsubscribe is not None:
+                self._unsubscribe(self)
+
+    def get_nowait(self):
+        # Blocks already handed to the loop cannot be taken back from this thread.
+        raise Empty
+
+    async def get(self):
+        item = await self._queue.get()
+        with self._lock:
+            self._pending -= 1
+        return item
+
+
+class _RunEndWatcher:
+    """Subscriber that only listens for the end of the run, then calls on_end() in the loop. Blocks are taken and forgotten,
+    so they do not count as dropped."""
+
+    def __init__(self,loop,on_end):
+        self._loop   = loop
+        self._on_end = on_end
+
+    def put_nowait(self,item):
+        if item is BlockDispatcher.END_OF_RUN:
+            try:
+                self._loop.call_soon_threadsafe(self._on_end)
+            except RuntimeError:
+                # The loop is closed, nobody is waiting anymore.
+                pass
+
+    def get_nowait(self):
+        raise Empty
+
+
+class AsyncVibrometer:
+    """asyncio interface to a Vibrometer: await start_acq(), async for block in blocks(), await autofocus() and batched
+    get_settings/set_settings."""
+
+    def __init__(self,vibrometer):
+        """Constructor, takes a Vibrometer object as argument."""
+        self.__vibrometer = vibrometer
+
+        # One worker, so device round-trips of this vibrometer never overlap.
+        self.__executor   = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def from_ip(ip):
+        """Constructor which creates the class from a provided IP address (string). No checks on validity of the IP."""
+        return AsyncVibrometer(Vibrometer.from_ip(ip))
+
+    @property
+    def vibrometer(self):
+        """The wrapped Vibrometer, for anything that is not available asynchronously."""
+        return self.__vibrometer
+
+    async def _run(self,func,*args):
+        """Run func(*args) on the device executor."""
+        return await asyncio.get_running_loop().run_in_executor(self.__executor,func,*args)
+
+    ### Acquisition
+    async def start_acq(self,timeout=None):
+        """Start the acquisition, returns True once the device is ready for data. Returns False when the run ends before that
+        (see stop_acq), raises TimeoutError when timeout (s) passes first. The acquisition then stays armed, like with
+        Vibrometer.start_acq."""
+        loop  = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def resolve(result):
+            if not ready.done():
+                ready.set_result(result)
+
+        def on_ready():
+            loop.call_soon_threadsafe(resolve,True)
+
+        self.__vibrometer.add_ready_callback(on_ready)
+        self.__vibrometer.start_acq()
+
+        # A run that ends without getting ready resolves the wait as well. The ready callback, if it was called, got in line
+        # before the end of the run did.
+        watcher = self.__vibrometer.subscribe_blocks(queue=_RunEndWatcher(loop,lambda: resolve(False)))
+        if not self.__vibrometer.acquiring:
+            loop.call_soon(resolve,False)
+
+        try:
+            return await asyncio.wait_for(ready,timeout)
+        finally:
+            self.__vibrometer.unsubscribe_blocks(watcher)
+            self.__vibrometer.remove_ready_callback(on_ready)
+
+    def stop_acq(self):
+        """Stop the acquisition, see Vibrometer.stop_acq. Does not touch the device, so it needs no await."""
+        return self.__vibrometer.stop_acq()
+
+    def blocks(self,maxsize=16):
+        """Async iterator over the finished blocks of the current (or next) run, ends when the run is over. At most maxsize
+        blocks wait for a slow consumer, further blocks are dropped (see Vibrometer.dropped_blocks)."""
+        # Subscribe right away, not on the first iteration, or we might miss the first blocks.
+        queue = _LoopBlockQueue(asyncio.get_running_loop(),maxsize,self.__vibrometer.unsubscribe_blocks)
+        self.__vibrometer.subscribe_blocks(queue=queue)
+
+        async def block_generator():
+            try:
+                while True:
+                    block = await queue.get()
+                    if block is BlockDispatcher.END_OF_RUN:
+                        return
+                    yield block
+            finally:
+                self.__vibrometer.unsubscribe_blocks(queue)
+
+        return block_generator()
+
+    async def write_data(self,filename,_dict=dict(),overwrite=False):
+        """Write data to the disk, see Vibrometer.write_data."""
+        await self._run(lambda: self.__vibrometer.write_data(filename,_dict,overwrite))
+
+    ### Device round-trips
+    async def autofocus(self):
+        """Autofocus and wait until it is done."""
+        await self._run(lambda: self.__vibrometer.autofocus(block=True))
+
+    async def get_settings(self,keys=None):
+        """Read several settings in one go. Returns a dict, all settings of to_dict() when keys is None."""
+        def get():
+            if keys is None:
+                return self.__vibrometer.to_dict()
+            return {key: getattr(self.__vibrometer,key) for key in keys}
+
+        return await self._run(get)
+
+    async def set_settings(self,settings_dict):
+        """Apply several settings in one go, see Vibrometer.settings_from_dict. Returns its report."""
+        return await self._run(self.__vibrometer.settings_from_dict,settings_dict)
+
+    def close(self):
+        """Shut down the executor. The wrapped Vibrometer is left alone."""
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,26 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Where the device classes come from. By default that is the polytec library, which talks to the hardware. With the
+# environment variable POLYTEC_BACKEND=simulated, the pure-Python stand-ins of SimulatedDevice are used instead, so the
+# package can be run, tested and profiled on machines without the library or a vibrometer. The backend is picked once, when
+# the package is first imported, so set the variable before that.
+
+import os
+
+BACKEND = os.environ.get("POLYTEC_BACKEND","polytec").lower()
+
+if BACKEND == "polytec":
+    from polytec.io.channel_activation import ChannelActivation
+    from polytec.io.channel_type import ChannelType
+    from polytec.io.data_acquisition import DataAcquisition
+    from polytec.io.device_command import DeviceCommand
+    from polytec.io.device_communication import DeviceCommunication
+    from polytec.io.device_type import DeviceType
+    from polytec.io.item_list import ItemList
+    from polytec.io.miscellaneous_tag import MiscellaneousTag
+    from polytec.quantity_conversion import value_from_quantity_string
+elif BACKEND == "simulated":
+    from .SimulatedDevice import ChannelActivation, ChannelType, DataAcquisition, DeviceCommand, DeviceCommunication, \
+            DeviceType, ItemList, MiscellaneousTag, value_from_quantity_string
+else:
+    raise ImportError(f"Unknown POLYTEC_BACKEND {BACKEND}, choose polytec or simulated.")
@@ -0,0 +1,131 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Hands finished blocks from the acquisition thread to whoever wants to look at them during the run (live averages, quality
+# checks, feedback between shots). The acquisition thread must never wait on a consumer, otherwise read_data falls behind and
+# the device buffer overruns. So every consumer gets a bounded queue which is only ever filled with put_nowait, and a consumer
+# that cannot keep up loses blocks (counted in dropped_blocks) instead of slowing down the acquisition.
+
+import logging
+
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+import numpy as np
+
+
+class Block:
+    """A finished block. samples maps channel name to the samples of this block, overrange(ch_name) gives the overrange
+    flags. trigger_time is the time.perf_counter() value at which the trigger was noticed. lost_ranges are the (start, stop)
+    ranges of samples the DataValidity channel flagged as lost, as indices into samples["DataValidity"], empty for a clean
+    block.
+
+    In a regular run, samples and overrange are views on the run buffer, not copies, so treat them as read-only. They are only
+    valid until the data of the run is let go of: with reuse_buffers (see Vibrometer.release_data), a later run writes into
+    the same buffer once the run was written or stopped. Copy what you keep longer, or what you keep beyond the callback when
+    you cannot tell. Streaming and accumulate runs reuse a single row of the buffer for every block, so there the block holds
+    copies, which are the consumer's to keep."""
+
+    def __init__(self,block_id,samples,overrange,packed=(),trigger_time=None,lost_ranges=None):
+        self.block_id     = block_id
+        self.samples      = samples
+        self._overrange   = overrange
+        self._packed      = packed
+        self.trigger_time = trigger_time
+        self.lost_ranges  = lost_ranges if lost_ranges is not None else np.empty((0,2),dtype=np.int64)
+
+    def overrange(self,ch_name):
+        """Overrange flags of a channel, None for channels without overrange. Bit-packed overrange is unpacked (a copy)."""
+        overrange = self._overrange.get(ch_name)
+        if overrange is not None and ch_name in self._packed:
+            return np.unpackbits(overrange,count=self.samples[ch_name].shape[0]).astype(bool)
+        return overrange
+
+
+class BlockDispatcher:
+    """Distributes Block objects to callbacks (called from a dispatcher thread) and to block iterators."""
+
+    # Marks the end of a run in the queues.
+    END_OF_RUN = None
+
+    def __init__(self,maxsize=16):
+        self._maxsize        = maxsize
+        self._callbacks      = []
+        self._subscribers    = []
+        self._lock           = Lock()
+        self._callback_queue = None
+        self._thread         = None
+        self._dropped_blocks = 0
+
+    @property
+    def dropped_blocks(self):
+        """Number of blocks consumers missed because they could not keep up."""
+        return self._dropped_blocks
+
+    @property
+    def active(self):
+        """Is anybody listening? Lets the acquisition skip building Block objects."""
+        return len(self._callbacks) > 0 or len(self._subscribers) > 0
+
+    def register_callback(self,callback):
+        """Register callback(block), called from the dispatcher thread for every finished block."""
+        with self._lock:
+            if self._thread is None:
+                self._callback_queue = Queue(self._maxsize)
+                self._thread = Thread(target = self.__callback_loop, daemon = True)
+                self._thread.start()
+            self._callbacks = self._callbacks + [callback]
+
+    def unregister_callback(self,callback):
+        with self._lock:
+            self._callbacks = [cb for cb in self._callbacks if cb is not callback]
+
+    def subscribe(self,maxsize=None,queue=None):
+        """Returns a queue which receives every block and END_OF_RUN at the end of each run. Instead of a queue.Queue, any
+        object with non-blocking put_nowait/get_nowait raising queue.Full/queue.Empty can be passed in."""
+        if queue is None:
+            queue = Queue(self._maxsize if maxsize is None else maxsize)
+        with self._lock:
+            self._subscribers = self._subscribers + [queue]
+        return queue
+
+    def unsubscribe(self,queue):
+        with self._lock:
+            self._subscribers = [sub for sub in self._subscribers if sub is not queue]
+
+    def publish(self,block):
+        """Called from the acquisition thread. Never blocks."""
+        if len(self._callbacks) > 0:
+            self.__offer(self._callback_queue,block)
+
+        for queue in self._subscribers:
+            self.__offer(queue,block)
+
+    def end_run(self):
+        """Tell the block iterators the run is over. The end marker is never dropped, the oldest block is instead. A queue
+        that is full but gives nothing back is given up on, rather than spinning here forever."""
+        for queue in self._subscribers:
+            while True:
+                try:
+                    queue.put_nowait(self.END_OF_RUN)
+                    break
+                except Full:
+                    try:
+                        queue.get_nowait()
+                        self._dropped_blocks += 1
+                    except Empty:
+                        break
+
+    def __offer(self,queue,block):
+        try:
+            queue.put_nowait(block)
+        except Full:
+            self._dropped_blocks += 1
+
+    def __callback_loop(self):
+        while True:
+            block = self._callback_queue.get()
+            for callback in self._callbacks:
+                try:
+                    callback(block)
+                except Exception:
+                    logging.exception(f"Block callback {callback} failed on block {block.block_id}.")
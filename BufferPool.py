@@ -0,0 +1,79 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Thousands of short runs back-to-back spend a good part of the dead time between runs allocating and zero-filling the run
+# buffers, and page-faulting them in again. The pool keeps the arrays of finished runs around and hands them out again to
+# the next run with the same layout (channel, block_count, block_size * freq_factor, dtype).
+#
+# Arrays are leased: the acquisition gets them from the pool, and they only go back once whoever owns the data says it has
+# been persisted (release). A leased array is never handed out twice, so data cannot be overwritten before it is written.
+# Reused arrays are not zeroed again, the acquisition overwrites every sample of every block anyway.
+
+from threading import Lock
+
+import numpy as np
+
+
+class BufferPool:
+    """Vibrometer.buffer_allocator that reuses the arrays of earlier runs. New arrays come from allocator (None: np.zeros)."""
+
+    def __init__(self,allocator=None,max_free=2):
+        self._allocator = allocator
+        self._max_free  = max_free
+        self._free      = dict()
+        self._leased    = dict()
+        self._lock      = Lock()
+        self._hits      = 0
+        self._misses    = 0
+
+    @property
+    def allocator(self):
+        return self._allocator
+
+    @property
+    def hits(self):
+        """Number of arrays handed out again instead of allocated."""
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __call__(self,ch_name,kind,shape,dtype):
+        key = (ch_name,kind,tuple(shape),np.dtype(dtype).str)
+
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                array = free.pop()
+                self._hits += 1
+            else:
+                array = None
+                self._misses += 1
+
+        if array is None:
+            array = np.zeros(shape,dtype=dtype) if self._allocator is None else self._allocator(ch_name,kind,shape,dtype)
+
+        with self._lock:
+            self._leased[id(array)] = (key,array)
+
+        return array
+
+    def release(self,channel_data):
+        """Give the arrays of a buffer (as in Vibrometer.take_data) back to the pool, once they have been persisted.
+        Arrays that did not come from this pool are ignored."""
+        with self._lock:
+            for channel in channel_data.values():
+                for kind in ["Samples","Overrange"]:
+                    array = channel.get(kind)
+                    if array is None or id(array) not in self._leased:
+                        continue
+
+                    key, array = self._leased.pop(id(array))
+                    free = self._free.setdefault(key,[])
+                    if len(free) < self._max_free:
+                        free.append(array)
+
+    def clear(self):
+        """Drop all free arrays."""
+        with self._lock:
+            self._free = dict()
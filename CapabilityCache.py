@@ -0,0 +1,80 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# What the connected device offers: the available items of the ItemList settings and the (min, max) ranges of the numeric
+# ones. Every setter validates against these, which used to be a device query (two for a failing VelEncConfig setter). They do
+# not change while a head is connected, so they are fetched once per connection and shared by all config objects using that
+# DeviceCommunication. The exceptions are the velocity range, whose items follow the maximum velocity range, so setting that
+# drops the decoder capabilities, and the ranges of the block count, block size and pre/post trigger, which follow the block
+# count and size (they share the memory of the device), so setting those drops these ranges.
+#
+# The cache can be saved to a JSON file, keyed by a device identity (the IP when created through Vibrometer.from_ip), and
+# loaded on the next connection, so a reconnect starts without a single capability query.
+
+import json
+import os
+
+from weakref import WeakKeyDictionary
+
+from .Backend import DeviceCommand, DeviceType
+from .SettingsCache import SettingsCache
+
+
+# One cache per DeviceCommunication, dropped with the connection.
+_connections = WeakKeyDictionary()
+
+
+class CapabilityCache(SettingsCache):
+    """Cache of item lists and ranges, keyed by (device type, command). Counts hits and misses like SettingsCache."""
+
+    @staticmethod
+    def for_connection(communication):
+        """The cache shared by everything that uses communication."""
+        try:
+            cache = _connections.get(communication)
+            if cache is None:
+                cache = _connections[communication] = CapabilityCache()
+        except TypeError:
+            # Connection objects that cannot be weakly referenced get a cache of their own.
+            cache = CapabilityCache()
+        return cache
+
+    def discard(self,device_type,commands):
+        """Forget the capabilities of some commands of device_type, those that follow a setting that was just changed."""
+        for command in commands:
+            self._values.pop((device_type,command),None)
+
+    def to_dict(self):
+        """The cached capabilities, JSON-ready: "DeviceType.Command": items or [min, max]."""
+        return {f"{device_type.name}.{command.name}": list(value) for (device_type,command),value in self._values.items()}
+
+    def from_dict(self,_dict):
+        """Fill the cache from to_dict() output. Entries the current backend does not know are skipped."""
+        for key,value in _dict.items():
+            device_type, command = key.split(".",1)
+            if device_type in DeviceType.__members__ and command in DeviceCommand.__members__:
+                self._values[(DeviceType[device_type],DeviceCommand[command])] = value
+
+    def save(self,filename,identity):
+        """Store the cache under identity in the JSON file filename, next to those of other devices."""
+        devices = dict()
+        if os.path.isfile(filename):
+            with open(filename) as capability_file:
+                devices = json.load(capability_file)
+
+        devices[identity] = self.to_dict()
+        with open(filename,"w") as capability_file:
+            json.dump(devices,capability_file,indent=1)
+
+    def load(self,filename,identity):
+        """Fill the cache with what was saved for identity. Returns False when the file or the device is not there."""
+        if not os.path.isfile(filename):
+            return False
+
+        with open(filename) as capability_file:
+            devices = json.load(capability_file)
+
+        if identity not in devices:
+            return False
+
+        self.from_dict(devices[identity])
+        return True
@@ -0,0 +1,78 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Compression of the channel datasets written by HDF5Writer (see HDF5Writer.set_compression). The raw int32 velocity samples
+# only use the low bytes for most of a trace, so they compress well once shuffled (the bytes, or bits, of all samples in a chunk
+# grouped by significance), and overrange is nearly always all zeros. The filters are stored with the datasets by HDF5 itself,
+# so reading a compressed file needs no changes.
+#
+# gzip, LZF and byte shuffle come with h5py. Bit shuffle (with LZ4) is the Bitshuffle filter from the hdf5plugin package, which
+# is only imported when used, and is then needed to read the files back as well.
+#
+# benchmark/compression.py measures the ratio and the write and read throughput of the methods on representative traces.
+
+METHODS = [None,"gzip","lzf","bitshuffle"]
+
+
+class Compression:
+    """Compression of the channel datasets: method None (no compression), "gzip" (level 0-9), "lzf" or "bitshuffle" (bit shuffle
+    followed by LZ4). shuffle adds the byte shuffle filter in front of gzip or LZF."""
+
+    def __init__(self,method=None,level=4,shuffle=False):
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method {method}, choose from {METHODS}.")
+        if method == "gzip" and level not in range(10):
+            raise ValueError("gzip level must be an int from 0 to 9.")
+        if shuffle and method not in ["gzip","lzf"]:
+            raise ValueError("Byte shuffle only goes in front of gzip or LZF.")
+
+        self._method  = method
+        self._level   = level if method == "gzip" else None
+        self._shuffle = shuffle
+
+        if method == "bitshuffle":
+            import hdf5plugin
+            self._plugin_options = dict(hdf5plugin.Bitshuffle())
+
+    @staticmethod
+    def from_string(text):
+        """Parse the str() of a Compression: "none", "gzip", "gzip-9", "lzf", "bitshuffle", with "+shuffle" for byte shuffle
+        (e.g. "gzip-4+shuffle")."""
+        method, _, shuffle = text.partition("+")
+        if shuffle not in ["","shuffle"]:
+            raise ValueError(f"Cannot parse compression {text}.")
+
+        method, _, level = method.partition("-")
+        return Compression(None if method == "none" else method,int(level) if level else 4,shuffle == "shuffle")
+
+    def __str__(self):
+        text = "none" if self._method is None else self._method
+        if self._level is not None:
+            text += f"-{self._level}"
+        return text+"+shuffle" if self._shuffle else text
+
+    def __repr__(self):
+        return f"Compression({self})"
+
+    @property
+    def method(self):
+        return self._method
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def shuffle(self):
+        return self._shuffle
+
+    def dataset_options(self):
+        """Keyword arguments for h5py create_dataset."""
+        if self._method is None:
+            return dict()
+        if self._method == "bitshuffle":
+            return dict(self._plugin_options)
+
+        options = {"compression": self._method, "shuffle": self._shuffle}
+        if self._level is not None:
+            options["compression_opts"] = self._level
+        return options
@@ -8,14 +8,17 @@
 #   can be used as part of a class inheriting all config files.
 # - Added DaqSampleRate and DaqBaseSampleRate as properties (daq_sample_rate and daq_base_sample_rate)
 # - Added as_dict() function to the class to output all properties 
+# - polytec classes are imported through Backend, so a simulated device can be used instead
+# - Settings are read through a SettingsCache, setters invalidate it
+# - Available items and ranges are read through the CapabilityCache of the connection
+# - ItemLists and ChannelActivation are constructed on first use
 
 import logging
 
-from polytec.io.device_type import DeviceType
-from polytec.io.device_command import DeviceCommand
-from polytec.io.item_list import ItemList
-from polytec.io.channel_activation import ChannelActivation
-from polytec.io.channel_type import ChannelType
+from .Backend import DeviceType, DeviceCommand, ItemList, ChannelActivation, ChannelType
+from .SettingsCache import SettingsCache
+from .CapabilityCache import CapabilityCache
+from .LazyItemList import LazyItemList
 
 
 def log_config(daq_config):
@@ -59,13 +62,55 @@ class DaqConfig:
             # initialize member variables
             self.__communication = device_communication
 
-        self.__daq_mode = ItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqMode) \
-            if self.__communication.has_command(DeviceType.SignalProcessing, DeviceCommand.DaqMode) else None
-        self.__trigger_mode = ItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqTriggerMode)
-        self.__trigger_edge = ItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqTriggerEdge)
-        self.__analog_trigger_source = ItemList(self.__communication, DeviceType.SignalProcessing,
-                                                DeviceCommand.DaqAnalogTriggerSource)
-        self._channel_activation = ChannelActivation(self.__communication)
+        # JS 2022, these are only constructed on first use
+        self.__daq_mode = LazyItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqMode)
+        self.__has_daq_mode = None
+        self.__trigger_mode = LazyItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqTriggerMode)
+        self.__trigger_edge = LazyItemList(self.__communication, DeviceType.SignalProcessing, DeviceCommand.DaqTriggerEdge)
+        self.__analog_trigger_source = LazyItemList(self.__communication, DeviceType.SignalProcessing,
+                                                    DeviceCommand.DaqAnalogTriggerSource)
+        self.__channel_activation = None
+
+        # JS 2022, shared with the other config classes when mixed into one class (see Vibrometer)
+        if not hasattr(self, "_settings_cache"):
+            self._settings_cache = SettingsCache()
+        self._capabilities = CapabilityCache.for_connection(self.__communication)
+
+    # Added by JS 2022
+    def __daq_mode_list(self):
+        """The DaqMode ItemList, None for devices without DAQ mode (streaming only)"""
+        if self.__has_daq_mode is None:
+            self.__has_daq_mode = self.__communication.has_command(DeviceType.SignalProcessing, DeviceCommand.DaqMode)
+        return self.__daq_mode if self.__has_daq_mode else None
+
+    # Added by JS 2022
+    @property
+    def _channel_activation(self):
+        """The ChannelActivation of the device"""
+        if self.__channel_activation is None:
+            self.__channel_activation = ChannelActivation(self.__communication)
+        return self.__channel_activation
+
+    # Added by JS 2022
+    def __cached(self, name, fetch):
+        """Read a SignalProcessing setting through the settings cache"""
+        return self._settings_cache.get(DeviceType.SignalProcessing, name, fetch)
+
+    # Added by JS 2022
+    def __capability(self, command, fetch):
+        """Read the available items or the range of a SignalProcessing setting through the capability cache"""
+        return self._capabilities.get(DeviceType.SignalProcessing, command, fetch)
+
+    # Added by JS 2022
+    def __invalidate(self):
+        """Called after every write, settings can depend on each other, also those of other device types"""
+        self._settings_cache.invalidate()
+
+    # Added by JS 2022
+    def __invalidate_block_ranges(self):
+        """Called after writing the block count or size, the device memory they share limits these ranges"""
+        self._capabilities.discard(DeviceType.SignalProcessing, [DeviceCommand.DaqBlockCount, DeviceCommand.DaqBlockSize,
+                                                                 DeviceCommand.DaqPreTrigger])
 
     # Added by JS 2022
     def to_dict(self):
@@ -89,14 +134,16 @@ class DaqConfig:
     @property
     def daq_mode(self):
         """Gets the data acquisition mode"""
-        return self.__daq_mode.current_item() if self.__daq_mode else "Streaming"
+        return self.__cached("daq_mode",
+                             lambda: self.__daq_mode.current_item() if self.__daq_mode_list() else "Streaming")
 
     @daq_mode.setter
     def daq_mode(self, new_value):
         """Sets the data acquisition mode"""
-        if self.__daq_mode:
-            if self.__daq_mode.is_item_available(new_value):
+        if self.__daq_mode_list():
+            if new_value in self.available_daq_modes():
                 self.__daq_mode.set_current_item(new_value)
+                self.__invalidate()
             else:
                 raise ConfigurationError(f"DAQ mode not available: {new_value}")
         elif new_value != "Streaming":
@@ -104,13 +151,15 @@ class DaqConfig:
 
     def available_daq_modes(self):
         """Gets all available data acquisition modes"""
-        return self.__daq_mode.available_items() if self.__daq_mode else ["Streaming"]
+        return self.__capability(DeviceCommand.DaqMode, lambda: self.__daq_mode.available_items()) \
+            if self.__daq_mode_list() else ["Streaming"]
 
     # Block count
     @property
     def block_count(self):
         """Gets the block count"""
-        return self.__communication.get_int16(DeviceType.SignalProcessing, DeviceCommand.DaqBlockCount)
+        return self.__cached("block_count", lambda: self.__communication.get_int16(DeviceType.SignalProcessing,
+                                                                                  DeviceCommand.DaqBlockCount))
 
     @block_count.setter
     def block_count(self, new_value):
@@ -118,18 +167,22 @@ class DaqConfig:
         value_range = self.block_count_range()
         if value_range[0] <= new_value <= value_range[1]:
             self.__communication.set_int16(DeviceType.SignalProcessing, DeviceCommand.DaqBlockCount, new_value)
+            self.__invalidate()
+            self.__invalidate_block_ranges()
         else:
             raise ConfigurationError(f"Block count out of range [{value_range[0]}, {value_range[1]}]")
 
     def block_count_range(self):
         """Gets the block count range"""
-        return self.__communication.get_int16_range(DeviceType.SignalProcessing, DeviceCommand.DaqBlockCount)
+        return self.__capability(DeviceCommand.DaqBlockCount, lambda: self.__communication.get_int16_range(
+            DeviceType.SignalProcessing, DeviceCommand.DaqBlockCount))
 
     # Block size
     @property
     def block_size(self):
         """Gets the block size"""
-        return self.__communication.get_int32(DeviceType.SignalProcessing, DeviceCommand.DaqBlockSize)
+        return self.__cached("block_size", lambda: self.__communication.get_int32(DeviceType.SignalProcessing,
+                                                                                 DeviceCommand.DaqBlockSize))
 
     @block_size.setter
     def block_size(self, new_value):
@@ -137,72 +190,80 @@ class DaqConfig:
         value_range = self.block_size_range()
         if value_range[0] <= new_value <= value_range[1]:
             self.__communication.set_int32(DeviceType.SignalProcessing, DeviceCommand.DaqBlockSize, new_value)
+            self.__invalidate()
+            self.__invalidate_block_ranges()
         else:
             raise ConfigurationError(f"Block count out of range [{value_range[0]}, {value_range[1]}]")
 
     def block_size_range(self):
         """Gets the block size range"""
-        return self.__communication.get_int32_range(DeviceType.SignalProcessing, DeviceCommand.DaqBlockSize)
+        return self.__capability(DeviceCommand.DaqBlockSize, lambda: self.__communication.get_int32_range(
+            DeviceType.SignalProcessing, DeviceCommand.DaqBlockSize))
 
     # Trigger mode
     @property
     def trigger_mode(self):
         """Gets the trigger mode"""
-        return self.__trigger_mode.current_item()
+        return self.__cached("trigger_mode", lambda: self.__trigger_mode.current_item())
 
     @trigger_mode.setter
     def trigger_mode(self, new_value):
         """Sets the trigger mode"""
         if new_value in self.available_trigger_modes():
             self.__trigger_mode.set_current_item(new_value)
+            self.__invalidate()
         else:
             raise ConfigurationError(f"Trigger mode not available: {new_value}")
 
     def available_trigger_modes(self):
         """Gets all available trigger modes"""
-        return self.__trigger_mode.available_items()
+        return self.__capability(DeviceCommand.DaqTriggerMode, lambda: self.__trigger_mode.available_items())
 
     # Trigger edge
     @property
     def trigger_edge(self):
         """Gets the trigger edge"""
-        return self.__trigger_edge.current_item()
+        return self.__cached("trigger_edge", lambda: self.__trigger_edge.current_item())
 
     @trigger_edge.setter
     def trigger_edge(self, new_value):
         """Sets the trigger edge"""
         if new_value in self.available_trigger_edges():
             self.__trigger_edge.set_current_item(new_value)
+            self.__invalidate()
         else:
             raise ConfigurationError(f"Trigger edge not available: {new_value}")
 
     def available_trigger_edges(self):
         """Gets all available trigger edges"""
-        return self.__trigger_edge.available_items()
+        return self.__capability(DeviceCommand.DaqTriggerEdge, lambda: self.__trigger_edge.available_items())
 
     # Analog trigger source
     @property
     def analog_trigger_source(self):
         """Gets the analog trigger source"""
-        return self.__analog_trigger_source.current_item()
+        return self.__cached("analog_trigger_source", lambda: self.__analog_trigger_source.current_item())
 
     @analog_trigger_source.setter
     def analog_trigger_source(self, new_value):
         """Sets the analog trigger source"""
         if new_value in self.available_analog_trigger_sources():
             self.__analog_trigger_source.set_current_item(new_value)
+            self.__invalidate()
         else:
             raise ConfigurationError(f"Analog trigger source not available: {new_value}")
 
     def available_analog_trigger_sources(self):
         """Gets all available trigger sources"""
-        return self.__analog_trigger_source.available_items()
+        return self.__capability(DeviceCommand.DaqAnalogTriggerSource,
+                                 lambda: self.__analog_trigger_source.available_items())
 
     # Analog trigger level
     @property
     def analog_trigger_level(self):
         """Gets the analog trigger level"""
-        return self.__communication.get_float(DeviceType.SignalProcessing, DeviceCommand.DaqAnalogTriggerLevel)
+        return self.__cached("analog_trigger_level", lambda: self.__communication.get_float(
+            DeviceType.SignalProcessing, DeviceCommand.DaqAnalogTriggerLevel))
 
     @analog_trigger_level.setter
     def analog_trigger_level(self, new_value):
@@ -210,30 +271,35 @@ class DaqConfig:
         value_range = self.analog_trigger_level_range()
         if value_range[0] <= new_value <= value_range[1]:
             self.__communication.set_float(DeviceType.SignalProcessing, DeviceCommand.DaqAnalogTriggerLevel, new_value)
+            self.__invalidate()
         else:
             raise ConfigurationError(f"Analog trigger level out of range [{value_range[0]}, {value_range[1]}]")
 
     def analog_trigger_level_range(self):
         """Gets the analog trigger level range"""
-        return self.__communication.get_float_range(DeviceType.SignalProcessing, DeviceCommand.DaqAnalogTriggerLevel)
+        return self.__capability(DeviceCommand.DaqAnalogTriggerLevel, lambda: self.__communication.get_float_range(
+            DeviceType.SignalProcessing, DeviceCommand.DaqAnalogTriggerLevel))
 
     # Gated trigger
     @property
     def gated_trigger(self):
         """Gets the gated trigger state"""
-        return self.__communication.get_int16(DeviceType.SignalProcessing, DeviceCommand.DaqGatedTrigger) == 1
+        return self.__cached("gated_trigger", lambda: self.__communication.get_int16(DeviceType.SignalProcessing,
+                                                                                    DeviceCommand.DaqGatedTrigger) == 1)
 
     @gated_trigger.setter
     def gated_trigger(self, new_value):
         """Sets the gated trigger state"""
         self.__communication.set_int16(DeviceType.SignalProcessing, DeviceCommand.DaqGatedTrigger,
                                        1 if new_value else 0)
+        self.__invalidate()
 
     # Pre/Post trigger
     @property
     def pre_post_trigger(self):
         """Sets the pre- or post-trigger"""
-        return self.__communication.get_int32(DeviceType.SignalProcessing, DeviceCommand.DaqPreTrigger)
+        return self.__cached("pre_post_trigger", lambda: self.__communication.get_int32(DeviceType.SignalProcessing,
+                                                                                       DeviceCommand.DaqPreTrigger))
 
     @pre_post_trigger.setter
     def pre_post_trigger(self, new_value):
@@ -241,12 +307,14 @@ class DaqConfig:
         value_range = self.pre_post_trigger_range()
         if value_range[0] <= new_value <= value_range[1]:
             self.__communication.set_int32(DeviceType.SignalProcessing, DeviceCommand.DaqPreTrigger, new_value)
+            self.__invalidate()
         else:
             raise ConfigurationError(f"Block count out of range [{value_range[0]}, {value_range[1]}]")
 
     def pre_post_trigger_range(self):
         """Gets the pre- or post-trigger range"""
-        return self.__communication.get_int32_range(DeviceType.SignalProcessing, DeviceCommand.DaqPreTrigger)
+        return self.__capability(DeviceCommand.DaqPreTrigger, lambda: self.__communication.get_int32_range(
+            DeviceType.SignalProcessing, DeviceCommand.DaqPreTrigger))
 
     # Active output
     @property
@@ -294,12 +362,14 @@ class DaqConfig:
     # Added by JS 2022
     @property
     def daq_sample_rate(self):
-        return self.__communication.get_int32(DeviceType.SignalProcessing, DeviceCommand.DaqSampleRate)
+        return self.__cached("daq_sample_rate", lambda: self.__communication.get_int32(DeviceType.SignalProcessing,
+                                                                                      DeviceCommand.DaqSampleRate))
 
     # Added by JS 2022
     @property
     def daq_base_sample_rate(self):
-        return self.__communication.get_int32(DeviceType.SignalProcessing, DeviceCommand.DaqBaseSampleRate)
+        return self.__cached("daq_base_sample_rate", lambda: self.__communication.get_int32(
+            DeviceType.SignalProcessing, DeviceCommand.DaqBaseSampleRate))
 
 class ConfigurationError(Exception):
     """Exception class raised when trying to to setup an invalid configuration"""
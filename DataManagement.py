@@ -1,18 +1,54 @@
 # (c) Jasper Smits 2022, release under LGPLv3
 
 # This small class will handle saving the results of an experimental run to a HDF5 file. As an input it will take mainly the buffer of Vibrometer class, and a dict-of-dicts describing properties of the vibrometer, laser, etc. This class will only support writing, for now.
+#
+# h5py is only imported once a file is written, so importing Vibrometer (which is an HDF5Writer) to change a setting does not
+# pay for it. Reading lives in HDF5Reader, which derives from h5py.File, and is imported from there on first use.
 
-import h5py
+import atexit
 import os
 
-from glob import glob
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+from time import perf_counter
 
 import numpy as np
 
+from .Compression import Compression
+
+# Files written by HDF5Writer.write_channel_data used to store every run as its own dataset (<channel>/<num>). Files with this
+# format version or higher store one (blocks, samples) dataset per channel (<channel>/blocks and <channel>/overrange) instead.
+BLOCK_LAYOUT_VERSION = 2
+
+# Target size of the chunks of those datasets, the size of the default HDF5 chunk cache.
+CHUNK_BYTES = 2**20
+
+# Files with this format version or higher store the metadata as attributes of /metadata/<group> instead of as root datasets
+# named <group>__<key>. Values larger than METADATA_ATTRIBUTE_BYTES are datasets in /metadata/<group> instead, since all
+# attributes of a group have to fit in 64 kB.
+METADATA_LAYOUT_VERSION  = 3
+METADATA_GROUP           = "metadata"
+METADATA_ATTRIBUTE_BYTES = 1024
+
+# The format version of the files written now.
+FORMAT_VERSION = METADATA_LAYOUT_VERSION
+
+# Dataset of files streamed in SWMR mode (see HDF5StreamWriter), set to True once the writer is done.
+STREAM_CLOSED = "stream_closed"
+
+# Group holding the lost sample summary of the DataValidity channel, see DataValidity.LostSampleIndex:
+# lost_count (samples lost per block) and lost_ranges ((block, start, stop) per range of lost samples). The indices are those of
+# the stored DataValidity samples, so with capture windows they count within the windows, not the full block.
+DATA_VALIDITY_GROUP = "data_validity"
+
 class HDF5Writer:
     def __init__(self):
         self._active_file = None
 
+        # Compression per channel name, None for the channels without one of their own, see set_compression().
+        self._compression = dict()
+
     @property
     def active_file(self):
         if self._active_file:
@@ -22,405 +58,473 @@ class HDF5Writer:
 
     def open_file(self, filename, overwrite=False):
         if (not overwrite) and os.path.exists(filename):
-            return IOError(f"File {filename} exists. Turn on overwrite or choose another file.")
+            raise IOError(f"File {filename} exists. Turn on overwrite or choose another file.")
 
+        import h5py
         self._active_file = h5py.File(filename, "w")
 
     def close_file(self):
         self._active_file.close()
         self._active_file = None
 
+    @property
+    def compression(self):
+        """Dict of channel name to the Compression of its datasets, None for the other channels. Use set_compression() and
+        clear_compression() to change it."""
+        return dict(self._compression)
+
+    def set_compression(self,compression,ch_name=None):
+        """Compress the datasets of a channel (e.g. "Velocity"), or of all channels without one of their own if none is given,
+        see Compression. Takes effect from the next file that is written."""
+        if not isinstance(compression,Compression):
+            raise ValueError("compression must be a Compression.")
+
+        self._compression[ch_name] = compression
+
+    def clear_compression(self,ch_name=None):
+        """Stop compressing a channel, or all channels if none is given."""
+        if ch_name is None:
+            self._compression = dict()
+        else:
+            self._compression.pop(ch_name,None)
+
+    def _dataset_options(self,ch_name,compression=None):
+        """create_dataset keyword arguments for the compression of a channel, from compression (as the compression property)
+        if given."""
+        compression = self._compression if compression is None else compression
+        channel_compression = compression.get(ch_name,compression.get(None))
+        return channel_compression.dataset_options() if channel_compression is not None else dict()
+
     ## Writing part, what does it have to do?
-    # Take channel data, and write it into a HDF5 structure ( <channel> / <run_num>, also include <channel>/<avg> ), include metadata
+    # Take channel data, and write it into a HDF5 structure ( <channel> / blocks, one row per run ), include metadata
     # Take (to be produced) dict-of-dicts which stores all setting data.
     # Store the executed script (this is not yet possible, and more of a feature of the entire control software, we will have to see how we do this.)
 
-    def write_channel_data(self,channel_data):
-        """Takes a set of channel_data as from the generate_buffers() of the Vibrometer class. Writes it to file as described above."""
+    def _root(self,group=None):
+        """The group everything is written into, the file root unless a group is given (e.g. one group per device)."""
+        return self._active_file if group is None else self._active_file.require_group(group)
 
-        for ch_name,channel in channel_data.items():
-            if channel["Overrange"] is not None:
-                has_overrange = True
-            else:
-                has_overrange = False
+    def _write_channel_header(self,ch_name,channel,group=None):
+        """Create the group of a channel and store the channel metadata in it. Returns the group and the dtype of the samples."""
+        ch_grp = self._root(group).create_group(ch_name)
 
-            ch_grp = self._active_file.create_group("/"+ch_name)
-            if has_overrange:
-                overrange_grp = ch_grp.create_group("overrange")
+        # Store the metadata in the channel group.
+        ch_grp["unit"]        = channel["Unit"]
+        ch_grp["scalefactor"] = channel["ScaleFactor"]
+        ch_grp["ID"]          = channel["ID"]
 
-            # Store the metadata in the channel group.
-            ch_grp["unit"]        = channel["Unit"]
-            ch_grp["scalefactor"] = channel["ScaleFactor"]
-            ch_grp["ID"]          = channel["ID"]
+        # Something about the datatype for each array. Of course, we store bools as bools.
+        if channel["Unit"] == "bool":
+            data_type = "b" # 1 byte
+        elif channel.get("Filter") is not None:
+            data_type = "f4" # Filtered and decimated in the acquisition, see OnlineFilter
+        else:
+            data_type = "i" # 4 bytes (=32bit)
 
-            my_data  = channel["Samples"]
+        # The filter a channel went through, so the data can be interpreted (and the time axis reconstructed) later.
+        if channel.get("Filter") is not None:
+            ch_grp.attrs["decimation"] = channel["Filter"].decimation
+            ch_grp.attrs["filter"]     = channel["Filter"].to_json()
 
-            # Something about the datatype for each array. Of course, we store bools as bools.
-            if channel["Unit"] == "bool":
-                data_type = "b" # 1 byte
-            else:
-                data_type = "i" # 4 bytes (=32bit)
+        # Capture windows: which samples of the block were kept, so the time axis can be reconstructed.
+        if channel.get("Windows") is not None:
+            ch_grp.attrs["windows"] = channel["Windows"]
 
-            # Now the data
+        return ch_grp, data_type
 
-            num_runs,num_samples = my_data.shape
+    def write_channel_data(self,channel_data,group=None,compression=None):
+        """Takes a set of channel_data as from the generate_buffers() of the Vibrometer class. Writes it to file as one chunked
+        (blocks, samples) dataset per channel, <channel>/blocks and <channel>/overrange, like HDF5StreamWriter. The datasets are
+        compressed as set with set_compression(), or as given by compression (a dict like the compression property)."""
+        root = self._root(group)
+        root.attrs["format_version"] = FORMAT_VERSION
 
-            for num in range(num_runs):
-                dataset = ch_grp.create_dataset(f"{num}",(num_samples,),dtype=data_type)
+        for ch_name,channel in channel_data.items():
+            ch_grp, data_type = self._write_channel_header(ch_name,channel,group)
+            num_runs,num_samples = channel["Samples"].shape
+            options = self._dataset_options(ch_name,compression)
+
+            datasets = [(ch_grp.create_dataset("blocks",(num_runs,num_samples),dtype=data_type,
+                                               chunks=self._chunk_shape(num_runs,num_samples,np.dtype(data_type).itemsize),
+                                               **options),
+                         channel["Samples"])]
 
-                # Store the data in the file.
-                dataset[:] = channel["Samples"][num,:]
-                if has_overrange:
-                    overrange_dataset = overrange_grp.create_dataset(f"{num}",(num_samples,),dtype="b")
-                    overrange_dataset[:] = channel["Overrange"][num,:]
+            if channel["Overrange"] is not None:
+                overrange_type, overrange_samples, overrange_attrs = self._overrange_layout(channel,num_samples)
+                overrange_dataset = ch_grp.create_dataset("overrange",(num_runs,overrange_samples),dtype=overrange_type,
+                                                          chunks=self._chunk_shape(num_runs,overrange_samples,1),**options)
+                overrange_dataset.attrs.update(overrange_attrs)
+                datasets.append((overrange_dataset,channel["Overrange"]))
+
+            # A row of chunks at a time: every chunk is written exactly once, and memory-mapped buffers (see MemmapAllocator)
+            # never have to be in memory as a whole.
+            for dataset,data in datasets:
+                rows = dataset.chunks[0]
+                for start in range(0,num_runs,rows):
+                    dataset[start:start+rows] = data[start:start+rows]
+
+    @staticmethod
+    def _chunk_shape(num_blocks,num_samples,itemsize):
+        """Chunk shape of a (blocks, samples) dataset. Blocks are read whole (block(), velocity()) or a range of them at a time
+        (average_velocity()), so chunks hold whole blocks: as many as fit in CHUNK_BYTES, so small blocks do not end up as
+        thousands of tiny chunks. Blocks larger than CHUNK_BYTES are split into equal parts along the samples."""
+        num_blocks, num_samples = max(num_blocks,1), max(num_samples,1)
+        block_bytes = num_samples*itemsize
+
+        if block_bytes >= CHUNK_BYTES:
+            parts = -(-block_bytes//CHUNK_BYTES)
+            return (1,-(-num_samples//parts))
+
+        return (min(num_blocks,CHUNK_BYTES//block_bytes),num_samples)
+
+    @staticmethod
+    def _overrange_layout(channel,num_samples):
+        """Overrange is stored either as one byte per sample, or bit-packed (8 samples per byte, see numpy.packbits). Packed
+        overrange is marked with attributes on the overrange group/dataset, so the reader knows how many samples to unpack.
+        Returns the dtype, the number of stored values per block and the attributes."""
+        if channel.get("OverrangePacked",False):
+            return "u1", (num_samples+7)//8, {"packed": True, "sample_count": num_samples}
+        else:
+            return "b", num_samples, dict()
     
-    def write_metadata(self,dict_of_dicts):
-        """A very inflexible function to write metadata from a dictionary of dictionaries."""
+    def write_statistics(self,channel_statistics,group=None):
+        """Takes the statistics of an accumulate run, as Vibrometer.statistics. Stores them per channel (<channel>/mean,
+        variance, sum, count, overrange_count and min/max if kept) in raw units, and marks the file as accumulated."""
+        root = self._root(group)
+        root.attrs["accumulated"] = True
+
+        for ch_name,channel in channel_statistics.items():
+            ch_grp, data_type = self._write_channel_header(ch_name,channel,group)
+            statistics = channel["Statistics"]
+
+            ch_grp["count"]    = statistics.count
+            ch_grp["sum"]      = statistics.sum
+            ch_grp["mean"]     = statistics.mean
+            ch_grp["variance"] = statistics.variance()
+
+            if statistics.overrange_count is not None:
+                ch_grp["overrange_count"] = statistics.overrange_count
+            if statistics.min is not None:
+                ch_grp["min"] = statistics.min
+                ch_grp["max"] = statistics.max
+
+    def write_lost_samples(self,lost_samples,block_count,group=None):
+        """Store the lost samples of a run (a DataValidity.LostSampleIndex) as a per-block count and a list of ranges."""
+        validity_grp = self._root(group).create_group(DATA_VALIDITY_GROUP)
+        validity_grp["lost_count"]  = lost_samples.lost_count(block_count)
+        validity_grp["lost_ranges"] = lost_samples.to_array()
+
+    def write_metadata(self,dict_of_dicts,group=None):
+        """Write metadata from a dictionary of dictionaries, as the attributes of /metadata/<key> (see METADATA_LAYOUT_VERSION)."""
+        root = self._root(group)
+        root.attrs["format_version"] = FORMAT_VERSION
+
+        metadata_grp = root.require_group(METADATA_GROUP)
         for _key,_dict in dict_of_dicts.items():
+            grp = metadata_grp.require_group(_key)
             for _skey,_item in _dict.items():
-                self._active_file[_key+"__"+_skey] = _item
-
-
-class HDF5Reader(h5py.File):
-    """A class to deal with conversion of data from the HDF5Writer. Unpacks the metadata back into the dict-of-dicts format. Converts data to SI units in a convenient way. One instance per file, wraps around the HDF5 reader, basically. Based on the h5py.File class."""
-    def __init__(self,filename,**kwargs):
-        super().__init__(filename,"r",**kwargs)
-        self._freq_factor = self["vibrometer__daq_sample_rate"][()]//self["vibrometer__daq_base_sample_rate"][()]
-        self._pre_post_trig = self["vibrometer__pre_post_trigger"][()]
-        self._base_samples  = self["vibrometer__block_size"][()]
-        self._total_samples = self._base_samples * self._freq_factor
-        self._base_sample_rate  = self["vibrometer__daq_base_sample_rate"][()]
-        self._sample_rate   = self._base_sample_rate/self._freq_factor
-        self._block_count  = self["vibrometer__block_count"][()]
-
-
+                if self._metadata_bytes(_item) > METADATA_ATTRIBUTE_BYTES:
+                    grp[_skey] = _item
+                else:
+                    grp.attrs[_skey] = _item
+
+    def write_dataset(self,name,data,group=None):
+        """Write an extra dataset alongside the run, e.g. something derived from it. name is a path such as "trigger_skew/skew",
+        in the root or in group, missing groups are created."""
+        self._root(group)[name] = data
+
+    @staticmethod
+    def _metadata_bytes(value):
+        if isinstance(value,str):
+            return len(value.encode())
+        return np.asarray(value).nbytes
+
+    def write_run(self,filename,metadata,data=None,statistics=None,lost_samples=None,overwrite=False,compression=None):
+        """Write a run to a file of its own: the blocks (data, as from the generate_buffers() of the Vibrometer class), or the
+        statistics of an accumulate run, the lost samples if there is a DataValidity channel and they are given (a
+        DataValidity.LostSampleIndex), and the metadata (a dict of dicts)."""
+        self.open_file(filename,overwrite=overwrite)
+        try:
+            if data is not None:
+                self.write_channel_data(data,compression=compression)
+                if "DataValidity" in data and lost_samples is not None:
+                    self.write_lost_samples(lost_samples,data["DataValidity"]["Samples"].shape[0])
+            else:
+                self.write_statistics(statistics)
+                if "DataValidity" in statistics and lost_samples is not None:
+                    self.write_lost_samples(lost_samples,statistics["DataValidity"]["Statistics"].count)
+            self.write_metadata(metadata)
+        finally:
+            self.close_file()
 
-        self._metadata = self.__reconstruct_dict()
 
-        self._preexp_shots = 0
-        # Let's see whether there's any background substraction to be done.
-        if "pre_exp_beamdump" in self.metadata["traces"].keys():
-            # If this is true, then we have pre-experiment beamdump traces.
-            self._preexp_shots = self.metadata["traces"]["pre_exp_beamdump"]
+class HDF5StreamWriter(HDF5Writer):
+    """Writes blocks to a HDF5 file while the acquisition is still running.
 
-        self._postexp_shots = 0
-        # Let's see whether there's any background substraction to be done.
-        if "post_exp_beamdump" in self.metadata["traces"].keys():
-            # If this is true, then we have pre-experiment beamdump traces.
-            self._postexp_shots = self.metadata["traces"]["pre_exp_beamdump"]
+    All file I/O happens in a consumer thread, the acquisition thread only hands finished blocks over through a queue and never
+    waits on the disk. Blocks are appended to one resizable dataset per channel (<channel>/blocks and <channel>/overrange) and
+    the file is flushed after every block, or at most every flush_interval (s), so a run that is aborted halfway still leaves
+    a readable file behind.
 
-        self._background_traces = self._calc_background_traces()
+    With swmr, the file is written in HDF5 single-writer/multiple-reader mode: other processes can open it while it is being
+    written and read the blocks that have been flushed (see HDF5Reader.follow). Such files need HDF5 1.10 or later to read."""
 
-    def average_velocity(self,start=0,end=None):
-        # Apparently we can't use self variables in the function definition
-        if end == None:
-            end = self._block_count
+    def __init__(self,filename,metadata,overwrite=False,compression=None,swmr=False,flush_interval=0.):
+        HDF5Writer.__init__(self)
+        if compression is not None:
+            self._compression = dict(compression)
 
-        arr = np.zeros(self._total_samples,dtype=float)
-        for it in range(start,end):
-            arr += self.velocity(it)
+        # Checked here, an exception in the consumer thread would only surface at join().
+        if (not overwrite) and os.path.exists(filename):
+            raise IOError(f"File {filename} exists. Turn on overwrite or choose another file.")
 
-        return arr/(end-start)
+        self._filename       = filename
+        self._metadata       = metadata
+        self._swmr           = swmr
+        self._flush_interval = flush_interval
+        self._queue          = Queue()
+        self._thread         = None
+        self._error          = None
+        self._blocks_written = 0
 
     @property
-    def preexp_shots(self):
-        return self._preexp_shots
+    def swmr(self):
+        return self._swmr
 
     @property
-    def postexp_shots(self):
-        return self._postexp_shots
+    def filename(self):
+        return self._filename
 
     @property
-    def background_traces(self):
-        return self._background_traces
-
-    def _calc_background_traces(self):
-        # If there is pre-experiment and post-experiment background recordings, this property
-        # can be used to substract them.
-        arr = np.zeros(self._total_samples,dtype=float)
-        if self._preexp_shots > 0:
-            arr += self._preexp_shots * self.average_velocity()
+    def blocks_written(self):
+        """Number of blocks that have been persisted (flushed) so far."""
+        return self._blocks_written
 
-        if self._postexp_shots > 0:
-            arr += self._postexp_shots * self.average_velocity()
+    def start(self,channel_data):
+        """Start the consumer thread. channel_data is the buffer of the Vibrometer class, only used for the channel layout."""
+        if self._thread is not None:
+            raise RuntimeError("Stream writer was already started.")
 
-        if self._preexp_shots + self._postexp_shots > 0:
-            return arr/(self._preexp_shots+self._postexp_shots)
-        else:
-            return 0
+        header = dict()
+        for ch_name,channel in channel_data.items():
+            header[ch_name] = {"Unit": channel["Unit"], "ScaleFactor": channel["ScaleFactor"], "ID": channel["ID"],
+                               "SampleCount": channel["Samples"].shape[1], "HasOverrange": channel["Overrange"] is not None,
+                               "OverrangePacked": channel.get("OverrangePacked",False), "Filter": channel.get("Filter"),
+                               "Windows": channel.get("Windows")}
+
+        self._thread = Thread(target = self.__consumer, args = (header,))
+        self._thread.start()
+
+    def put_block(self,block_id,blocks,lost_ranges=None):
+        """Hand over a finished block, blocks maps channel name to (samples, overrange). The arrays are written as they are, so
+        they should be copies the acquisition does not touch anymore. lost_ranges are the (start, stop) ranges of samples the
+        DataValidity channel flagged in this block. Never blocks."""
+        self._queue.put((block_id,blocks,lost_ranges))
+
+    def close(self):
+        """Tell the consumer thread no more blocks are coming. Does not wait for the writes to finish, use join() for that."""
+        self._queue.put(None)
+
+    def join(self,timeout=None):
+        """Wait until all queued blocks are written and the file is closed. Raises the error of the consumer thread, if any."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        if self._error is not None:
+            raise IOError(f"Streaming to {self._filename} failed.") from self._error
+
+    def __consumer(self,header):
+        written = 0
+        try:
+            import h5py
+            # SWMR needs the newest file format.
+            self._active_file = h5py.File(self._filename,"w",libver="latest") if self._swmr else h5py.File(self._filename,"w")
+            self._active_file.attrs["format_version"] = FORMAT_VERSION
+            self._active_file.attrs["blocks_written"] = 0
+
+            self.write_metadata(self._metadata)
+
+            for ch_name,channel in header.items():
+                ch_grp, data_type = self._write_channel_header(ch_name,channel)
+                num_samples = channel["SampleCount"]
+
+                options = self._dataset_options(ch_name)
+
+                ch_grp.create_dataset("blocks",(0,num_samples),maxshape=(None,num_samples),chunks=(1,num_samples),dtype=data_type,
+                                      **options)
+                if channel["HasOverrange"]:
+                    overrange_type, overrange_samples, overrange_attrs = self._overrange_layout(channel,num_samples)
+                    overrange_dataset = ch_grp.create_dataset("overrange",(0,overrange_samples),maxshape=(None,overrange_samples),
+                                                              chunks=(1,overrange_samples),dtype=overrange_type,**options)
+                    overrange_dataset.attrs.update(overrange_attrs)
+
+            if "DataValidity" in header:
+                validity_grp = self._active_file.create_group(DATA_VALIDITY_GROUP)
+                validity_grp.create_dataset("lost_count",(0,),maxshape=(None,),dtype="i8")
+                validity_grp.create_dataset("lost_ranges",(0,3),maxshape=(None,3),chunks=(256,3),dtype="i8")
+
+            # In SWMR mode nothing can be created anymore, and readers do not see attribute changes. Readers go by the size of
+            # the datasets instead of blocks_written, and by STREAM_CLOSED to know the writer is done.
+            if self._swmr:
+                self._active_file.create_dataset(STREAM_CLOSED,data=False,dtype="b")
+                self._active_file.swmr_mode = True
+
+            self._active_file.flush()
+            last_flush = perf_counter()
+
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                block_id, blocks, lost_ranges = item
+                for ch_name,(samples,overrange) in blocks.items():
+                    dataset = self._active_file[ch_name]["blocks"]
+                    dataset.resize(block_id+1,axis=0)
+                    dataset[block_id,:] = samples
+
+                    if overrange is not None:
+                        overrange_dataset = self._active_file[ch_name]["overrange"]
+                        overrange_dataset.resize(block_id+1,axis=0)
+                        overrange_dataset[block_id,:] = overrange
+
+                if DATA_VALIDITY_GROUP in self._active_file:
+                    self.__append_lost_samples(block_id,lost_ranges)
+
+                written = block_id+1
+                if perf_counter()-last_flush >= self._flush_interval:
+                    self.__flush(written)
+                    last_flush = perf_counter()
+
+        except Exception as e:
+            self._error = e
+
+            # Keep draining the queue, otherwise the blocks pile up in memory until the run ends.
+            while self._queue.get() is not None:
+                pass
+
+        finally:
+            if self._active_file is not None:
+                try:
+                    self.__flush(written)
+                    if self._swmr and STREAM_CLOSED in self._active_file:
+                        # After the last blocks are on disk, so a reader that sees it has seen all blocks.
+                        self._active_file[STREAM_CLOSED][()] = True
+                except Exception as e:
+                    if self._error is None:
+                        self._error = e
+                finally:
+                    self.close_file()
+
+    def __flush(self,written):
+        self._active_file.attrs["blocks_written"] = written
+        self._active_file.flush()
+        self._blocks_written = written
+
+    def __append_lost_samples(self,block_id,lost_ranges):
+        validity_grp = self._active_file[DATA_VALIDITY_GROUP]
+        lost_ranges  = np.empty((0,2),dtype=np.int64) if lost_ranges is None else lost_ranges
+
+        lost_count = validity_grp["lost_count"]
+        lost_count.resize(block_id+1,axis=0)
+        lost_count[block_id] = np.sum(lost_ranges[:,1]-lost_ranges[:,0])
+
+        if len(lost_ranges) > 0:
+            dataset = validity_grp["lost_ranges"]
+            start   = dataset.shape[0]
+            dataset.resize(start+len(lost_ranges),axis=0)
+            dataset[start:,0]  = block_id
+            dataset[start:,1:] = lost_ranges
+
+
+class HDF5BackgroundWriter(HDF5Writer):
+    """Writes runs to HDF5 files in a writer thread, so the caller can go on with the next run (see Vibrometer.write_data_async).
+
+    Runs are written one at a time in the order they were queued, and every file is fsynced once it is closed, so a run whose
+    future is done is on the disk. At most maxsize runs wait to be written, put() blocks beyond that: the runs hold the run
+    buffers, and memory should not fill up with them when the disk cannot keep up.
+
+    Call close() when done. The writer thread does not keep the interpreter alive by itself, at exit the runs still queued are
+    written (through atexit) and the thread is stopped."""
+
+    def __init__(self,maxsize=2):
+        HDF5Writer.__init__(self)
+
+        self._maxsize = maxsize
+        self._queue   = Queue(maxsize)
+        self._thread  = Thread(target = self.__consumer,daemon=True)
+        self._thread.start()
+
+        # atexit runs its handlers last registered first. h5py unregisters its type converters at exit, so it is imported
+        # before registering, or the runs still queued would be written after that.
+        import h5py
+        atexit.register(self.close)
 
     @property
-    def metadata(self):
-        return self._metadata
-
-    def generate_t_array(self,freq_factor=True):
-        if freq_factor:
-            return ( np.arange(self._total_samples * self._freq_factor) - self._pre_post_trig ) / self._sample_rate
-        else:
-            return ( np.arange(self._total_samples) - self._pre_post_trig//self._freq_factor ) / self._base_sample_rate
-
-    def velocity(self,num):
-        """Output the velocity of a specific run number, scaled to the proper SI units."""
-        return self[f"Velocity/{num}"][()] * self["Velocity/scalefactor"][()]
-
-    def __reconstruct_dict(self):
-        _dict = dict()
-        for key in self.keys():
-            split_key = key.split("__")
-            if len(split_key)>1:
-                if not split_key[0] in _dict:
-                    _dict[split_key[0]] = dict()
-                _dict[split_key[0]][split_key[1]] = self[key][()] 
-
-        return _dict
-    
-    def write_si_data_file(self):
-        """To share data, it can be desirable to have a file to share in SI units, we'll still use hdf5.
-
-        We write:
-        - Time
-        - BaseTime
-        - Velocity/<num>
-        - Overrange/<num>
-        - RSSI/<num>
-        - Trigger/<num>
-
-        - Metadata saved in metadata/<type>/<variable>"""
-
-        _file = h5py.File(self.filename+".si","w")
-
-        _file["Time"] = self.generate_t_array()
-        _file["BaseTime"] = self.generate_t_array(False)
-
-        for num in range(self._block_count):
-            _file[f"Time"] = self.generate_t_array()
-            _file[f"BaseTime"] = self.generate_t_array(freq_factor=False)
-            _file[f"Velocity/{num}"] = self[f"Velocity/{num}"][()] * self["Velocity/scalefactor"][()]
-            _file[f"Overrange/{num}"] = self[f"Velocity/overrange/{num}"][()]
-            _file[f"RSSI/{num}"] = self[f"RSSI/{num}"][()] * self["RSSI/scalefactor"][()]
-            _file[f"Trigger/{num}"] = self[f"Trigger/{num}"][()]
-
-        # Now the metadata
-        for key,_dict in self.metadata.items():
-            for key2,value2 in _dict.items():
-                _file[f"metadata/{key}/{key2}"] = value2
-
-        _file.close()
-        del _file
-
-## Old function that dealt with single-trace files.
-def series_to_one_file(location,prefix,param_range,postfix=".hdf5"):
-    """To convert a series of measurements to a single file, reducing everything to SI units like in the above code."""
-    filename = f"{location}/{prefix}{postfix}"
-
-    _file = h5py.File(filename,"w")
-
-    first = True
-
-    # For each param, we open the file and load the relevant data.
-    for param in param_range:
-        file_loc = f"{location}/{prefix}_{param}{postfix}"
-        subgroup = _file.create_group(f"{param}")
-
-        read_file = HDF5Reader(file_loc)
-
-        for num in range(read_file["vibrometer__block_count"][()]):
-            subgroup[f"Velocity/{num}"] = read_file[f"Velocity/{num}"][()] * read_file["Velocity/scalefactor"][()]
-            subgroup[f"Overrange/{num}"] = read_file[f"Velocity/overrange/{num}"][()]
-            subgroup[f"RSSI/{num}"] = read_file[f"RSSI/{num}"][()] * read_file["RSSI/scalefactor"][()]
-            subgroup[f"Trigger/{num}"] = read_file[f"Trigger/{num}"][()]
-
-        subgroup[f"Time"] = read_file.generate_t_array()
-        subgroup[f"BaseTime"] = read_file.generate_t_array(freq_factor=False)
-        subgroup[f"avgVelocity"] = read_file.average_velocity()
-
-        if first:
-            first = False
-            # Now the metadata
-            for key,_dict in read_file.metadata.items():
-                for key2,value2 in _dict.items():
-                    _file[f"metadata/{key}/{key2}"] = value2
-
-        read_file.close()
-        del read_file
-
-    _file.close()
-    del _file
-
-# HDF5 does not play nice with dictionaries so this is just a quick work-around to make it work nicely.
-def write_simple_dict_to_hdf5_subgroup(subgroup,_dict):
-    for key,value in _dict.items():
-        subgroup[key] = value
-    
-
-
-def recv_gather_to_one_file(location,prefix,postfix=".hdf5"):
-    # What filename will we save to?
-    filename = f"{location}/{prefix}{postfix}"
-
-    # Create this file.
-    _file = h5py.File(filename,"w")
-
-    # Find all files which match the pattern. These will be fused into one file.
-    data_files = glob(f"{location}/{prefix}_*{postfix}")
-
-    # Aux variables for looping over traces
-    first    = True
-    trace_it = 0
-    file_num = 0
-
-    print(f"Processing {len(data_files)} files.")
-
-    for data_file in data_files:
-        print(f"Entering file {file_num}.")
-
-        # file_it tracks which shot we're at in this specific file.
-        file_it = 0
-
-        # Read file using the HDF5 reader.
-        read_file = HDF5Reader(data_file)
-
-        # Files in the HDF5 reader are sorted chronologically. We first want to identify how many traces and their metadata.
-        # In the receiver gather format, this is saved in the traces dictionary.
-        rcv_location  = read_file.metadata["traces"]["receiver_loc"]
-        src_locations = read_file.metadata["traces"]["src_locations"]
-
-        # Derive the number of unique traces in this file from the rcv_locations
-        num_traces = len(src_locations)
-        shots_per_tr  = read_file.metadata["traces"]["shots_per_point"]
-
-        preexp_shots  = read_file.preexp_shots
-        postexp_shots = read_file.postexp_shots
-
-
-        # If the data is complete, the total number of blocks for the vibrometer should be
-        # the number of traces * number of points. Let's check this. The vib doesn't save if this is not the case.
-        if shots_per_tr*num_traces+preexp_shots+postexp_shots != read_file.metadata["vibrometer"]["block_count"]:
-            raise IOError(f"The datafile {data_file} does not seem to be complete. Expected: {shots_per_tr*num_traces}. Present: {read_file.metadata['vibrometer']['block_count']}.")
-
-        # If this is the first time this file is written to, we need to write the data structure.
-        if first:
-            first = False  # Don't do this again
-
-            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/experiment"),read_file.metadata["experiment"])
-
-            # Devices
-            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/laser"),read_file.metadata["laser"])
-            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/vibrometer"),read_file.metadata["vibrometer"])
-
-            # If there is galvo or rotator metadata, we write this as well
-            if "galvo" in read_file.metadata.keys():
-                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/galvo"),read_file.metadata["galvo"])
-
-            if "rotator" in read_file.metadata.keys():
-                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/rotator"),read_file.metadata["rotator"])
-
-            # If there is information about the sample, add it here as well.
-            if "sample" in read_file.metadata.keys():
-                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/sample"),read_file.metadata["sample"])
-            else: # Otherwise we create an empty group.
-                _file.create_group("metadata/sample")
-
-            # Create the group for trace metadata, data
-            _file.create_group("data/sample")
-            _file.create_group("data/trace")
-            _file.create_group("metadata/trace")
-
-        # Ok, that concludes organizing the data file. Now onto data copying/output.
-
-        # Pre-experiment background traces
-        if preexp_shots>0:
-            start_num = 0
-            end_num   = preexp_shots
-
-            subgroup = _file.create_group(f"data/special_trace/pre_experiment_beamdump/{file_num}")
-            subgroup_metadata = _file.create_group(f"metadata/special_trace/pre_experiment_beamdump/{file_num}")
-
-            # We save all the raw data.
-            for num in range(preexp_shots):
-                subgroup[f"Velocity/{num}"] = read_file[f"Velocity/{num+start_num}"][()] * read_file["Velocity/scalefactor"][()]
-                subgroup[f"Overrange/{num}"] = read_file[f"Velocity/overrange/{num+start_num}"][()]
-                subgroup[f"RSSI/{num}"] = read_file[f"RSSI/{num+start_num}"][()] * read_file["RSSI/scalefactor"][()]
-                subgroup[f"Trigger/{num}"] = read_file[f"Trigger/{num+start_num}"][()]
-
-            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
-            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
-            subgroup[f"Time"] = read_file.generate_t_array()
-            subgroup[f"BaseTime"] = read_file.generate_t_array(freq_factor=False)
-            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num)
-
-
-        # For each trace, we make a variable called subgroup.
-        for src_location in src_locations:
-            # Iterators in the file run between these 2 values.
-            start_num = file_it * shots_per_tr + preexp_shots
-            end_num   = (file_it+1) * shots_per_tr + preexp_shots
-
-            subgroup = _file.create_group(f"data/trace/{trace_it}")
-            subgroup_metadata = _file.create_group(f"metadata/trace/{trace_it}")
-
-            # We save all the raw data.
-            for num in range(shots_per_tr):
-                subgroup[f"Velocity/{num}"] = read_file[f"Velocity/{num+start_num}"][()] * read_file["Velocity/scalefactor"][()]
-                subgroup[f"Overrange/{num}"] = read_file[f"Velocity/overrange/{num+start_num}"][()]
-                subgroup[f"RSSI/{num}"] = read_file[f"RSSI/{num+start_num}"][()] * read_file["RSSI/scalefactor"][()]
-                subgroup[f"Trigger/{num}"] = read_file[f"Trigger/{num+start_num}"][()]
-
-            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
-            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
-            # Average velocity now also has background substracted.
-            subgroup[f"Time"] = read_file.generate_t_array()
-            subgroup[f"BaseTime"] = read_file.generate_t_array(freq_factor=False)
-            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num) - read_file.background_traces
-
-            # That was all the data. Now the metadata.
-            # For now, this just stores source and receiver locations.
-            subgroup_metadata[f"rcv_location"] = rcv_location
-            subgroup_metadata[f"src_location"] = src_location
-
-            # Increment the trace iterator and the file iterator
-            trace_it += 1
-            file_it  += 1
-
-
-
-    
-        # Post-experiment background traces
-        if postexp_shots>0:
-            start_num = file_it * shots_per_tr + preexp_shots
-            end_num = file_it * shots_per_tr + preexp_shots + postexp_shots
-
-            subgroup = _file.create_group(f"data/special_trace/post_experiment_beamdump/{file_num}")
-            subgroup_metadata = _file.create_group(f"metadata/special_trace/post_experiment_beamdump/{file_num}")
-
-            # We save all the raw data.
-            for num in range(postexp_shots):
-                subgroup[f"Velocity/{num}"] = read_file[f"Velocity/{num+start_num}"][()] * read_file["Velocity/scalefactor"][()]
-                subgroup[f"Overrange/{num}"] = read_file[f"Velocity/overrange/{num+start_num}"][()]
-                subgroup[f"RSSI/{num}"] = read_file[f"RSSI/{num+start_num}"][()] * read_file["RSSI/scalefactor"][()]
-                subgroup[f"Trigger/{num}"] = read_file[f"Trigger/{num+start_num}"][()]
-
-            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
-            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
-            subgroup[f"Time"] = read_file.generate_t_array()
-            subgroup[f"BaseTime"] = read_file.generate_t_array(freq_factor=False)
-            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num)
-
-        read_file.close()
-        del read_file
-
-        file_num += 1
-
-    # At the end of the import, we should write the total number of traces to the experiment metadata.
-    _file["metadata/experiment/total_traces"] = trace_it
-
-    _file.close()
-    del _file
-
-
-
-
-
-
-    
+    def maxsize(self):
+        return self._maxsize
 
+    @property
+    def pending(self):
+        """Number of runs queued or being written."""
+        return self._queue.unfinished_tasks
+
+    def put(self,filename,metadata,data=None,statistics=None,lost_samples=None,overwrite=False,compression=None,release=None,
+            timeout=None):
+        """Queue a run for writing, see HDF5Writer.write_run for the arguments. The writer owns data from here on: release(data)
+        is called once it is written. Blocks while the queue is full, at most timeout (s), then raises queue.Full. Returns a
+        concurrent.futures.Future, done (with the filename as result) once the file is written and fsynced, or with the error.
+        A run that could not be written is not released, the error carries it as its data attribute."""
+        # Checked here, an exception in the writer thread would only surface through the future.
+        if (not overwrite) and os.path.exists(filename):
+            raise IOError(f"File {filename} exists. Turn on overwrite or choose another file.")
+
+        future = Future()
+        self._queue.put((future,filename,metadata,data,statistics,lost_samples,overwrite,compression,release),timeout=timeout)
+        return future
+
+    def flush(self):
+        """Wait until all queued runs are written."""
+        self._queue.join()
+
+    def close(self):
+        """Write the runs still queued, then stop the writer thread."""
+        atexit.unregister(self.close)
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def __consumer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            future, filename, metadata, data, statistics, lost_samples, overwrite, compression, release = item
+            written = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    self.write_run(filename,metadata,data,statistics,lost_samples,overwrite,compression)
+                    with open(filename,"rb+") as written_file:
+                        os.fsync(written_file.fileno())
+                    written = True
+                    future.set_result(filename)
+                except Exception as e:
+                    # The caller gets the run back with the error, it may be the only copy.
+                    e.data = data
+                    future.set_exception(e)
+
+            if written and release is not None and data is not None:
+                release(data)
+            self._queue.task_done()
+
+
+# The reading side used to live in this file, importing it from here still works.
+_READER_NAMES = ["HDF5Reader","series_to_one_file","write_simple_dict_to_hdf5_subgroup","recv_gather_to_one_file"]
+
+def __getattr__(name):
+    if name in _READER_NAMES:
+        from . import HDF5Reader
+        return getattr(HDF5Reader,name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
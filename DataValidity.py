@@ -0,0 +1,106 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# The DataValidity channel flags every sample for which the device lost the data packet. Polytec checks it one sample at a
+# time in Python and gives up on the first lost packet. Here a chunk is checked in a single numpy pass, and the lost samples
+# are kept as (start, stop) ranges per block, which is compact since packets get lost in runs. The ranges end up in the HDF5
+# file (see HDF5Writer.write_lost_samples), so bad shots can be left out without going through the raw data again.
+
+import numpy as np
+
+
+def lost_sample_ranges(valid,offset=0):
+    """(start, stop) ranges of the False samples in valid, as an (n, 2) int64 array. offset is added to every index."""
+    lost = ~np.asarray(valid,dtype=bool)
+    if not lost.any():
+        return np.empty((0,2),dtype=np.int64)
+
+    # +1 where a run of lost samples starts, -1 right after it ends.
+    edges = np.diff(np.concatenate(([False],lost,[False])).astype(np.int8))
+    return np.column_stack((np.flatnonzero(edges == 1),np.flatnonzero(edges == -1))).astype(np.int64) + offset
+
+def window_ranges(ranges,windows):
+    """Translate (start, stop) ranges of samples of a block into the samples kept by capture windows, the (n, 2) [start, stop)
+    ranges of the block that were stored back to back. Parts outside all windows are dropped, parts that end up adjacent
+    are merged."""
+    lengths = windows[:,1]-windows[:,0]
+    offsets = np.concatenate(([0],np.cumsum(lengths)[:-1]))
+
+    kept = []
+    for start,stop in ranges:
+        for (first,last),offset in zip(windows,offsets):
+            clipped_start, clipped_stop = max(start,first), min(stop,last)
+            if clipped_start >= clipped_stop:
+                continue
+
+            clipped = [clipped_start-first+offset,clipped_stop-first+offset]
+            if len(kept) > 0 and kept[-1][1] == clipped[0]:
+                kept[-1][1] = clipped[1]
+            else:
+                kept.append(clipped)
+
+    return np.array(kept,dtype=np.int64).reshape(-1,2)
+
+
+class LostSampleIndex:
+    """Lost sample ranges of a run, per block. Indices are DataValidity samples within the block, stop is exclusive. With
+    capture windows they are translated into the stored samples once the block is done, see to_windows()."""
+
+    def __init__(self):
+        self._ranges = dict()
+
+    def add(self,block_id,ranges):
+        """Add the ranges of a chunk of a block. Ranges have to come in order, a range continuing the previous one of the
+        same block (a packet loss spanning two chunks) is merged into it."""
+        if len(ranges) == 0:
+            return
+
+        previous = self._ranges.get(block_id)
+        if previous is None:
+            self._ranges[block_id] = np.asarray(ranges,dtype=np.int64)
+            return
+
+        ranges = np.array(ranges,dtype=np.int64)
+        if previous[-1,1] == ranges[0,0]:
+            ranges[0,0] = previous[-1,0]
+            previous = previous[:-1]
+        self._ranges[block_id] = np.concatenate((previous,ranges))
+
+    def to_windows(self,block_id,windows):
+        """Translate the ranges of a finished block into the samples kept by the capture windows (see window_ranges). A block
+        that only lost samples outside the windows counts as clean."""
+        if block_id not in self._ranges:
+            return
+
+        ranges = window_ranges(self._ranges[block_id],windows)
+        if len(ranges) > 0:
+            self._ranges[block_id] = ranges
+        else:
+            del self._ranges[block_id]
+
+    def ranges(self,block_id):
+        """Lost sample ranges of a block, an (n, 2) array of (start, stop)."""
+        return self._ranges.get(block_id,np.empty((0,2),dtype=np.int64))
+
+    def lost_count(self,block_count):
+        """Number of lost samples per block."""
+        counts = np.zeros(block_count,dtype=np.int64)
+        for block_id,ranges in self._ranges.items():
+            if block_id < block_count:
+                counts[block_id] = np.sum(ranges[:,1]-ranges[:,0])
+        return counts
+
+    def valid_blocks(self,block_count):
+        """Mask of the blocks without lost samples."""
+        return self.lost_count(block_count) == 0
+
+    def to_array(self):
+        """All ranges as an (n, 3) array of (block_id, start, stop), sorted by block."""
+        if len(self._ranges) == 0:
+            return np.empty((0,3),dtype=np.int64)
+
+        return np.concatenate([np.column_stack((np.full(len(ranges),block_id,dtype=np.int64),ranges))
+                               for block_id,ranges in sorted(self._ranges.items())])
+
+    def __len__(self):
+        """Number of blocks with lost samples."""
+        return len(self._ranges)
@@ -0,0 +1,631 @@
+# (c) Jasper Smits 2022, release under LGPLv3
+
+# Reading the files written by HDF5Writer and HDF5StreamWriter (see DataManagement), and merging series of them into a single
+# file in SI units.
+
+import h5py
+import json
+
+from glob import glob
+from time import perf_counter, sleep
+
+import numpy as np
+
+from .BlockDispatcher import Block
+from .DataManagement import BLOCK_LAYOUT_VERSION, DATA_VALIDITY_GROUP, METADATA_GROUP, METADATA_LAYOUT_VERSION, STREAM_CLOSED
+
+# Registers the Bitshuffle filter with HDF5, for files written with Compression("bitshuffle"). Not needed for anything else.
+try:
+    import hdf5plugin
+except ImportError:
+    pass
+
+# Marks metadata_value calls without a default.
+_REQUIRED = object()
+
+def _decode(value):
+    """String metadata is read back as bytes from datasets (and the old layout), but as str from attributes."""
+    return value.decode() if isinstance(value,bytes) else value
+
+
+class HDF5Reader(h5py.File):
+    """A class to deal with conversion of data from the HDF5Writer. Unpacks the metadata back into the dict-of-dicts format. Converts data to SI units in a convenient way. One instance per file, wraps around the HDF5 reader, basically. Based on the h5py.File class."""
+    def __init__(self,filename,**kwargs):
+        super().__init__(filename,"r",**kwargs)
+        self._format_version = self.attrs.get("format_version",1)
+
+        self._base_sample_rate  = self.metadata_value("vibrometer","daq_base_sample_rate")
+        self._freq_factor = self.metadata_value("vibrometer","daq_sample_rate")//self._base_sample_rate
+        self._pre_post_trig = self.metadata_value("vibrometer","pre_post_trigger")
+        self._base_samples  = self.metadata_value("vibrometer","block_size")
+        self._total_samples = self._base_samples * self._freq_factor
+        self._sample_rate   = self._base_sample_rate*self._freq_factor
+        self._block_count  = self.metadata_value("vibrometer","block_count")
+
+        # Accumulate runs only have the statistics of the blocks, not the blocks themselves.
+        self._accumulated = bool(self.attrs.get("accumulated",False))
+
+        # Streamed files may have been cut short, in that case only the blocks that made it to disk count. Files streamed in
+        # SWMR mode may still be growing, their blocks are counted on disk, see refresh().
+        self._run_block_count = self._block_count
+        self._swmr = STREAM_CLOSED in self
+        if self._swmr:
+            self.refresh()
+        elif self._format_version >= BLOCK_LAYOUT_VERSION and "blocks_written" in self.attrs:
+            self._block_count = min(self._block_count,self.attrs["blocks_written"])
+
+        # All metadata and the background traces are only read when asked for, see metadata and background_traces.
+        self._metadata          = None
+        self._background_traces = None
+
+        # The lost sample ranges sorted by run number, read once and extended with the rows a SWMR writer appended since, see
+        # lost_samples.
+        self._lost_ranges = np.empty((0,3),dtype=np.int64)
+
+        # Let's see whether there's any background substraction to be done. If so, we have pre- and/or post-experiment
+        # beamdump traces.
+        self._preexp_shots  = self.metadata_value("traces","pre_exp_beamdump",0)
+        self._postexp_shots = self.metadata_value("traces","post_exp_beamdump",0)
+
+    def average_velocity(self,start=0,end=None):
+        # Apparently we can't use self variables in the function definition
+        if end == None:
+            end = self._block_count
+
+        # Accumulated files have the average over all blocks ready, but nothing to average a part of the blocks over.
+        if self._accumulated:
+            if start != 0 or end != self._block_count:
+                raise ValueError("Accumulated files only hold the average over all blocks.")
+            return self["Velocity/mean"][()] * self["Velocity/scalefactor"][()]
+
+        # A chunk row at a time, in the block layout that is one read per chunk instead of one per block.
+        arr  = np.zeros(self._velocity_samples(),dtype=float)
+        rows = self._chunk_rows("Velocity")
+        for it in range(start,end,rows):
+            arr += np.sum(self.blocks("Velocity",it,min(it+rows,end)),axis=0,dtype=float)
+
+        return arr * self["Velocity/scalefactor"][()] / (end-start)
+
+    @property
+    def block_count(self):
+        return self._block_count
+
+    @property
+    def channels(self):
+        """Names of the channels in the file."""
+        return [name for name,obj in self.items() if isinstance(obj,h5py.Group) and "scalefactor" in obj]
+
+    ### Files still being written, streamed in SWMR mode (see Vibrometer.stream_data)
+    def refresh(self):
+        """Pick up the blocks flushed since the file was opened (or last refreshed) of a file streamed in SWMR mode, opened with
+        HDF5Reader(filename, swmr=True). Returns the new block_count. For other files this just returns block_count."""
+        if not self._swmr:
+            return self._block_count
+
+        # A block counts once it is on disk for every channel.
+        datasets = [self[f"{ch_name}/{name}"] for ch_name in self.channels for name in ["blocks","overrange"]
+                    if name in self[ch_name]]
+        if DATA_VALIDITY_GROUP in self:
+            datasets += [self[f"{DATA_VALIDITY_GROUP}/lost_count"],self[f"{DATA_VALIDITY_GROUP}/lost_ranges"]]
+
+        written = self._run_block_count
+        for dataset in datasets:
+            if self.swmr_mode:
+                dataset.refresh()
+            if dataset.name != f"/{DATA_VALIDITY_GROUP}/lost_ranges":
+                written = min(written,dataset.shape[0])
+
+        self._block_count = written
+        return written
+
+    @property
+    def stream_closed(self):
+        """Is the writer of a file streamed in SWMR mode done with it? Always True for other files."""
+        if not self._swmr:
+            return True
+
+        dataset = self[STREAM_CLOSED]
+        if self.swmr_mode:
+            dataset.refresh()
+        return bool(dataset[()])
+
+    def follow(self,start=0,timeout=None,poll_interval=0.1):
+        """Iterate over the blocks of a file streamed in SWMR mode while it is being written, from run number start on. Every
+        block is yielded as soon as it is on disk, as a BlockDispatcher.Block with the raw samples, like Vibrometer.iter_blocks.
+        Ends when the writer is done and all blocks were yielded. Raises TimeoutError if timeout (s) passes without a new block.
+        For other files, this iterates over the blocks there are."""
+        channels = self.channels
+        num, last_block = start, perf_counter()
+        while True:
+            # Checked before looking for new blocks: once the writer is done, its last blocks are on disk.
+            closed    = self.stream_closed
+            available = self.refresh()
+            while num < available:
+                yield self.__read_block(channels,num)
+                num += 1
+                last_block = perf_counter()
+
+            if closed or num >= self._run_block_count:
+                return
+            if timeout is not None and perf_counter()-last_block > timeout:
+                raise TimeoutError(f"No new block in {self.filename} for {timeout} s.")
+            sleep(poll_interval)
+
+    def __read_block(self,channels,num):
+        samples   = {ch_name: self.block(ch_name,num) for ch_name in channels}
+        overrange = {ch_name: self.overrange(ch_name,num) for ch_name in channels if "overrange" in self[ch_name]}
+        return Block(num,samples,overrange,lost_ranges=self.lost_samples(num))
+
+    @property
+    def accumulated(self):
+        """Was this file written by an accumulate run? Then there are statistics (see statistics()) instead of blocks."""
+        return self._accumulated
+
+    def statistics(self,channel,scaled=True):
+        """Statistics over the blocks of a channel in an accumulated file, as a dict of arrays. When scaled, everything but
+        count and overrange_count is converted to SI units (the variance with the square of the scale factor)."""
+        if not self._accumulated:
+            raise ValueError("File holds blocks, not statistics.")
+
+        ch_grp      = self[channel]
+        scalefactor = ch_grp["scalefactor"][()] if scaled else 1
+
+        statistics = {"count": ch_grp["count"][()]}
+        for key in ["sum","mean","min","max"]:
+            if key in ch_grp:
+                statistics[key] = ch_grp[key][()] * scalefactor
+        statistics["variance"] = ch_grp["variance"][()] * scalefactor**2
+        if "overrange_count" in ch_grp:
+            statistics["overrange_count"] = ch_grp["overrange_count"][()]
+
+        return statistics
+
+    @property
+    def preexp_shots(self):
+        return self._preexp_shots
+
+    @property
+    def postexp_shots(self):
+        return self._postexp_shots
+
+    @property
+    def background_traces(self):
+        if self._background_traces is None:
+            self._background_traces = self._calc_background_traces()
+        return self._background_traces
+
+    def _calc_background_traces(self):
+        # If there is pre-experiment and post-experiment background recordings, this property
+        # can be used to substract them.
+        arr = np.zeros(self._velocity_samples(),dtype=float)
+        if self._preexp_shots > 0:
+            arr += self._preexp_shots * self.average_velocity()
+
+        if self._postexp_shots > 0:
+            arr += self._postexp_shots * self.average_velocity()
+
+        if self._preexp_shots + self._postexp_shots > 0:
+            return arr/(self._preexp_shots+self._postexp_shots)
+        else:
+            return 0
+
+    @property
+    def metadata(self):
+        """All metadata as a dict of dicts, read on first access. Strings are str, in either layout."""
+        if self._metadata is None:
+            self._metadata = self.__reconstruct_dict()
+        return self._metadata
+
+    def metadata_value(self,group,key,default=_REQUIRED):
+        """A single metadata value, read on its own instead of with all the others. Returns default if given and the value is
+        not in the file, raises KeyError otherwise."""
+        if self._format_version >= METADATA_LAYOUT_VERSION:
+            path = f"{METADATA_GROUP}/{group}"
+            if path in self and key in self[path].attrs:
+                return _decode(self[path].attrs[key])
+            path = f"{path}/{key}"
+        else:
+            path = f"{group}__{key}"
+
+        if path in self:
+            return _decode(self[path][()])
+        if default is _REQUIRED:
+            raise KeyError(f"No metadata {group}/{key} in {self.filename}.")
+        return default
+
+    def generate_t_array(self,freq_factor=True,decimation=1,windows=None):
+        """Time axis of a block. decimation gives the time axis of a channel decimated during the acquisition, see
+        decimation(), windows that of a channel cut down to capture windows, see windows(). channel_t_array() does both."""
+        if freq_factor:
+            samples = np.arange(self._total_samples)
+            t_array = ( samples - self._pre_post_trig ) / self._sample_rate
+        else:
+            samples = np.arange(self._base_samples)
+            t_array = ( samples - self._pre_post_trig//self._freq_factor ) / self._base_sample_rate
+
+        # A trailing partial decimation window is dropped by the filter.
+        t_array = t_array[:len(samples)//decimation*decimation:decimation]
+
+        if windows is not None:
+            t_array = np.concatenate([t_array[start:stop] for start,stop in windows])
+        return t_array
+
+    def channel_t_array(self,channel):
+        """Time axis of the stored samples of a channel, taking decimation and capture windows into account."""
+        return self.generate_t_array(freq_factor=channel != "RSSI",decimation=self.decimation(channel),
+                                     windows=self.windows(channel))
+
+    def windows(self,channel):
+        """Sample ranges [start, stop) of the block a channel was cut down to during the acquisition, as an (n, 2) array.
+        None when the whole block was kept."""
+        return self[channel].attrs["windows"] if "windows" in self[channel].attrs else None
+
+    def _velocity_samples(self):
+        """Number of velocity samples per block, fewer than _total_samples when it was decimated or cut down to capture
+        windows during the acquisition."""
+        if "Velocity" not in self:
+            return self._total_samples
+        if self.windows("Velocity") is not None:
+            return int(np.sum(np.diff(self.windows("Velocity"),axis=1)))
+        return self._total_samples // self.decimation("Velocity")
+
+    def decimation(self,channel):
+        """Decimation factor of a channel that was filtered during the acquisition (see OnlineFilter), 1 otherwise."""
+        return int(self[channel].attrs.get("decimation",1))
+
+    def filter_description(self,channel):
+        """Description of the filter a channel went through during the acquisition (see OnlineFilter.describe), or None."""
+        if "filter" not in self[channel].attrs:
+            return None
+        return json.loads(self[channel].attrs["filter"])
+
+    def block(self,channel,num):
+        """Raw samples of a specific run number of a channel, independent of the layout the file was written in."""
+        if self._format_version >= BLOCK_LAYOUT_VERSION:
+            return self[f"{channel}/blocks"][num]
+        else:
+            return self[f"{channel}/{num}"][()]
+
+    def blocks(self,channel,start,stop):
+        """Raw samples of the run numbers [start, stop) of a channel as a (blocks, samples) array, independent of the layout the
+        file was written in. In the block layout this is a single read."""
+        if self._format_version >= BLOCK_LAYOUT_VERSION:
+            return self[f"{channel}/blocks"][start:stop]
+        else:
+            return np.array([self[f"{channel}/{num}"][()] for num in range(start,stop)])
+
+    def _chunk_rows(self,channel):
+        """Number of blocks per chunk of a channel, to read the blocks chunk by chunk. 1 for the legacy layout."""
+        if self._format_version >= BLOCK_LAYOUT_VERSION:
+            chunks = self[f"{channel}/blocks"].chunks
+            return chunks[0] if chunks is not None else 1
+        return 1
+
+    def overrange(self,channel,num):
+        """Overrange flags of a specific run number of a channel, independent of the layout the file was written in."""
+        overrange_obj = self[f"{channel}/overrange"]
+        if self._format_version >= BLOCK_LAYOUT_VERSION:
+            overrange = overrange_obj[num]
+        else:
+            overrange = overrange_obj[f"{num}"][()]
+
+        # Bit-packed overrange gets unpacked to one bool per sample again.
+        if overrange_obj.attrs.get("packed",False):
+            return np.unpackbits(overrange,count=overrange_obj.attrs["sample_count"]).astype(bool)
+        else:
+            return overrange
+
+    def lost_samples(self,num):
+        """(start, stop) ranges of the samples of a run number the DataValidity channel flagged as lost. Empty when the file
+        has no lost sample summary."""
+        if DATA_VALIDITY_GROUP not in self:
+            return np.empty((0,2),dtype=np.int64)
+
+        lost_ranges = self.__sorted_lost_ranges()
+        first, last = np.searchsorted(lost_ranges[:,0],[num,num+1])
+        return lost_ranges[first:last,1:]
+
+    def __sorted_lost_ranges(self):
+        """The lost_ranges dataset sorted by run number. Only the rows not read before are read, so reading the lost samples
+        block by block (see follow) does not read the whole dataset for every block."""
+        dataset = self[f"{DATA_VALIDITY_GROUP}/lost_ranges"]
+        known   = len(self._lost_ranges)
+        if dataset.shape[0] > known:
+            lost_ranges = np.concatenate([self._lost_ranges,dataset[known:]])
+            self._lost_ranges = lost_ranges[np.argsort(lost_ranges[:,0],kind="stable")]
+        return self._lost_ranges
+
+    def valid_blocks(self):
+        """Mask of the run numbers without lost samples, to leave bad shots out. All True when the file has no lost sample
+        summary (no DataValidity channel, or written before it was recorded)."""
+        if DATA_VALIDITY_GROUP not in self:
+            return np.ones(self._block_count,dtype=bool)
+
+        return self[f"{DATA_VALIDITY_GROUP}/lost_count"][:self._block_count] == 0
+
+    def channel_memmap(self,channel,filename,scaled=False):
+        """Convert all blocks of a channel to a (blocks, samples) np.memmap file, block by block, so it never has to fit in
+        memory. When scaled, the samples are stored as float64 in SI units. Returns the memmap."""
+        first = self.block(channel,0)
+        dtype = np.float64 if scaled else first.dtype
+        array = np.memmap(filename,dtype=dtype,mode="w+",shape=(self._block_count,first.shape[0]))
+
+        scalefactor = self[f"{channel}/scalefactor"][()] if scaled else 1
+        rows = self._chunk_rows(channel)
+        for num in range(0,self._block_count,rows):
+            stop = min(num+rows,self._block_count)
+            array[num:stop] = self.blocks(channel,num,stop) * scalefactor if scaled else self.blocks(channel,num,stop)
+
+        array.flush()
+        return array
+
+    def velocity(self,num):
+        """Output the velocity of a specific run number, scaled to the proper SI units."""
+        return self.block("Velocity",num) * self["Velocity/scalefactor"][()]
+
+    def __reconstruct_dict(self):
+        _dict = dict()
+        if self._format_version >= METADATA_LAYOUT_VERSION:
+            for key,grp in self.get(METADATA_GROUP,dict()).items():
+                _dict[key] = {skey: _decode(value) for skey,value in grp.attrs.items()}
+                _dict[key].update({skey: _decode(dataset[()]) for skey,dataset in grp.items()})
+            return _dict
+
+        # Files before METADATA_LAYOUT_VERSION: <group>__<key> datasets in the root.
+        for key in self.keys():
+            split_key = key.split("__")
+            if len(split_key)>1:
+                if not split_key[0] in _dict:
+                    _dict[split_key[0]] = dict()
+                _dict[split_key[0]][split_key[1]] = _decode(self[key][()])
+
+        return _dict
+    
+    def write_si_data_file(self):
+        """To share data, it can be desirable to have a file to share in SI units, we'll still use hdf5.
+
+        We write:
+        - Time
+        - BaseTime
+        - Velocity/<num>
+        - Overrange/<num>
+        - RSSI/<num>
+        - Trigger/<num>
+
+        - Metadata saved in metadata/<type>/<variable>"""
+
+        _file = h5py.File(self.filename+".si","w")
+
+        _file["Time"] = self.channel_t_array("Velocity")
+        _file["BaseTime"] = self.channel_t_array("RSSI")
+
+        _write_si_blocks(_file,self,0,self._block_count)
+
+        # Now the metadata
+        for key,_dict in self.metadata.items():
+            for key2,value2 in _dict.items():
+                _file[f"metadata/{key}/{key2}"] = value2
+
+        _file.close()
+        del _file
+
+def _write_si_blocks(subgroup,read_file,start,count):
+    """Store count blocks of read_file from run number start on as Velocity/<num>, Overrange/<num>, RSSI/<num> and
+    Trigger/<num> (num counting from 0) in subgroup, in SI units. The channels are read a chunk row of Velocity at a time, so
+    only that many blocks are in memory at once."""
+    velocity_scale = read_file["Velocity/scalefactor"][()]
+    rssi_scale     = read_file["RSSI/scalefactor"][()]
+
+    rows = read_file._chunk_rows("Velocity")
+    for first in range(0,count,rows):
+        last     = min(first+rows,count)
+        velocity = read_file.blocks("Velocity",start+first,start+last) * velocity_scale
+        rssi     = read_file.blocks("RSSI",start+first,start+last) * rssi_scale
+        trigger  = read_file.blocks("Trigger",start+first,start+last)
+
+        for num in range(first,last):
+            subgroup[f"Velocity/{num}"]  = velocity[num-first]
+            subgroup[f"Overrange/{num}"] = read_file.overrange("Velocity",start+num)
+            subgroup[f"RSSI/{num}"]      = rssi[num-first]
+            subgroup[f"Trigger/{num}"]   = trigger[num-first]
+
+## Old function that dealt with single-trace files.
+def series_to_one_file(location,prefix,param_range,postfix=".hdf5"):
+    """To convert a series of measurements to a single file, reducing everything to SI units like in the above code."""
+    filename = f"{location}/{prefix}{postfix}"
+
+    _file = h5py.File(filename,"w")
+
+    first = True
+
+    # For each param, we open the file and load the relevant data.
+    for param in param_range:
+        file_loc = f"{location}/{prefix}_{param}{postfix}"
+        subgroup = _file.create_group(f"{param}")
+
+        read_file = HDF5Reader(file_loc)
+
+        _write_si_blocks(subgroup,read_file,0,read_file.block_count)
+
+        subgroup[f"Time"] = read_file.channel_t_array("Velocity")
+        subgroup[f"BaseTime"] = read_file.channel_t_array("RSSI")
+        subgroup[f"avgVelocity"] = read_file.average_velocity()
+
+        if first:
+            first = False
+            # Now the metadata
+            for key,_dict in read_file.metadata.items():
+                for key2,value2 in _dict.items():
+                    _file[f"metadata/{key}/{key2}"] = value2
+
+        read_file.close()
+        del read_file
+
+    _file.close()
+    del _file
+
+# HDF5 does not play nice with dictionaries so this is just a quick work-around to make it work nicely.
+def write_simple_dict_to_hdf5_subgroup(subgroup,_dict):
+    for key,value in _dict.items():
+        subgroup[key] = value
+    
+
+
+def recv_gather_to_one_file(location,prefix,postfix=".hdf5"):
+    # What filename will we save to?
+    filename = f"{location}/{prefix}{postfix}"
+
+    # Create this file.
+    _file = h5py.File(filename,"w")
+
+    # Find all files which match the pattern. These will be fused into one file.
+    data_files = glob(f"{location}/{prefix}_*{postfix}")
+
+    # Aux variables for looping over traces
+    first    = True
+    trace_it = 0
+    file_num = 0
+
+    print(f"Processing {len(data_files)} files.")
+
+    for data_file in data_files:
+        print(f"Entering file {file_num}.")
+
+        # file_it tracks which shot we're at in this specific file.
+        file_it = 0
+
+        # Read file using the HDF5 reader.
+        read_file = HDF5Reader(data_file)
+
+        # Files in the HDF5 reader are sorted chronologically. We first want to identify how many traces and their metadata.
+        # In the receiver gather format, this is saved in the traces dictionary.
+        rcv_location  = read_file.metadata["traces"]["receiver_loc"]
+        src_locations = read_file.metadata["traces"]["src_locations"]
+
+        # Derive the number of unique traces in this file from the rcv_locations
+        num_traces = len(src_locations)
+        shots_per_tr  = read_file.metadata["traces"]["shots_per_point"]
+
+        preexp_shots  = read_file.preexp_shots
+        postexp_shots = read_file.postexp_shots
+
+
+        # If the data is complete, the total number of blocks for the vibrometer should be
+        # the number of traces * number of points. Let's check this. The vib doesn't save if this is not the case.
+        if shots_per_tr*num_traces+preexp_shots+postexp_shots != read_file.metadata["vibrometer"]["block_count"]:
+            raise IOError(f"The datafile {data_file} does not seem to be complete. Expected: {shots_per_tr*num_traces}. Present: {read_file.metadata['vibrometer']['block_count']}.")
+
+        # If this is the first time this file is written to, we need to write the data structure.
+        if first:
+            first = False  # Don't do this again
+
+            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/experiment"),read_file.metadata["experiment"])
+
+            # Devices
+            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/laser"),read_file.metadata["laser"])
+            write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/vibrometer"),read_file.metadata["vibrometer"])
+
+            # If there is galvo or rotator metadata, we write this as well
+            if "galvo" in read_file.metadata.keys():
+                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/galvo"),read_file.metadata["galvo"])
+
+            if "rotator" in read_file.metadata.keys():
+                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/devices/rotator"),read_file.metadata["rotator"])
+
+            # If there is information about the sample, add it here as well.
+            if "sample" in read_file.metadata.keys():
+                write_simple_dict_to_hdf5_subgroup(_file.create_group("metadata/sample"),read_file.metadata["sample"])
+            else: # Otherwise we create an empty group.
+                _file.create_group("metadata/sample")
+
+            # Create the group for trace metadata, data
+            _file.create_group("data/sample")
+            _file.create_group("data/trace")
+            _file.create_group("metadata/trace")
+
+        # Ok, that concludes organizing the data file. Now onto data copying/output.
+
+        # Pre-experiment background traces
+        if preexp_shots>0:
+            start_num = 0
+            end_num   = preexp_shots
+
+            subgroup = _file.create_group(f"data/special_trace/pre_experiment_beamdump/{file_num}")
+            subgroup_metadata = _file.create_group(f"metadata/special_trace/pre_experiment_beamdump/{file_num}")
+
+            # We save all the raw data.
+            _write_si_blocks(subgroup,read_file,start_num,preexp_shots)
+
+            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
+            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
+            subgroup[f"Time"] = read_file.channel_t_array("Velocity")
+            subgroup[f"BaseTime"] = read_file.channel_t_array("RSSI")
+            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num)
+
+
+        # For each trace, we make a variable called subgroup.
+        for src_location in src_locations:
+            # Iterators in the file run between these 2 values.
+            start_num = file_it * shots_per_tr + preexp_shots
+            end_num   = (file_it+1) * shots_per_tr + preexp_shots
+
+            subgroup = _file.create_group(f"data/trace/{trace_it}")
+            subgroup_metadata = _file.create_group(f"metadata/trace/{trace_it}")
+
+            # We save all the raw data.
+            _write_si_blocks(subgroup,read_file,start_num,shots_per_tr)
+
+            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
+            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
+            # Average velocity now also has background substracted.
+            subgroup[f"Time"] = read_file.channel_t_array("Velocity")
+            subgroup[f"BaseTime"] = read_file.channel_t_array("RSSI")
+            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num) - read_file.background_traces
+
+            # That was all the data. Now the metadata.
+            # For now, this just stores source and receiver locations.
+            subgroup_metadata[f"rcv_location"] = rcv_location
+            subgroup_metadata[f"src_location"] = src_location
+
+            # Increment the trace iterator and the file iterator
+            trace_it += 1
+            file_it  += 1
+
+
+
+    
+        # Post-experiment background traces
+        if postexp_shots>0:
+            start_num = file_it * shots_per_tr + preexp_shots
+            end_num = file_it * shots_per_tr + preexp_shots + postexp_shots
+
+            subgroup = _file.create_group(f"data/special_trace/post_experiment_beamdump/{file_num}")
+            subgroup_metadata = _file.create_group(f"metadata/special_trace/post_experiment_beamdump/{file_num}")
+
+            # We save all the raw data.
+            _write_si_blocks(subgroup,read_file,start_num,postexp_shots)
+
+            # We generate both time arrays and an average velocity array. Note that this is not very efficient but it makes
+            # sharing data a lot easier, and does not take that much space compared to the raw data storage.
+            subgroup[f"Time"] = read_file.channel_t_array("Velocity")
+            subgroup[f"BaseTime"] = read_file.channel_t_array("RSSI")
+            subgroup[f"avgVelocity"] = read_file.average_velocity(start_num,end_num)
+
+        read_file.close()
+        del read_file
+
+        file_num += 1
+
+    # At the end of the import, we should write the total number of traces to the experiment metadata.
+    _file["metadata/experiment/total_traces"] = trace_it
+
+    _file.close()
+    del _file
+
+
+
+
+
+
+    
+
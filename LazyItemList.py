@@ -0,0 +1,21 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Constructing an ItemList talks to the device. The config classes have one per setting, nine in all, which used to be built in
+# the constructor whether the setting was ever touched or not. With the settings and capabilities cached (see SettingsCache
+# and CapabilityCache), most of them are never needed, so they are only built on first use.
+
+from .Backend import ItemList
+
+
+class LazyItemList:
+    """Stands in for ItemList(communication, device_type, command), which is constructed on the first method call."""
+
+    def __init__(self,communication,device_type,command):
+        self._args      = (communication,device_type,command)
+        self._item_list = None
+
+    def __getattr__(self,name):
+        # Only called for what is not found on the instance, i.e. the ItemList methods.
+        if self._item_list is None:
+            self._item_list = ItemList(*self._args)
+        return getattr(self._item_list,name)
@@ -0,0 +1,55 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Backs the run buffers of a Vibrometer with np.memmap files instead of RAM, so a run is no longer capped by physical memory.
+# The OS pages completed blocks out to the file and only keeps what is being written (and what was recently read) resident.
+# Put the directory on a fast local disk, the acquisition writes into these pages.
+
+import os
+
+from itertools import count
+
+import numpy as np
+
+
+class MemmapAllocator:
+    """Vibrometer.buffer_allocator creating one np.memmap file per channel array in directory.
+
+    With delete=True the files are unlinked right after they are mapped: the mapping stays valid, and the disk space is
+    returned as soon as the arrays are dropped. Where the OS does not allow that (Windows), they are removed by cleanup()."""
+
+    def __init__(self,directory,delete=True):
+        if not os.path.isdir(directory):
+            raise IOError(f"Directory {directory} does not exist.")
+
+        self._directory = directory
+        self._delete    = delete
+        self._run       = count()
+        self._leftover  = []
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def __call__(self,ch_name,kind,shape,dtype):
+        filename = os.path.join(self._directory,f"vibrometer_{os.getpid()}_{next(self._run)}_{ch_name}_{kind}.dat")
+
+        # mode w+ creates a sparse, zeroed file, the pages only get backed by the disk once they are written.
+        array = np.memmap(filename,dtype=dtype,mode="w+",shape=shape)
+
+        if self._delete:
+            try:
+                os.remove(filename)
+            except OSError:
+                self._leftover.append(filename)
+
+        return array
+
+    def cleanup(self):
+        """Remove the files that could not be removed when they were created. Files still mapped are retried next time."""
+        leftover = []
+        for filename in self._leftover:
+            try:
+                os.remove(filename)
+            except OSError:
+                leftover.append(filename)
+        self._leftover = leftover
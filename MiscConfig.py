@@ -2,8 +2,8 @@
 
 from time import sleep
 
-from polytec.io.device_type import DeviceType
-from polytec.io.device_command import DeviceCommand
+from .Backend import DeviceType, DeviceCommand
+from .SettingsCache import SettingsCache
 
 # Some implementation notes:
 # AF:           device_communication.set_int16(DeviceType.SensorHead, DeviceCommand.Autofocus,1)
@@ -30,7 +30,10 @@ class MiscConfig:
         if init_connection:
             self.__communication = device_communication
 
-        # This is empty, all settings are int16s which are accessed directly.
+        # No ItemLists, all settings are int16s which are accessed directly. qtec and focus_position are read through the
+        # settings cache (shared with the other config classes), af_status and signal_level are live and always read.
+        if not hasattr(self,"_settings_cache"):
+            self._settings_cache = SettingsCache()
 
     def to_dict(self):
         """Dictionary representation of this class."""
@@ -47,11 +50,13 @@ class MiscConfig:
     def autofocus(self,block=False):
         """Forces the Sensor head to autofocus"""
         self.__communication.set_int16(DeviceType.SensorHead, DeviceCommand.Autofocus,1)
+        self._settings_cache.invalidate(DeviceType.SensorHead) # Moves the focus position
         
         # If this function is chosen to block until AF is done, we query af_status until it returns 1 (done).
         if block:
             while self.af_status != 1:
                 sleep(0.1)
+            self._settings_cache.invalidate(DeviceType.SensorHead)
 
     @property
     def af_status(self):
@@ -68,7 +73,8 @@ class MiscConfig:
     @property
     def qtec(self):
         """QTec status, 1 [on] or 0 [off]."""
-        return self.__communication.get_int32(DeviceType.QTecModule, DeviceCommand.QTecOn)
+        return self._settings_cache.get(DeviceType.QTecModule,"qtec",
+                lambda: self.__communication.get_int32(DeviceType.QTecModule, DeviceCommand.QTecOn))
 
     @qtec.setter
     def qtec(self,val):
@@ -79,13 +85,15 @@ class MiscConfig:
             raise ValueError("Value has to be 0 or 1.")
 
         self.__communication.set_int32(DeviceType.QTecModule, DeviceCommand.QTecOn,val)
+        self._settings_cache.invalidate()
 
     
     # Focus Position
     @property
     def focus_position(self):
         """Focus position, between 0 and 1835."""
-        return self.__communication.get_int16(DeviceType.SensorHead, DeviceCommand.FocusPosition)
+        return self._settings_cache.get(DeviceType.SensorHead,"focus_position",
+                lambda: self.__communication.get_int16(DeviceType.SensorHead, DeviceCommand.FocusPosition))
 
     @focus_position.setter
     def focus_position(self,val):
@@ -96,5 +104,6 @@ class MiscConfig:
             raise ValueError("Value has to be between 0 and 1835.")
 
         self.__communication.set_int16(DeviceType.SensorHead, DeviceCommand.FocusPosition,val)
+        self._settings_cache.invalidate()
 
 
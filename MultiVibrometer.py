@@ -0,0 +1,211 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Coordinates several vibrometer heads in the same setup. Each Vibrometer keeps its own acquisition thread; this class fans
+# configuration and arming out over a thread pool (one worker per device, so N devices cost one round-trip time instead of N),
+# lines the blocks of all devices up by trigger index and writes everything to a single file with one group per device.
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full, Empty
+from statistics import median
+from threading import Lock
+
+import numpy as np
+
+from .Vibrometer import Vibrometer
+from .DataManagement import HDF5Writer
+from .BlockDispatcher import BlockDispatcher
+
+
+class _TaggedBlockQueue:
+    """Subscriber for a single device which tags its blocks with the device name and feeds them into a queue shared by all
+    devices. At most maxsize blocks of one device wait for the consumer, the end-of-run marker is always let in."""
+
+    def __init__(self,name,shared_queue,maxsize):
+        self._name    = name
+        self._shared  = shared_queue
+        self._maxsize = maxsize
+        self._pending = 0
+        self._lock    = Lock()
+
+    def put_nowait(self,item):
+        with self._lock:
+            if item is not BlockDispatcher.END_OF_RUN and self._pending >= self._maxsize:
+                raise Full
+            self._pending += 1
+
+        self._shared.put_nowait((self,item))
+
+    def get_nowait(self):
+        raise Empty
+
+    def consumed(self):
+        with self._lock:
+            self._pending -= 1
+
+    @property
+    def name(self):
+        return self._name
+
+
+class MultiVibrometer:
+    """Synchronized acquisition with several Vibrometer instances."""
+
+    def __init__(self,vibrometers):
+        """Constructor, takes a dict of name: Vibrometer, or a list of Vibrometers (named vib0, vib1, ...)."""
+        if not isinstance(vibrometers,dict):
+            vibrometers = {f"vib{num}": vib for num,vib in enumerate(vibrometers)}
+
+        if len(vibrometers) == 0:
+            raise ValueError("MultiVibrometer needs at least one Vibrometer.")
+
+        self.__vibrometers  = vibrometers
+        self.__executor     = ThreadPoolExecutor(max_workers=len(vibrometers))
+
+        # Spread between the first and last device noticing the trigger, per aligned block.
+        self.__trigger_skew = dict()
+
+    @staticmethod
+    def from_ips(ips):
+        """Constructor from a dict of name: IP address or a list of IP addresses. Connections are set up in parallel."""
+        if not isinstance(ips,dict):
+            ips = {f"vib{num}": ip for num,ip in enumerate(ips)}
+
+        with ThreadPoolExecutor(max_workers=max(len(ips),1)) as executor:
+            futures = {name: executor.submit(Vibrometer.from_ip,ip) for name,ip in ips.items()}
+            return MultiVibrometer({name: future.result() for name,future in futures.items()})
+
+    @property
+    def vibrometers(self):
+        return self.__vibrometers
+
+    def _map(self,func):
+        """Call func(vibrometer) for every device in parallel. Returns a dict name: result, raises the first exception."""
+        futures = {name: self.__executor.submit(func,vib) for name,vib in self.__vibrometers.items()}
+        return {name: future.result() for name,future in futures.items()}
+
+    ### Configuration
+    def settings_from_dict(self,settings_dict):
+        """Apply the same settings to every device, in parallel. Returns name: report, see Vibrometer.settings_from_dict."""
+        return self._map(lambda vib: vib.settings_from_dict(settings_dict))
+
+    def to_dict(self):
+        """Dictionary of name: Vibrometer.to_dict(), read in parallel."""
+        return self._map(lambda vib: vib.to_dict())
+
+    ### Acquisition
+    def start_acq(self,timeout=None):
+        """Arm all devices in parallel and return once every one of them is ready for data. When that takes longer than timeout
+        (s), or arming a device fails, the acquisition is stopped on all devices and the error (TimeoutError) raised."""
+        self.__trigger_skew = dict()
+
+        # All devices are armed at the same time, so the timeout of each is the timeout of them all.
+        try:
+            self._map(lambda vib: vib.start_acq(block=True,timeout=timeout))
+        except Exception:
+            self.stop_acq()
+            raise
+
+    def stop_acq(self):
+        """Stop the acquisition on all devices."""
+        return {name: vib.stop_acq() for name,vib in self.__vibrometers.items()}
+
+    def iter_aligned_blocks(self,timeout=None,maxsize=16):
+        """Iterate over the blocks of the current (or next) run, aligned by trigger index. Yields (block_id, {name: Block}) as
+        soon as all devices delivered that block, ends when all runs are over. Blocks a device dropped (see
+        Vibrometer.dropped_blocks) never complete and are skipped. Raises queue.Empty if timeout (s) passes without news."""
+        shared = Queue()
+        queues = [_TaggedBlockQueue(name,shared,maxsize) for name in self.__vibrometers]
+
+        # Subscribe right away, not on the first next(), or we might miss the first blocks.
+        for queue in queues:
+            self.__vibrometers[queue.name].subscribe_blocks(queue=queue)
+
+        def block_generator():
+            pending  = dict()
+            finished = 0
+            try:
+                while finished < len(queues):
+                    queue, block = shared.get(timeout=timeout)
+                    queue.consumed()
+
+                    if block is BlockDispatcher.END_OF_RUN:
+                        finished += 1
+                        continue
+
+                    aligned = pending.setdefault(block.block_id,dict())
+                    aligned[queue.name] = block
+
+                    if len(aligned) == len(queues):
+                        del pending[block.block_id]
+                        trigger_times = [blk.trigger_time for blk in aligned.values()]
+                        self.__trigger_skew[block.block_id] = max(trigger_times) - min(trigger_times)
+                        yield block.block_id, aligned
+            finally:
+                for queue in queues:
+                    self.__vibrometers[queue.name].unsubscribe_blocks(queue)
+
+        return block_generator()
+
+    @property
+    def trigger_skew(self):
+        """Dict of block_id: spread (s) between the first and last device noticing the trigger, for the aligned blocks of
+        the current run."""
+        return dict(self.__trigger_skew)
+
+    def trigger_skew_summary(self):
+        """Median and maximum trigger skew (s) of the current run."""
+        skews = list(self.__trigger_skew.values())
+        if len(skews) == 0:
+            return {"blocks": 0, "median": None, "max": None}
+        return {"blocks": len(skews), "median": median(skews), "max": max(skews)}
+
+    ### Data storage
+    def write_data(self,filename,_dict=dict(),overwrite=False):
+        """Write the data of all devices to a single file, one group per device. _dict is stored in the root, like the
+        metadata of Vibrometer.write_data, the vibrometer settings in the group of each device."""
+        if (not overwrite) and os.path.exists(filename):
+            raise IOError(f"File {filename} exists. Turn on overwrite or choose another file.")
+
+        # The round-trips happen in parallel, the writing itself is sequential since it all goes to one file.
+        settings = self.to_dict()
+
+        # Every device is checked before any data is taken, taken data of the others would be lost otherwise.
+        missing = [name for name,vib in self.__vibrometers.items()
+                   if not (vib.statistics is not None if settings[name]["accumulate"] else vib.has_data)]
+        if len(missing) > 0:
+            raise Exception(f"No data available for writing from {', '.join(missing)}.")
+
+        data = {name: vib.statistics if settings[name]["accumulate"] else vib.take_data()
+                for name,vib in self.__vibrometers.items()}
+
+        writer = HDF5Writer()
+        writer.open_file(filename,overwrite=overwrite)
+        try:
+            for name,vib in self.__vibrometers.items():
+                if settings[name]["accumulate"]:
+                    writer.write_statistics(data[name],group=name)
+                    block_count = data[name]["DataValidity"]["Statistics"].count if "DataValidity" in data[name] else 0
+                else:
+                    writer.write_channel_data(data[name],group=name,compression=vib.compression)
+                    block_count = data[name]["DataValidity"]["Samples"].shape[0] if "DataValidity" in data[name] else 0
+
+                if "DataValidity" in data[name]:
+                    writer.write_lost_samples(vib.lost_samples,block_count,group=name)
+                writer.write_metadata({"vibrometer": settings[name]},group=name)
+
+                if not settings[name]["accumulate"]:
+                    vib.release_data(data[name])
+
+            writer.write_metadata(_dict)
+
+            if len(self.__trigger_skew) > 0:
+                block_ids = sorted(self.__trigger_skew)
+                writer.write_dataset("trigger_skew/block_id",np.array(block_ids))
+                writer.write_dataset("trigger_skew/skew",np.array([self.__trigger_skew[num] for num in block_ids]))
+        finally:
+            writer.close_file()
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
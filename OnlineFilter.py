@@ -0,0 +1,136 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Low-pass filtering and decimation while the data comes in (see Vibrometer.set_filter), instead of after reading every
+# trace back from the HDF5 file. Only the reduced-rate data ends up in the buffer and in the file, which cuts memory, disk
+# space and write bandwidth by the decimation factor.
+#
+# The device hands out a block in chunks, so the filter keeps its state (the last samples for a FIR filter, the delay line
+# for an IIR filter) from one chunk to the next, and by default also from one block to the next. Output sample k of a block
+# is the filtered input at sample k*decimation; a trailing partial window of a block is dropped.
+#
+# FIR filters only need numpy. IIR filters (second-order sections) need scipy.signal, which is only imported when used.
+
+import json
+
+import numpy as np
+
+
+class OnlineFilter:
+    """Streaming FIR (taps) or IIR (sos, second-order sections as in scipy.signal) filter followed by decimation."""
+
+    def __init__(self,decimation=1,taps=None,sos=None,reset_per_block=False):
+        if not isinstance(decimation,int) or decimation < 1:
+            raise ValueError("decimation must be a positive int.")
+        if taps is not None and sos is not None:
+            raise ValueError("Give either FIR taps or IIR sos, not both.")
+
+        self._decimation      = decimation
+        self._taps            = np.asarray(taps,dtype=np.float64) if taps is not None else None
+        self._sos             = np.asarray(sos,dtype=np.float64) if sos is not None else None
+        self._reset_per_block = reset_per_block
+
+        if self._sos is not None:
+            if self._sos.ndim != 2 or self._sos.shape[1] != 6:
+                raise ValueError("sos must be an (n, 6) array of second-order sections.")
+            from scipy.signal import sosfilt
+            self._sosfilt = sosfilt
+
+        self.reset()
+
+    @staticmethod
+    def lowpass(decimation,numtaps=None,cutoff=0.8):
+        """Decimating FIR low-pass: windowed sinc (Hamming) with its cutoff at cutoff times the new Nyquist frequency."""
+        if numtaps is None:
+            numtaps = 16*decimation+1
+
+        n    = np.arange(numtaps) - (numtaps-1)/2
+        fc   = cutoff/decimation/2 # cycles per input sample
+        taps = 2*fc*np.sinc(2*fc*n) * np.hamming(numtaps)
+        return OnlineFilter(decimation,taps=taps/np.sum(taps))
+
+    @property
+    def decimation(self):
+        return self._decimation
+
+    @property
+    def reset_per_block(self):
+        return self._reset_per_block
+
+    def reset(self):
+        """Forget the filter state, done at the start of every run."""
+        if self._taps is not None:
+            self._history = np.zeros(len(self._taps)-1,dtype=np.float64)
+        if self._sos is not None:
+            self._zi = np.zeros((self._sos.shape[0],2),dtype=np.float64)
+
+    def output_count(self,num_samples):
+        """Number of output samples of a block of num_samples input samples."""
+        return num_samples // self._decimation
+
+    def start_block(self):
+        if self._reset_per_block:
+            self.reset()
+
+    def process(self,samples,start,out):
+        """Filter a chunk of input samples which starts at input sample start of the block, and write the output samples
+        that fall in it into out, the output row of the block."""
+        samples = np.asarray(samples,dtype=np.float64)
+        first, offset = self.__first_output(start)
+        count = max(min(len(out)-first,-(-(len(samples)-offset)//self._decimation)),0)
+
+        if self._taps is not None:
+            extended = np.concatenate((self._history,samples))
+            if count > 0:
+                # Only the outputs we keep get computed, one dot product per output sample.
+                windows = np.lib.stride_tricks.sliding_window_view(extended,len(self._taps))
+                out[first:first+count] = windows[offset::self._decimation][:count] @ self._taps[::-1]
+            self._history = extended[len(extended)-len(self._history):]
+
+        elif self._sos is not None:
+            filtered, self._zi = self._sosfilt(self._sos,samples,zi=self._zi)
+            out[first:first+count] = filtered[offset::self._decimation][:count]
+
+        else:
+            out[first:first+count] = samples[offset::self._decimation][:count]
+
+    def process_flags(self,flags,start,out):
+        """Decimate a chunk of flags (overrange) like process: an output sample is flagged when any input sample of its
+        decimation window is. Windows that straddle two chunks are combined with what is already in out."""
+        flags = np.asarray(flags,dtype=bool)
+        if len(flags) == 0:
+            return
+
+        # Split the chunk at the window boundaries and OR every piece.
+        first_window = start // self._decimation
+        boundaries   = np.arange((-start) % self._decimation,len(flags),self._decimation)
+        if len(boundaries) == 0 or boundaries[0] != 0:
+            boundaries = np.concatenate(([0],boundaries))
+        windows = np.logical_or.reduceat(flags,boundaries)
+
+        count = max(min(len(out)-first_window,len(windows)),0)
+        if count == 0:
+            return
+
+        if start % self._decimation != 0:
+            windows[0] |= out[first_window]
+        out[first_window:first_window+count] = windows[:count]
+
+    def __first_output(self,start):
+        """Index of the first output sample at or after input sample start, and its offset into the chunk."""
+        first = -(-start // self._decimation)
+        return first, first*self._decimation - start
+
+    def describe(self):
+        """Description of the filter for the metadata of a file."""
+        if self._taps is not None:
+            kind, coefficients = "fir", self._taps.tolist()
+        elif self._sos is not None:
+            kind, coefficients = "iir_sos", self._sos.tolist()
+        else:
+            kind, coefficients = "none", []
+
+        return {"kind": kind, "decimation": self._decimation, "coefficients": coefficients,
+                "reset_per_block": self._reset_per_block}
+
+    def to_json(self):
+        return json.dumps(self.describe())
@@ -0,0 +1,512 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Runs a Vibrometer, and with it the acquisition loop, in a dedicated child process. Whatever the parent does with the GIL
+# (numpy reductions, h5py writes, plotting) can then no longer delay the read_data calls and overrun the device buffer.
+#
+# The run buffers of the child are allocated in multiprocessing.shared_memory segments (see SharedMemoryAllocator), one per
+# channel array. The child announces them when it is ready for data, and the parent maps them, so the data never gets copied
+# or pickled. Finished blocks and the end of a run are announced over an event queue. Everything else (settings, methods)
+# is forwarded to the child over a pipe, so the parent has the same API as a Vibrometer.
+
+import pickle
+import multiprocessing as mp
+
+from multiprocessing import shared_memory
+from queue import Empty
+from threading import Thread, Event, Lock
+
+import numpy as np
+
+from .Vibrometer import Vibrometer
+from .DataManagement import HDF5Writer, HDF5BackgroundWriter
+from .BlockDispatcher import Block, BlockDispatcher
+
+
+class SharedMemoryAllocator:
+    """Vibrometer.buffer_allocator which puts every run buffer array in its own shared memory segment. The segments are
+    tagged with the run they were allocated for, see next_run."""
+
+    def __init__(self):
+        self._run       = 0
+        self._segments  = {self._run: dict()}
+        self._lingering = []
+
+    def __call__(self,ch_name,kind,shape,dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm    = shared_memory.SharedMemory(create=True,size=max(nbytes,1))
+
+        array = _shared_array(shm,shape,dtype)
+        array[...] = 0
+
+        self._segments[self._run][id(array)] = shm
+        return array
+
+    def describe(self,array):
+        """(segment name, shape, dtype) of an array of the current run, enough for another process to map it."""
+        return self._segments[self._run][id(array)].name, array.shape, array.dtype.str
+
+    def next_run(self):
+        """Arrays allocated from here on belong to the next run. Returns the id of the run that ended."""
+        run = self._run
+        self._run += 1
+        self._segments[self._run] = dict()
+        return run
+
+    def release(self,run,unlink=False):
+        """Let go of the segments of run, and remove their names too with unlink. Segments that still have arrays pointing
+        into them are retried later."""
+        segments = list(self._segments.pop(run,dict()).values())
+        if unlink:
+            for shm in segments:
+                shm.unlink()
+        self._lingering = _close_segments(self._lingering + segments)
+
+
+def _shared_array(shm,shape,dtype):
+    """Array on a shared memory segment. Through frombuffer, so that closing the segment fails (and is retried later) as long
+    as an array or view points into it, instead of unmapping the memory under it."""
+    return np.frombuffer(shm.buf,dtype=dtype,count=int(np.prod(shape))).reshape(shape)
+
+def _close_segments(segments):
+    """Close the segments that can be closed, returns the ones that are still in use."""
+    in_use = []
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            in_use.append(shm)
+    return in_use
+
+def _picklable(exception):
+    """Exceptions travel back to the parent, but not all of them pickle."""
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return RuntimeError(f"{type(exception).__name__}: {exception}")
+
+
+class _EventForwarder:
+    """Block subscriber in the child. Announces the buffers of a run to the parent once it is ready for data, then its
+    finished blocks and its end. Never blocks."""
+
+    def __init__(self,vib,allocator,events):
+        self._vib       = vib
+        self._allocator = allocator
+        self._events    = events
+        self._lock      = Lock()
+        self._armed     = False
+        self._announced = False
+
+    def arm(self):
+        """Announce the buffers of the run that was just started, once it is ready for data."""
+        with self._lock:
+            if self._armed:
+                return
+            self._armed = True
+
+        self._vib.add_ready_callback(self.__announce)
+
+    def __announce(self):
+        with self._lock:
+            self._armed = False
+            if self._announced:
+                return
+            self._announced = True
+
+        layout = dict()
+        for ch_name,channel in self._vib.buffer.items():
+            info = {key: value for key,value in channel.items() if key not in ("Samples","Overrange")}
+            info["Samples"]   = self._allocator.describe(channel["Samples"])
+            info["Overrange"] = self._allocator.describe(channel["Overrange"]) if channel["Overrange"] is not None else None
+            layout[ch_name] = info
+        self._events.put(("ready",layout,self._vib.block_count))
+
+    def put_nowait(self,item):
+        if item is BlockDispatcher.END_OF_RUN:
+            self.__end_run()
+        else:
+            self._events.put(("block",item.block_id,item.trigger_time,item.lost_ranges))
+
+    def get_nowait(self):
+        raise Empty
+
+    def __end_run(self):
+        # On the acquisition thread, so the next run cannot have allocated anything yet. The child lets go of the segments
+        # of this run before the parent hears of its end. It only has data for a completed, non-streamed run.
+        run = self._allocator.next_run()
+        try:
+            self._vib.take_data()
+            has_data = True
+        except Exception:
+            has_data = False
+
+        # The parent removes the names of the segments it mapped, those of a run that never got announced are removed here.
+        with self._lock:
+            announced, self._announced = self._announced, False
+        self._allocator.release(run,unlink=not announced)
+
+        self._events.put(("run_end",has_data))
+
+
+def _worker(ip,conn,events):
+    """Main function of the child process: owns the Vibrometer and serves the requests of the parent."""
+    try:
+        vib = Vibrometer.from_ip(ip)
+    except Exception as e:
+        conn.send(("error",_picklable(e)))
+        return
+
+    allocator = SharedMemoryAllocator()
+    vib.buffer_allocator = allocator
+    forwarder = _EventForwarder(vib,allocator,events)
+    vib.subscribe_blocks(queue=forwarder)
+    conn.send(("ok",None))
+
+    while True:
+        op, name, args, kwargs = conn.recv()
+        try:
+            if op == "get":
+                result = getattr(vib,name)
+            elif op == "set":
+                setattr(vib,name,args[0])
+                result = None
+            elif op == "call":
+                result = getattr(vib,name)(*args,**kwargs)
+            elif op == "start_acq":
+                vib.start_acq()
+                forwarder.arm()
+                result = None
+            elif op == "sync":
+                # Everything sent before, the end of a stopped run among others, reaches the parent before this.
+                events.put(("synced",))
+                result = None
+            elif op == "close":
+                break
+
+            conn.send(("ok",result))
+        except Exception as e:
+            conn.send(("error",_picklable(e)))
+
+    # The acquisition thread holds a reference to vib, so it has to be closed by hand to stop it.
+    vib.stop_acq()
+    vib.close()
+    conn.send(("ok",None))
+
+
+class ProcessVibrometer(HDF5Writer):
+    """A Vibrometer running in a child process, with the same API. Acquired data is shared with the parent without copies."""
+
+    def __init__(self,ip):
+        """Constructor, takes the IP address (string) of the vibrometer. The connection is made in the child process."""
+        HDF5Writer.__init__(self)
+
+        # Spawn instead of fork: the parent is usually multi-threaded (GUI, analysis), which does not mix with fork.
+        ctx = mp.get_context("spawn")
+        self.__conn, child_conn = ctx.Pipe()
+        self.__events  = ctx.Queue()
+        self.__process = ctx.Process(target = _worker, args = (ip,child_conn,self.__events), daemon = True)
+        self.__process.start()
+        self.__rpc_lock = Lock()
+
+        # Raises if the child could not connect.
+        self.__receive()
+
+        self.__ready_for_data  = Event()
+        self.__ready_callbacks = []
+        self.__ready_lock      = Lock()
+        self.__dispatcher      = BlockDispatcher()
+        self.__synced          = Event()
+        self.__sync_lock       = Lock()
+
+        # Mapped arrays of the run in progress, and of the last finished run.
+        self.__run       = None
+        self.__data      = None
+        self.__segments  = []
+        self.__lingering = []
+
+        # Writer thread of write_data_async(), in the parent like write_data. Started on first use.
+        self.__background_writer = None
+        self.__write_queue_size  = 2
+
+        self.__listener = Thread(target = self.__listen, daemon = True)
+        self.__listener.start()
+
+    @staticmethod
+    def from_ip(ip):
+        """Constructor which creates the class from a provided IP address (string). No checks on validity of the IP."""
+        return ProcessVibrometer(ip)
+
+    ### Forwarding to the Vibrometer in the child
+    def __receive(self):
+        status, result = self.__conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def __call(self,op,name=None,*args,**kwargs):
+        with self.__rpc_lock:
+            self.__conn.send((op,name,args,kwargs))
+            return self.__receive()
+
+    def __getattr__(self,name):
+        # Only called for attributes not found on this class: Vibrometer properties and methods are forwarded.
+        if not name.startswith("_"):
+            attr = getattr(Vibrometer,name,None)
+            if isinstance(attr,property):
+                return self.__call("get",name)
+            if callable(attr):
+                return lambda *args, **kwargs: self.__call("call",name,*args,**kwargs)
+
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def __setattr__(self,name,value):
+        if name.startswith("_") or hasattr(type(self),name) or not isinstance(getattr(Vibrometer,name,None),property):
+            object.__setattr__(self,name,value)
+        else:
+            self.__call("set",name,value)
+
+    def close(self):
+        """Stop the child process. Runs handed to write_data_async() are still written."""
+        if self.__background_writer is not None:
+            self.__background_writer.close()
+
+        self.__call("close")
+        self.__events.put(("closed",))
+        self.__process.join()
+
+    ### Acquisition
+    @property
+    def ready_for_data(self):
+        return self.__ready_for_data.is_set()
+
+    def start_acq(self,block=False,timeout=None):
+        """Start the acquisition. Call after all settings are set. When block is true, will pause until ready for data, at most
+        timeout (s), then raises TimeoutError. See Vibrometer.start_acq."""
+        self.__call("start_acq")
+
+        if block and not self.__ready_for_data.wait(timeout):
+            raise TimeoutError(f"Not ready for data within {timeout} s.")
+
+    def stop_acq(self):
+        """See Vibrometer.stop_acq. Returns once the end of the run has reached the parent too."""
+        stopped = self.__call("call","stop_acq")
+        self.__sync()
+        return stopped
+
+    def __sync(self):
+        """Wait until the listener has handled everything the child announced so far."""
+        with self.__sync_lock:
+            self.__synced.clear()
+            self.__call("sync")
+            self.__synced.wait()
+
+    def add_ready_callback(self,callback):
+        """See Vibrometer.add_ready_callback. Called from the listener thread of the parent."""
+        with self.__ready_lock:
+            if not self.__ready_for_data.is_set():
+                self.__ready_callbacks.append(callback)
+                return
+
+        callback()
+
+    def register_block_callback(self,callback):
+        """See Vibrometer.register_block_callback. Blocks are views on the shared memory, not copies. Streaming and accumulate
+        runs hand out no blocks, see iter_blocks."""
+        self.__dispatcher.register_callback(callback)
+
+    def unregister_block_callback(self,callback):
+        self.__dispatcher.unregister_callback(callback)
+
+    def iter_blocks(self,timeout=None,maxsize=None):
+        """See Vibrometer.iter_blocks. Blocks are views on the shared memory, not copies. In streaming and accumulate runs the
+        child reuses a single row for every block, so no blocks are handed out then: the iterator only sees the end of the
+        run."""
+        queue = self.subscribe_blocks(maxsize)
+
+        def block_generator():
+            try:
+                while True:
+                    block = queue.get(timeout=timeout)
+                    if block is BlockDispatcher.END_OF_RUN:
+                        return
+                    yield block
+            finally:
+                self.unsubscribe_blocks(queue)
+
+        return block_generator()
+
+    def subscribe_blocks(self,maxsize=None,queue=None):
+        return self.__dispatcher.subscribe(maxsize,queue)
+
+    def unsubscribe_blocks(self,queue):
+        self.__dispatcher.unsubscribe(queue)
+
+    @property
+    def dropped_blocks(self):
+        return self.__dispatcher.dropped_blocks
+
+    def __listen(self):
+        while True:
+            message = self.__events.get()
+
+            if message[0] == "ready":
+                self.__map_run(message[1],message[2])
+
+                with self.__ready_lock:
+                    self.__ready_for_data.set()
+                    ready_callbacks, self.__ready_callbacks = self.__ready_callbacks, []
+
+                for callback in ready_callbacks:
+                    callback()
+
+            elif message[0] == "block":
+                self.__publish(message[1],message[2],message[3])
+
+            elif message[0] == "run_end":
+                self.__finish_run(message[1])
+
+            elif message[0] == "synced":
+                self.__synced.set()
+
+            elif message[0] == "closed":
+                return
+
+    def __map_run(self,layout,block_count):
+        """Map the shared memory segments of a new run."""
+        self.__lingering = _close_segments(self.__lingering)
+
+        channels = dict()
+        segments = []
+        for ch_name,info in layout.items():
+            channel = dict(info)
+            for kind in ["Samples","Overrange"]:
+                if info[kind] is not None:
+                    name, shape, dtype = info[kind]
+                    shm = shared_memory.SharedMemory(name=name)
+                    channel[kind] = _shared_array(shm,shape,dtype)
+
+                    # Both processes have it mapped now, the name is no longer needed. The memory goes away once both let go.
+                    shm.unlink()
+                    segments.append(shm)
+            channels[ch_name] = channel
+
+        rows = next(iter(channels.values()))["Samples"].shape[0] if len(channels) > 0 else 0
+        self.__run = {"channels": channels, "segments": segments, "deliver_blocks": rows == block_count}
+
+    def __publish(self,block_id,trigger_time,lost_ranges):
+        if self.__run is None or not self.__run["deliver_blocks"] or not self.__dispatcher.active:
+            return
+
+        channels = self.__run["channels"]
+        samples   = {ch_name: channel["Samples"][block_id] for ch_name,channel in channels.items()}
+        overrange = {ch_name: channel["Overrange"][block_id] if channel["Overrange"] is not None else None
+                     for ch_name,channel in channels.items()}
+        packed    = [ch_name for ch_name,channel in channels.items() if channel["OverrangePacked"]]
+
+        self.__dispatcher.publish(Block(block_id,samples,overrange,packed,trigger_time,lost_ranges))
+
+    def __finish_run(self,has_data):
+        run, self.__run = self.__run, None
+        self.__ready_for_data.clear()
+
+        # The child only has data for a completed, non-streamed run. Either way it already let go of its buffers.
+        if run is None:
+            pass
+        elif has_data:
+            self.__release_data()
+            self.__data     = run["channels"]
+            self.__segments = run["segments"]
+        else:
+            self.__lingering += run["segments"]
+
+        self.__dispatcher.end_run()
+
+    ### Data storage
+    def write_data(self,filename,_dict=dict(),overwrite=False):
+        """Write data to the disk, from the shared memory of the last run. See Vibrometer.write_data."""
+        # Accumulate runs leave no buffers behind, only the (small) statistics, which are fetched from the child.
+        statistics = self.statistics if self.__data == None else None
+        if self.__data == None and statistics == None:
+            raise Exception("No data available for writing.")
+
+        _dict["vibrometer"] = self.to_dict()
+
+        self.write_run(filename,_dict,self.__data,statistics,self.lost_samples,overwrite)
+
+        self.__release_data()
+
+    def write_data_async(self,filename,_dict=dict(),overwrite=False,timeout=None):
+        """See Vibrometer.write_data_async. The file is written by a writer thread of the parent, from the shared memory of the
+        last run, which is freed once written."""
+        statistics = self.statistics if self.__data == None else None
+        if self.__data == None and statistics == None:
+            raise Exception("No data available for writing.")
+
+        metadata = {key: dict(value) for key,value in _dict.items()}
+        metadata["vibrometer"] = self.to_dict()
+
+        if self.__background_writer is None:
+            self.__background_writer = HDF5BackgroundWriter(self.__write_queue_size)
+
+        # Like take_data: the segments are closed once the writer has dropped the arrays.
+        data = self.take_data() if statistics is None else None
+        return self.__background_writer.put(filename,metadata,data,statistics,self.lost_samples,overwrite,self.compression,
+                                            timeout=timeout)
+
+    def flush_writes(self):
+        """See Vibrometer.flush_writes."""
+        if self.__background_writer is not None:
+            self.__background_writer.flush()
+
+    @property
+    def pending_writes(self):
+        return self.__background_writer.pending if self.__background_writer is not None else 0
+
+    @property
+    def write_queue_size(self):
+        return self.__write_queue_size
+
+    @write_queue_size.setter
+    def write_queue_size(self,val):
+        if not isinstance(val,int) or val < 1:
+            raise ValueError("write_queue_size must be a positive int.")
+
+        if self.__background_writer is not None:
+            self.__background_writer.close()
+            self.__background_writer = None
+        self.__write_queue_size = val
+
+    def set_compression(self,compression,ch_name=None):
+        """See HDF5Writer.set_compression. Also set in the child, which writes the file when streaming (see stream_data)."""
+        HDF5Writer.set_compression(self,compression,ch_name)
+        self.__call("call","set_compression",compression,ch_name)
+
+    def clear_compression(self,ch_name=None):
+        HDF5Writer.clear_compression(self,ch_name)
+        self.__call("call","clear_compression",ch_name)
+
+    @property
+    def has_data(self):
+        """See Vibrometer.has_data."""
+        return self.__data is not None
+
+    def take_data(self):
+        """See Vibrometer.take_data. The shared memory is freed once the caller drops the arrays."""
+        if self.__data == None:
+            raise Exception("No data available for writing.")
+
+        data, self.__data = self.__data, None
+        self.__lingering += self.__segments
+        self.__segments = []
+        return data
+
+    def release_data(self,data):
+        """See Vibrometer.release_data. The shared memory of the data is freed once the caller drops the arrays, so there is
+        nothing to hand back to the child."""
+        pass
+
+    def __release_data(self):
+        self.__data = None
+        self.__lingering = _close_segments(self.__lingering + self.__segments)
+        self.__segments = []
@@ -0,0 +1,86 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Statistics of a channel over all blocks of a run, updated block by block during the acquisition (Vibrometer.accumulate).
+# For runs where only the averaged trace is of interest, the raw blocks then never have to be kept: memory goes from
+# block_count x samples down to a handful of arrays of one block, and the average is there as soon as the last block is.
+#
+# Mean and variance use Welford's update, which stays accurate over thousands of blocks where the naive sum of squares
+# would cancel out. All statistics are in raw device units, like the samples in the buffer, multiply by the scale factor.
+
+import numpy as np
+
+
+class RunningStatistics:
+    """Sample-wise statistics over the blocks of a channel: count, sum, mean, variance, overrange counts and optionally the
+    min/max envelope."""
+
+    def __init__(self,num_samples,envelope=False,overrange=False,dtype=np.int32):
+        self._count = 0
+        self._sum   = np.zeros(num_samples,dtype=np.float64)
+        self._mean  = np.zeros(num_samples,dtype=np.float64)
+        self._m2    = np.zeros(num_samples,dtype=np.float64)
+
+        # Number of blocks in which each sample was overrange, only for channels with overrange.
+        self._overrange_count = np.zeros(num_samples,dtype=np.int32) if overrange else None
+
+        # The envelope is int32, or float32 for filtered channels (see OnlineFilter).
+        dtype = dtype if np.issubdtype(dtype,np.floating) else np.int32
+        info  = np.finfo(dtype) if np.issubdtype(dtype,np.floating) else np.iinfo(dtype)
+        self._min = np.full(num_samples,info.max,dtype=dtype) if envelope else None
+        self._max = np.full(num_samples,info.min,dtype=dtype) if envelope else None
+
+        # Scratch rows for update().
+        self._delta   = np.empty(num_samples,dtype=np.float64)
+        self._scratch = np.empty(num_samples,dtype=np.float64)
+
+    def update(self,samples,overrange=None):
+        """Add a block. overrange are the (unpacked) overrange flags of the block, for channels with overrange."""
+        self._count += 1
+
+        # Welford, through the scratch rows so a block does not cost any allocations.
+        delta, scratch = self._delta, self._scratch
+        np.subtract(samples,self._mean,out=delta)
+        np.divide(delta,self._count,out=scratch)
+        self._mean += scratch
+        np.subtract(samples,self._mean,out=scratch)
+        np.multiply(delta,scratch,out=scratch)
+        self._m2   += scratch
+        self._sum  += samples
+
+        if self._overrange_count is not None and overrange is not None:
+            self._overrange_count += overrange
+
+        if self._min is not None:
+            np.minimum(self._min,samples,out=self._min)
+            np.maximum(self._max,samples,out=self._max)
+
+    @property
+    def count(self):
+        """Number of blocks accumulated."""
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def mean(self):
+        return self._mean
+
+    def variance(self,ddof=1):
+        """Sample-wise variance over the blocks, ddof=1 for the unbiased estimate. NaN while there are too few blocks."""
+        if self._count <= ddof:
+            return np.full_like(self._m2,np.nan)
+        return self._m2/(self._count-ddof)
+
+    @property
+    def overrange_count(self):
+        return self._overrange_count
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
@@ -0,0 +1,54 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Every property of DaqConfig, VelEncConfig and MiscConfig used to be a round-trip to the device. The acquisition loop reads
+# block_size, trigger_mode and the sample rates on every block, and to_dict() does some twenty reads on every write_data. The
+# settings only change through our own setters (or someone at the front panel), so they are read once and served from here.
+#
+# Values are cached per device type. A setter drops all cached values, since changing one setting can change others, also of
+# another device type (the velocity range follows the maximum velocity range, the decoder bandwidth can change the sample
+# rate of the signal processing, etc.). Vibrometer fills the cache when a run is armed, so the run and the metadata written
+# with it see the same settings. Changes made behind our back (front panel,
+# another program) are only picked up after refresh(). Live readings like the signal level are never cached.
+
+class SettingsCache:
+    """Cache of device settings, shared by the config classes of a device. Counts hits and misses."""
+
+    def __init__(self):
+        # With the cache disabled every read goes to the device, like before.
+        self.enabled = True
+        self._values = dict()
+        self.reset_counters()
+
+    def get(self,device_type,name,fetch):
+        """The cached value of setting name of device_type, or fetch() it from the device."""
+        if not self.enabled:
+            return fetch()
+
+        key = (device_type,name)
+        if key in self._values:
+            self.hits += 1
+            return self._values[key]
+
+        self.misses += 1
+        value = self._values[key] = fetch()
+        return value
+
+    def invalidate(self,device_type=None):
+        """Forget the cached values of device_type, or all of them."""
+        if device_type is None:
+            self._values = dict()
+        else:
+            self._values = {key: value for key,value in self._values.items() if key[0] != device_type}
+
+    def refresh(self):
+        """Forget everything, the next reads go to the device."""
+        self.invalidate()
+
+    def reset_counters(self):
+        self.hits   = 0
+        self.misses = 0
+
+    def stats(self):
+        reads = self.hits+self.misses
+        return {"enabled": self.enabled, "entries": len(self._values), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits/reads if reads else None}
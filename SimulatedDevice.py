@@ -0,0 +1,442 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# A pure-Python stand-in for the parts of the polytec library this package uses (DeviceCommunication, DataAcquisition,
+# ItemList, ChannelActivation and the enums), so Vibrometer, the config classes and acquire_to_csv can be run, tested and
+# profiled without hardware and without the library. Select it with POLYTEC_BACKEND=simulated, see Backend.
+#
+# The behaviour of the device is set up through a SimulatedDevice, handed to DeviceCommunication:
+# - sample rates, active channels and the initial settings;
+# - trigger timing: the first trigger trigger_delay after the acquisition starts, then one every trigger_interval (plus a
+#   random trigger_jitter). A block starts at the first trigger after the previous block is complete;
+# - realtime: samples come in at the base sample rate after the trigger, like on the device. Otherwise a block is complete
+#   the moment it is triggered, which measures the overhead of the software alone;
+# - injected latency per device command (command_latency) and per read_data call (read_latency);
+# - packet loss: every read_data chunk loses a packet of packet_size samples with probability packet_loss, which shows up
+#   in the DataValidity channel.
+#
+# The device side runs on the clock, independent of how fast the data is read. When the software falls more than the buffer
+# capacity behind, read_data raises, like the real DataAcquisition does on a buffer overrun.
+
+from enum import Enum
+from random import Random
+from time import perf_counter, sleep
+
+import numpy as np
+
+
+class ChannelType(Enum):
+    Unknown      = 0
+    Velocity     = 1
+    Displacement = 2
+    Acceleration = 3
+    RSSI         = 4
+    Trigger      = 5
+    DataValidity = 6
+
+
+class DeviceType(Enum):
+    Controller                 = 0
+    SignalProcessing           = 1
+    VelocityDecoderDigital     = 2
+    DisplacementDecoderDigital = 3
+    AccelerationDecoderDigital = 4
+    SensorHead                 = 5
+    QTecModule                 = 6
+    AutofocusArea              = 7
+
+
+class DeviceCommand(Enum):
+    OperationMode          = 0
+    DaqMode                = 1
+    DaqTriggerMode         = 2
+    DaqTriggerEdge         = 3
+    DaqAnalogTriggerSource = 4
+    DaqAnalogTriggerLevel  = 5
+    DaqBlockCount          = 6
+    DaqBlockSize           = 7
+    DaqGatedTrigger        = 8
+    DaqPreTrigger          = 9
+    DaqSampleRate          = 10
+    DaqBaseSampleRate      = 11
+    Bandwidth              = 12
+    Range                  = 13
+    TrackingFilterRange    = 14
+    HighPass               = 15
+    MaximumVelocityRange   = 16
+    OutputActive           = 17
+    HeadroomDigitalOut     = 18
+    Autofocus              = 19
+    AutofocusResult        = 20
+    SignalLevel            = 21
+    FocusPosition          = 22
+    QTecOn                 = 23
+    IQMode                 = 24
+
+
+class MiscellaneousTag(Enum):
+    CurrentValue = 0
+    StartUpValue = 1
+
+
+class LibraryFunctionCallError(RuntimeError):
+    """Raised where the polytec library would report a failed call."""
+    pass
+
+
+_SI_PREFIXES = {"n": 1e-9, "u": 1e-6, "µ": 1e-6, "m": 1e-3, "": 1., "k": 1e3, "M": 1e6, "G": 1e9}
+
+def value_from_quantity_string(quantity,base_unit):
+    """Value of a quantity string like "20 mm/s" in base_unit (here m/s), like polytec.quantity_conversion."""
+    number, unit = quantity.strip().split(" ",1)
+    unit = unit.strip()
+    if not unit.endswith(base_unit) or unit[:-len(base_unit)] not in _SI_PREFIXES:
+        raise ValueError(f"Cannot convert {quantity} to {base_unit}.")
+    return float(number) * _SI_PREFIXES[unit[:-len(base_unit)]]
+
+
+# Item lists: (device type, command) -> (available items, initial item).
+_ITEM_LISTS = {
+    (DeviceType.SignalProcessing,DeviceCommand.OperationMode):          (["Off","Daq"],"Daq"),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqMode):                (["Block","Streaming"],"Block"),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqTriggerMode):         (["None","Extern","Analog"],"Extern"),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqTriggerEdge):         (["Rising","Falling","Both"],"Rising"),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqAnalogTriggerSource): (["Velocity","RSSI"],"Velocity"),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.Bandwidth):        (["100 kHz","1.5 MHz"],"1.5 MHz"),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.Range):            (["20 mm/s","100 mm/s","500 mm/s","2 m/s"],"500 mm/s"),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.TrackingFilterRange): (["Off","Slow","Medium","Fast"],"Off"),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.HighPass):         (["Off","100 Hz"],"Off"),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.MaximumVelocityRange): (["2 m/s","6 m/s"],"2 m/s"),
+}
+
+# Numeric settings: (device type, command) -> (initial value, (min, max)).
+_NUMBERS = {
+    (DeviceType.SignalProcessing,DeviceCommand.DaqBlockCount):          (25,(0,32767)),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqBlockSize):           (4000,(1,10000000)),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqAnalogTriggerLevel):  (0.5,(-1.,1.)),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqGatedTrigger):        (0,(0,1)),
+    (DeviceType.SignalProcessing,DeviceCommand.DaqPreTrigger):          (0,(-10000000,10000000)),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.OutputActive):     (1,(0,1)),
+    (DeviceType.VelocityDecoderDigital,DeviceCommand.HeadroomDigitalOut): (1.,(0.,2.)),
+    (DeviceType.SensorHead,DeviceCommand.Autofocus):                    (0,(0,1)),
+    (DeviceType.SensorHead,DeviceCommand.AutofocusResult):              (1,(0,1)),
+    (DeviceType.SensorHead,DeviceCommand.SignalLevel):                  (400,(0,512)),
+    (DeviceType.SensorHead,DeviceCommand.FocusPosition):                (900,(0,1835)),
+    (DeviceType.QTecModule,DeviceCommand.QTecOn):                       (1,(0,1)),
+    (DeviceType.Controller,DeviceCommand.IQMode):                       (0,(0,1)),
+}
+
+# Full scale of the raw samples per channel type, see DataAcquisition.channel_max_value.
+_MAX_VALUES = {ChannelType.Velocity: 2**23, ChannelType.Displacement: 2**23, ChannelType.Acceleration: 2**23,
+               ChannelType.RSSI: 2**16, ChannelType.Trigger: 1, ChannelType.DataValidity: 1}
+
+
+class SimulatedDevice:
+    """The simulated vibrometer behind a DeviceCommunication. See the top of this file for what the parameters do."""
+
+    def __init__(self,sample_rate=1250000,base_sample_rate=625000,channels=("Velocity","RSSI","DataValidity"),
+                 realtime=True,trigger_delay=0.01,trigger_interval=0.1,trigger_jitter=0.,command_latency=0.,
+                 read_latency=0.,packet_loss=0.,packet_size=64,autofocus_time=0.5,settings=None,seed=0):
+        if sample_rate % base_sample_rate != 0:
+            raise ValueError("sample_rate must be a multiple of base_sample_rate.")
+
+        self.realtime         = realtime
+        self.trigger_delay    = trigger_delay
+        self.trigger_interval = trigger_interval
+        self.trigger_jitter   = trigger_jitter
+        self.command_latency  = command_latency
+        self.read_latency     = read_latency
+        self.packet_loss      = packet_loss
+        self.packet_size      = packet_size
+        self.autofocus_time   = autofocus_time
+        self.random           = Random(seed)
+
+        self.channels = [ChannelType[channel] for channel in channels]
+
+        self.items   = {key: list(available) for key,(available,_) in _ITEM_LISTS.items()}
+        self.values  = {key: current for key,(_,current) in _ITEM_LISTS.items()}
+        self.ranges  = {key: value_range for key,(_,value_range) in _NUMBERS.items()}
+        self.values.update({key: value for key,(value,_) in _NUMBERS.items()})
+
+        # Rates are read-only on the device.
+        self.values[(DeviceType.SignalProcessing,DeviceCommand.DaqSampleRate)]     = sample_rate
+        self.values[(DeviceType.SignalProcessing,DeviceCommand.DaqBaseSampleRate)] = base_sample_rate
+
+        for (device_type,command),value in (settings or dict()).items():
+            self.values[(device_type,command)] = value
+
+        # Number of device commands (get/set) handled, to see how chatty the software is.
+        self.command_count = 0
+        # perf_counter() time of every trigger that started a block, to measure how long the software takes to notice.
+        self.trigger_times = []
+        self._autofocus_done = 0.
+
+        # One period of every signal, chunks are cut from these so generating data costs next to nothing.
+        rng    = np.random.default_rng(seed)
+        period = 1 << 16
+        phase  = 2*np.pi*np.arange(period)/period
+        velocity = 0.3*np.sin(64*phase) + 0.01*rng.standard_normal(period)
+        self.tables = {ChannelType.Velocity:     np.round(velocity*_MAX_VALUES[ChannelType.Velocity]).astype(np.int32),
+                       ChannelType.Displacement: np.round(0.3*np.cos(64*phase)*_MAX_VALUES[ChannelType.Velocity]).astype(np.int32),
+                       ChannelType.Acceleration: np.round(0.3*np.sin(64*phase+1.)*_MAX_VALUES[ChannelType.Velocity]).astype(np.int32),
+                       ChannelType.RSSI:         np.round((0.7+0.02*rng.standard_normal(period))*_MAX_VALUES[ChannelType.RSSI]).astype(np.int32)}
+        self.overrange = np.abs(velocity) > 0.305
+
+    @property
+    def sample_rate(self):
+        return self.values[(DeviceType.SignalProcessing,DeviceCommand.DaqSampleRate)]
+
+    @property
+    def base_sample_rate(self):
+        return self.values[(DeviceType.SignalProcessing,DeviceCommand.DaqBaseSampleRate)]
+
+    @property
+    def freq_factor(self):
+        return self.sample_rate // self.base_sample_rate
+
+    def setting(self,device_type,command):
+        return self.values[(device_type,command)]
+
+    ### Device commands, called through DeviceCommunication and ItemList
+    def command(self):
+        self.command_count += 1
+        if self.command_latency > 0:
+            sleep(self.command_latency)
+
+    def get(self,device_type,command):
+        self.command()
+        if (device_type,command) not in self.values:
+            raise LibraryFunctionCallError(f"Device {device_type.name} has no command {command.name}.")
+
+        if (device_type,command) == (DeviceType.SensorHead,DeviceCommand.AutofocusResult):
+            return 1 if perf_counter() >= self._autofocus_done else 0
+        return self.values[(device_type,command)]
+
+    def set(self,device_type,command,value):
+        self.command()
+        if (device_type,command) not in self.values:
+            raise LibraryFunctionCallError(f"Device {device_type.name} has no command {command.name}.")
+
+        value_range = self.ranges.get((device_type,command))
+        if value_range is not None and not value_range[0] <= value <= value_range[1]:
+            raise LibraryFunctionCallError(f"{value} out of range {value_range} for {command.name}.")
+        if (device_type,command) in self.items and value not in self.items[(device_type,command)]:
+            raise LibraryFunctionCallError(f"{value} not available for {command.name}.")
+
+        if (device_type,command) == (DeviceType.SensorHead,DeviceCommand.Autofocus):
+            self._autofocus_done = perf_counter() + self.autofocus_time
+            return
+        self.values[(device_type,command)] = value
+
+
+class DeviceCommunication:
+    """Simulated polytec.io.device_communication.DeviceCommunication. ip is only kept for show, the device is given (or a
+    SimulatedDevice with the default settings)."""
+
+    def __init__(self,ip,device=None):
+        self.ip     = ip
+        self.device = device if device is not None else SimulatedDevice()
+
+    def has_device(self,device_type):
+        return any(key[0] == device_type for key in self.device.values)
+
+    def has_command(self,device_type,command):
+        return (device_type,command) in self.device.values
+
+    def get_int16(self,device_type,command,miscellaneous_tag=None):
+        return int(self.device.get(device_type,command))
+
+    def get_int32(self,device_type,command,miscellaneous_tag=None):
+        return int(self.device.get(device_type,command))
+
+    def get_float(self,device_type,command,miscellaneous_tag=None):
+        return float(self.device.get(device_type,command))
+
+    def set_int16(self,device_type,command,value):
+        self.device.set(device_type,command,int(value))
+
+    def set_int32(self,device_type,command,value):
+        self.device.set(device_type,command,int(value))
+
+    def set_float(self,device_type,command,value):
+        self.device.set(device_type,command,float(value))
+
+    def get_int16_range(self,device_type,command):
+        self.device.command()
+        if (device_type,command) not in self.device.ranges:
+            raise LibraryFunctionCallError(f"Device {device_type.name} has no range for {command.name}.")
+        return self.device.ranges[(device_type,command)]
+
+    get_int32_range = get_int16_range
+    get_float_range = get_int16_range
+
+
+class ItemList:
+    """Simulated polytec.io.item_list.ItemList: a setting with a list of allowed string values."""
+
+    def __init__(self,communication,device_type,command):
+        # Looking up the setting on the device is a round-trip, like any other command.
+        communication.device.command()
+        if (device_type,command) not in communication.device.items:
+            raise LibraryFunctionCallError(f"{command.name} of {device_type.name} is not an item list.")
+
+        self._device = communication.device
+        self._key    = (device_type,command)
+
+    def current_item(self):
+        return self._device.get(*self._key)
+
+    def set_current_item(self,item):
+        self._device.set(*self._key,item)
+
+    def is_item_available(self,item):
+        return item in self.available_items()
+
+    def available_items(self):
+        self._device.command()
+        return list(self._device.items[self._key])
+
+
+class ChannelActivation:
+    """Simulated polytec.io.channel_activation.ChannelActivation. One channel per type, enabled as configured."""
+
+    def __init__(self,communication):
+        communication.device.command()
+        self._device = communication.device
+
+    def is_channel_type_supported(self,channel_type):
+        return channel_type in _MAX_VALUES
+
+    def is_channel_available(self,channel_type):
+        return channel_type in _MAX_VALUES
+
+    def max_channel_count(self,channel_type):
+        return 1 if channel_type in _MAX_VALUES else 0
+
+    def is_channel_enabled(self,channel_type,channel_id=0):
+        return channel_id == 0 and channel_type in self._device.channels
+
+
+class DataAcquisition:
+    """Simulated polytec.io.data_acquisition.DataAcquisition, see the top of this file for the timing model."""
+
+    def __init__(self,communication,buffer_capacity):
+        self._device   = communication.device
+        self._capacity = buffer_capacity
+        self._running  = False
+        self._extracted = dict()
+
+    def base_sample_rate_in_hz(self):
+        return self._device.base_sample_rate
+
+    def channel_max_value(self,channel_type):
+        return _MAX_VALUES[channel_type]
+
+    def start_data_acquisition(self):
+        device = self._device
+        self._running     = True
+        self._block_size  = device.setting(DeviceType.SignalProcessing,DeviceCommand.DaqBlockSize)
+        self._pre_trigger = device.setting(DeviceType.SignalProcessing,DeviceCommand.DaqPreTrigger)
+        self._triggered   = device.setting(DeviceType.SignalProcessing,DeviceCommand.DaqMode) == "Block" and \
+                            device.setting(DeviceType.SignalProcessing,DeviceCommand.DaqTriggerMode) != "None"
+        self._duration    = self._block_size/device.base_sample_rate if device.realtime else 0.
+
+        self._start        = perf_counter()
+        self._next_trigger = self._start + device.trigger_delay
+        self._block_id     = 0
+        self._block_start  = self.__trigger_after(self._start)
+        self._read         = 0
+
+    def stop_data_acquisition(self):
+        self._running = False
+
+    def next_data_acquisition_block(self):
+        self._block_id   += 1
+        self._block_start = self.__trigger_after(self._block_start + self._duration)
+        self._read        = 0
+
+    def __trigger_after(self,time):
+        """Start of the block that follows time: the next trigger, or time itself without trigger."""
+        if not self._triggered:
+            return time
+
+        device = self._device
+        while self._next_trigger < time:
+            self._next_trigger += max(device.trigger_interval,1e-9)
+        trigger = self._next_trigger + device.random.uniform(0.,device.trigger_jitter)
+        self._next_trigger += device.trigger_interval
+        device.trigger_times.append(trigger)
+        return trigger
+
+    def __arrived(self,now):
+        """Base samples of the current block the device has acquired by now."""
+        if now < self._block_start:
+            return 0
+        if not self._device.realtime:
+            return self._block_size
+        return min(int((now - self._block_start)*self._device.base_sample_rate),self._block_size)
+
+    def available_samples(self):
+        if not self._running:
+            return 0
+        return self.__arrived(perf_counter()) - self._read
+
+    def read_data(self,base_sample_count,timeout_ms):
+        """Wait until base_sample_count more base samples are there, and extract them."""
+        if not self._running:
+            raise LibraryFunctionCallError("Data acquisition not started.")
+
+        device = self._device
+        if device.read_latency > 0:
+            sleep(device.read_latency)
+
+        # When the samples will have arrived, on the device clock.
+        ready = self._block_start + ((self._read+base_sample_count)/device.base_sample_rate if device.realtime else 0.)
+        now   = perf_counter()
+        if ready - now > timeout_ms/1000:
+            sleep(timeout_ms/1000)
+            raise LibraryFunctionCallError("Data acquisition timeout.")
+        if ready > now:
+            sleep(ready - now)
+
+        # The device does not wait for us. Being more than the buffer capacity behind means data was overwritten.
+        behind = (perf_counter() - self._block_start)*device.base_sample_rate - self._read if device.realtime else 0
+        if behind > self._capacity:
+            raise LibraryFunctionCallError("Data acquisition buffer overrun.")
+
+        # Lost packet, in (full rate) DataValidity samples.
+        lost = None
+        if device.packet_loss > 0 and device.random.random() < device.packet_loss:
+            sample_count = base_sample_count*device.freq_factor
+            start = device.random.randrange(sample_count)
+            lost  = (start,min(start+device.packet_size,sample_count))
+
+        self._extracted = {"start": self._read, "count": base_sample_count, "lost": lost}
+        self._read += base_sample_count
+
+    def extracted_sample_count(self,channel_type,channel_id):
+        # Only RSSI comes at the base sample rate.
+        count = self._extracted.get("count",0)
+        return count if channel_type == ChannelType.RSSI else count*self._device.freq_factor
+
+    def __positions(self,channel_type,sample_count):
+        factor = 1 if channel_type == ChannelType.RSSI else self._device.freq_factor
+        start  = self._extracted["start"]*factor + self._block_id*self._block_size*factor
+        return np.arange(start,start+sample_count)
+
+    def get_int32_data(self,channel_type,channel_id,sample_count):
+        if channel_type == ChannelType.DataValidity:
+            valid = np.ones(sample_count,dtype=np.int32)
+            if self._extracted["lost"] is not None:
+                valid[self._extracted["lost"][0]:self._extracted["lost"][1]] = 0
+            return valid
+
+        if channel_type == ChannelType.Trigger:
+            # Flags the sample at which the trigger came in.
+            factor   = self._device.freq_factor
+            position = np.arange(sample_count) + self._extracted["start"]*factor
+            return (position == self._pre_trigger).astype(np.int32)
+
+        return np.take(self._device.tables[channel_type],self.__positions(channel_type,sample_count),mode="wrap")
+
+    def get_overrange(self,channel_type,channel_id,sample_count):
+        return np.take(self._device.overrange,self.__positions(channel_type,sample_count),mode="wrap")
@@ -0,0 +1,153 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Instrumentation of the acquisition loop. When a run is slow or a timeout hits, this tells whether the time goes into
+# read_data, get_int32_data, get_overrange or waiting for the trigger, how full the DataAcquisition ring buffer got, and how
+# many samples per second made it into the buffers.
+#
+# Recording is kept cheap: a histogram update is a bisect into fixed buckets and two additions, no locks, no allocation. When
+# telemetry is disabled, the acquisition loop does not time anything at all.
+
+import json
+
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+
+
+# Upper bounds (s) of the latency histogram buckets, 1-2-5 steps from 10 us to 10 s. Anything slower ends up in +Inf.
+LATENCY_BUCKETS = [scale*decade for decade in [1e-5,1e-4,1e-3,1e-2,1e-1,1.] for scale in [1,2,5]] + [10.]
+
+
+class LatencyHistogram:
+    """Histogram of call latencies with fixed buckets (see LATENCY_BUCKETS)."""
+
+    def __init__(self):
+        self.counts = [0]*(len(LATENCY_BUCKETS)+1)
+        self.count  = 0
+        self.sum    = 0.
+        self.max    = 0.
+
+    def record(self,seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS,seconds)] += 1
+        self.count += 1
+        self.sum   += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self):
+        return {"buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS]+["+Inf"],self.counts)),
+                "count": self.count, "sum": self.sum, "mean": self.sum/self.count if self.count else None, "max": self.max}
+
+
+class Telemetry:
+    """Telemetry of the acquisition loop of a Vibrometer: latency histograms per call, ring buffer fill level over time,
+    sample/byte throughput and trigger wait time per block."""
+
+    def __init__(self,fill_history=10000):
+        self.enabled = False
+        self._fill_history = fill_history
+        self.reset()
+
+    def reset(self):
+        """Start over, called at the start of every run."""
+        self._histograms    = dict()
+        self._fill          = deque(maxlen=self._fill_history)
+        self._fill_max      = 0
+        self._samples       = 0
+        self._bytes         = 0
+        self._lost_samples  = 0
+        self._lost_blocks   = set()
+        self._trigger_waits = []
+        self._run_start     = perf_counter()
+        self._run_end       = None
+
+    def end_run(self):
+        self._run_end = perf_counter()
+
+    ### Recording, called from the acquisition thread
+    def record(self,name,seconds):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def timed(self,name,func,*args):
+        """Call func(*args) and record how long it took under name."""
+        start  = perf_counter()
+        result = func(*args)
+        self.record(name,perf_counter()-start)
+        return result
+
+    def record_fill(self,available_samples):
+        """Record the number of samples waiting in the DataAcquisition ring buffer."""
+        self._fill.append((perf_counter()-self._run_start,available_samples))
+        if available_samples > self._fill_max:
+            self._fill_max = available_samples
+
+    def record_samples(self,samples,nbytes):
+        self._samples += samples
+        self._bytes   += nbytes
+
+    def record_lost(self,block_id,samples):
+        """Record samples the DataValidity channel flagged as lost."""
+        self._lost_samples += samples
+        self._lost_blocks.add(block_id)
+
+    def record_trigger_wait(self,block_id,seconds):
+        self._trigger_waits.append((block_id,seconds))
+        self.record("wait_for_trigger",seconds)
+
+    ### Export
+    def snapshot(self):
+        """Everything recorded so far as a dict."""
+        duration = (self._run_end if self._run_end is not None else perf_counter()) - self._run_start
+        fill     = list(self._fill)
+
+        return {"duration":          duration,
+                "samples":           self._samples,
+                "bytes":             self._bytes,
+                "samples_per_second":self._samples/duration if duration > 0 else None,
+                "bytes_per_second":  self._bytes/duration if duration > 0 else None,
+                "lost_samples":      self._lost_samples,
+                "lost_blocks":       len(self._lost_blocks),
+                "calls":             {name: histogram.to_dict() for name,histogram in self._histograms.items()},
+                "buffer_fill":       {"last": fill[-1][1] if fill else None, "max": self._fill_max,
+                                      "history": fill},
+                "trigger_wait":      [{"block_id": block_id, "seconds": seconds} for block_id,seconds in self._trigger_waits]}
+
+    def to_json(self,**kwargs):
+        return json.dumps(self.snapshot(),**kwargs)
+
+    def to_prometheus(self,prefix="vibrometer",labels=None):
+        """Prometheus text exposition format. labels (dict) are added to every sample, e.g. to tell devices apart."""
+        base_labels = ",".join(f'{key}="{value}"' for key,value in (labels or dict()).items())
+
+        def fmt(extra=""):
+            all_labels = ",".join(label for label in [base_labels,extra] if label)
+            return "{"+all_labels+"}" if all_labels else ""
+
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_call_seconds histogram"]
+        for name,histogram in self._histograms.items():
+            call = f'call="{name}"'
+            cumulative = 0
+            for bound,count in zip([str(bound) for bound in LATENCY_BUCKETS]+["+Inf"],histogram.counts):
+                cumulative += count
+                bucket = f'{call},le="{bound}"'
+                lines.append(f"{prefix}_call_seconds_bucket{fmt(bucket)} {cumulative}")
+            lines.append(f"{prefix}_call_seconds_sum{fmt(call)} {histogram.sum}")
+            lines.append(f"{prefix}_call_seconds_count{fmt(call)} {histogram.count}")
+
+        lines += [f"# TYPE {prefix}_samples_total counter",        f"{prefix}_samples_total{fmt()} {snapshot['samples']}",
+                  f"# TYPE {prefix}_bytes_total counter",          f"{prefix}_bytes_total{fmt()} {snapshot['bytes']}",
+                  f"# TYPE {prefix}_lost_samples_total counter",   f"{prefix}_lost_samples_total{fmt()} {snapshot['lost_samples']}",
+                  f"# TYPE {prefix}_samples_per_second gauge",     f"{prefix}_samples_per_second{fmt()} {snapshot['samples_per_second'] or 0}",
+                  f"# TYPE {prefix}_buffer_fill_samples gauge",    f"{prefix}_buffer_fill_samples{fmt()} {snapshot['buffer_fill']['last'] or 0}",
+                  f"# TYPE {prefix}_buffer_fill_max_samples gauge",f"{prefix}_buffer_fill_max_samples{fmt()} {snapshot['buffer_fill']['max']}"]
+
+        return "\n".join(lines)+"\n"
+
+
+def untimed(name,func,*args):
+    """Stand-in for Telemetry.timed when telemetry is disabled."""
+    return func(*args)
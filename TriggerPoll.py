@@ -0,0 +1,88 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# The device does not tell us when a trigger arrives, we can only ask how many samples are available. Polling with a fixed
+# sleep puts a floor under the latency (the old 10 ms sleep meant up to 10 ms before the first read). This class spins for a
+# short window, where triggers usually arrive when the experiment is well-timed, and then backs off exponentially so long
+# waits do not eat a CPU core. Even at the longest interval (1 ms by default) the cost of a poll is negligible.
+
+from time import perf_counter, sleep
+
+
+class TriggerPoll:
+    """Adaptive polling strategy: tight spin for spin_time seconds, then sleep intervals growing from min_interval to
+    max_interval by a factor backoff."""
+
+    def __init__(self,spin_time=0.005,min_interval=0.00005,max_interval=0.001,backoff=2.):
+        self.spin_time    = spin_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff      = backoff
+
+    @property
+    def spin_time(self):
+        return self.__spin_time
+
+    @spin_time.setter
+    def spin_time(self,val):
+        if val < 0:
+            raise ValueError("spin_time cannot be negative.")
+        self.__spin_time = float(val)
+
+    @property
+    def min_interval(self):
+        return self.__min_interval
+
+    @min_interval.setter
+    def min_interval(self,val):
+        if val <= 0:
+            raise ValueError("min_interval must be larger than 0.")
+        self.__min_interval = float(val)
+
+    @property
+    def max_interval(self):
+        return self.__max_interval
+
+    @max_interval.setter
+    def max_interval(self,val):
+        if val <= 0:
+            raise ValueError("max_interval must be larger than 0.")
+        self.__max_interval = float(val)
+
+    @property
+    def backoff(self):
+        return self.__backoff
+
+    @backoff.setter
+    def backoff(self,val):
+        if val < 1:
+            raise ValueError("backoff must be at least 1.")
+        self.__backoff = float(val)
+
+    def wait(self,condition,abort_event=None,timeout=None):
+        """Block until condition() is true. Returns True if it did, False if abort_event was set or timeout (s) passed first.
+
+        While backing off we sleep on abort_event, so setting it wakes us immediately."""
+        start = perf_counter()
+
+        # Spin phase
+        while perf_counter() - start < self.__spin_time:
+            if condition():
+                return True
+            if abort_event is not None and abort_event.is_set():
+                return False
+
+        # Back-off phase
+        interval = self.__min_interval
+        while not condition():
+            if timeout is not None and perf_counter() - start >= timeout:
+                return False
+
+            if abort_event is not None:
+                if abort_event.wait(interval):
+                    return False
+            else:
+                sleep(interval)
+
+            interval = min(interval*self.__backoff, self.__max_interval)
+
+        return True
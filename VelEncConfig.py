@@ -7,9 +7,10 @@
 # Copyright (c) 2022 Jasper Smits
 # Released under the terms of the GNU Lesser General Public License version 3
 
-from polytec.io.device_type import DeviceType
-from polytec.io.device_command import DeviceCommand
-from polytec.io.item_list import ItemList
+from .Backend import DeviceType, DeviceCommand
+from .SettingsCache import SettingsCache
+from .CapabilityCache import CapabilityCache
+from .LazyItemList import LazyItemList
 
 
 # We intent to expose the following variables, asterisk for read-only.
@@ -38,11 +39,33 @@ class VelEncConfig:
             self.__communication = device_communication
 
         ## Below is auto-generated by the function_writer utility. Copy-pasted in manually
-        self.__bandwidth = ItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.Bandwidth)
-        self.__range = ItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.Range)
-        self.__tracking_filter = ItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.TrackingFilterRange)
-        self.__high_pass_filter = ItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.HighPass)
-        self.__max_velocity_range = ItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.MaximumVelocityRange)
+        ## The ItemLists are only constructed on first use, see LazyItemList.
+        self.__bandwidth = LazyItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.Bandwidth)
+        self.__range = LazyItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.Range)
+        self.__tracking_filter = LazyItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.TrackingFilterRange)
+        self.__high_pass_filter = LazyItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.HighPass)
+        self.__max_velocity_range = LazyItemList(self.__communication, DeviceType.VelocityDecoderDigital, DeviceCommand.MaximumVelocityRange)
+
+        # Reads are served from the settings cache (shared with the other config classes), see SettingsCache.
+        if not hasattr(self,"_settings_cache"):
+            self._settings_cache = SettingsCache()
+
+        # The available items are read once per connection, see CapabilityCache.
+        self._capabilities = CapabilityCache.for_connection(self.__communication)
+
+    def __cached(self,name,item_list):
+        return self._settings_cache.get(DeviceType.VelocityDecoderDigital,name,lambda: item_list.current_item())
+
+    def __set(self,item_list,new_value):
+        """Write the value and forget the cached settings. The velocity range (and its available items) depends on the maximum
+        velocity range, and the decoder settings can change those of the signal processing, like the sample rate."""
+        item_list.set_current_item(new_value)
+        self._settings_cache.invalidate()
+        if item_list is self.__max_velocity_range:
+            self._capabilities.invalidate(DeviceType.VelocityDecoderDigital)
+
+    def __available(self,item_list,command):
+        return self._capabilities.get(DeviceType.VelocityDecoderDigital,command,lambda: item_list.available_items())
 
     def to_dict(self):
         """Dictionary representation of this class' properties."""
@@ -60,91 +83,91 @@ class VelEncConfig:
     @property
     def bandwidth(self):
         """Gets the Bandwidth"""
-        return self.__bandwidth.current_item()
+        return self.__cached("bandwidth",self.__bandwidth)
     
     @bandwidth.setter
     def bandwidth(self,new_value):
         """Sets the Bandwidth"""
-        if self.__bandwidth.is_item_available(new_value):
-            self.__bandwidth.set_current_item(new_value)
+        if new_value in self.all_bandwidth():
+            self.__set(self.__bandwidth,new_value)
         else:
             raise ConfigurationError(f"Bandwidth mode not available: {new_value}. Available values: {self.all_bandwidth()}.")
 
     def all_bandwidth(self):
         """Gets all available settings for property Bandwidth"""
-        return self.__bandwidth.available_items()
+        return self.__available(self.__bandwidth,DeviceCommand.Bandwidth)
 
     # Velocity Range
     @property
     def range(self):
         """Gets the Velocity Range"""
-        return self.__range.current_item()
+        return self.__cached("range",self.__range)
     
     @range.setter
     def range(self,new_value):
         """Sets the Velocity Range"""
-        if self.__range.is_item_available(new_value):
-            self.__range.set_current_item(new_value)
+        if new_value in self.all_range():
+            self.__set(self.__range,new_value)
         else:
             raise ConfigurationError(f"Velocity Range mode not available: {new_value}. Available values: {self.all_range()}.")
     
     def all_range(self):
         """Gets all available settings for property Velocity Range"""
-        return self.__range.available_items()
+        return self.__available(self.__range,DeviceCommand.Range)
     
     # Tracking Filter
     @property
     def tracking_filter(self):
         """Gets the Tracking Filter"""
-        return self.__tracking_filter.current_item()
+        return self.__cached("tracking_filter",self.__tracking_filter)
     
     @tracking_filter.setter
     def tracking_filter(self,new_value):
         """Sets the Tracking Filter"""
-        if self.__tracking_filter.is_item_available(new_value):
-            self.__tracking_filter.set_current_item(new_value)
+        if new_value in self.all_tracking_filter():
+            self.__set(self.__tracking_filter,new_value)
         else:
             raise ConfigurationError(f"Tracking Filter mode not available: {new_value}. Available values: {self.all_tracking_filter()}.")
     
     def all_tracking_filter(self):
         """Gets all available settings for property Tracking Filter"""
-        return self.__tracking_filter.available_items()
+        return self.__available(self.__tracking_filter,DeviceCommand.TrackingFilterRange)
     
     # High Pass Filter
     @property
     def high_pass_filter(self):
         """Gets the High Pass Filter"""
-        return self.__high_pass_filter.current_item()
+        return self.__cached("high_pass_filter",self.__high_pass_filter)
     
     @high_pass_filter.setter
     def high_pass_filter(self,new_value):
         """Sets the High Pass Filter"""
-        if self.__high_pass_filter.is_item_available(new_value):
-            self.__high_pass_filter.set_current_item(new_value)
+        if new_value in self.all_high_pass_filter():
+            self.__set(self.__high_pass_filter,new_value)
         else:
             raise ConfigurationError(f"High Pass Filter mode not available: {new_value}. Available values: {self.all_high_pass_filter()}.")
     
     def all_high_pass_filter(self):
         """Gets all available settings for property High Pass Filter"""
-        return self.__high_pass_filter.available_items()
+        return self.__available(self.__high_pass_filter,DeviceCommand.HighPass)
     
     # Maximum Velocity Range
     @property
     def max_velocity_range(self):
         """Gets the Maximum Velocity Range"""
-        return self.__max_velocity_range.current_item()
+        return self.__cached("max_velocity_range",self.__max_velocity_range)
     
     @max_velocity_range.setter
     def max_velocity_range(self,new_value):
         """Sets the Maximum Velocity Range"""
-        if self.__max_velocity_range.is_item_available(new_value):
-            self.__max_velocity_range.set_current_item(new_value)
+        if new_value in self.all_max_velocity_range():
+            self.__set(self.__max_velocity_range,new_value)
         else:
             raise ConfigurationError(f"Maximum Velocity Range mode not available: {new_value}. Available values: {self.all_max_velocity_range()}.")
     
     def all_max_velocity_range(self):
         """Gets all available settings for property Maximum Velocity Range"""
-        return self.__max_velocity_range.available_items()
+        return self.__available(self.__max_velocity_range,DeviceCommand.MaximumVelocityRange)
     
 
 
@@ -2,29 +2,33 @@
 # DaqConfig,acquire_from_csv (c) 2021 Polytec GmbH, Waldbrunn, released under LGPLv3.
 # Other files (c) 20222 Jasper Smits, released under LGPLv3.
 
-from polytec.io.channel_activation import ChannelActivation
-from polytec.io.data_acquisition import DataAcquisition
-from polytec.io.channel_type import ChannelType
-#from polytec.io.device_command import DeviceCommand
-#from polytec.io.device_type import DeviceType
-#from polytec.io.item_list import ItemList
-
-from polytec.io.device_communication import DeviceCommunication
+# The polytec library, or the simulated device (POLYTEC_BACKEND=simulated), see Backend.
+from .Backend import ChannelActivation, DataAcquisition, ChannelType, DeviceCommunication
+#from .Backend import DeviceCommand, DeviceType, ItemList
 
 from .acquire_to_csv import __get_active_channels as get_active_channels # Args: communication, acquisition
 from .acquire_to_csv import __wait_for_trigger as wait_for_trigger # acquisition, self.trigger_mode
 
-from .DaqConfig import DaqConfig
+from .DaqConfig import DaqConfig, ConfigurationError
 from .VelEncConfig import VelEncConfig
 from .MiscConfig import MiscConfig
-from .DataManagement import HDF5Writer
-
-from threading import Thread
-
+from .DataManagement import HDF5Writer, HDF5StreamWriter, HDF5BackgroundWriter
+from .TriggerPoll import TriggerPoll
+from .BlockDispatcher import Block, BlockDispatcher
+from .MemmapAllocator import MemmapAllocator
+from .BufferPool import BufferPool
+from .Telemetry import Telemetry, untimed
+from .DataValidity import LostSampleIndex, lost_sample_ranges
+from .RunningStatistics import RunningStatistics
+from .OnlineFilter import OnlineFilter
+
+from threading import Thread, Event, Lock, current_thread
+from time import perf_counter
+
+import json
+import traceback
 import numpy as np
 
-from time import sleep
-
 class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
     """This class controls all features of the vibrometer."""
 
@@ -36,14 +40,18 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
 
         self.__communication = dc
 
+        # Who we are talking to, the key under which the capabilities are saved (see save_capabilities). The IP by default.
+        self.device_identity = None
+
         DaqConfig.__init__(self,dc,True)
         VelEncConfig.__init__(self,dc,True)
         MiscConfig.__init__(self,dc,True)
         HDF5Writer.__init__(self)
 
-        # Below deals with data acquisition
-        self.__acquisition = DataAcquisition(dc,10000000)
-        self.__acquisition_thread = Thread(target = self.__acquisition_loop)
+        # Below deals with data acquisition. The DataAcquisition (with its 10M sample buffer) and the acquisition thread are
+        # only set up by the first start_acq, so a Vibrometer that is only used to change settings starts fast.
+        self.__acquisition = None
+        self.__acquisition_thread = None
         self.__acq_loop   = True
         self.__acquiring  = False
         self.__buffer     = None
@@ -51,27 +59,96 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
         # Do we automatically autofocus before each acquisition?
         self.__auto_af    = False
 
+        # Store overrange flags 8 per byte? Packing happens once per block from a single scratch row.
+        self.__pack_overrange    = False
+        self.__overrange_scratch = dict()
+
+        # Filter/decimation stage per channel name, see OnlineFilter and set_filter().
+        self.__filters = dict()
+
+        # Time windows (s, relative to the trigger) to keep of every block, None keeps the whole block. The full block goes
+        # into a single scratch row per channel, and only the windows are copied into the buffer when the block is done.
+        self.__capture_windows = None
+        self.__sample_scratch  = dict()
+        self.__window_index    = dict()
+
+        # Accumulate mode: only keep running statistics per channel (see RunningStatistics), never the raw blocks.
+        self.__accumulate          = False
+        self.__accumulate_envelope = False
+        self.__statistics          = None
+
+        # Where the run buffers come from, allocator(ch_name, kind, shape, dtype) with kind "Samples" or "Overrange".
+        # None means plain zeroed numpy arrays.
+        self.__buffer_allocator  = None
+
+        # Reuse the run buffers of earlier runs? Arrays go back to the pool once written, see BufferPool.
+        self.__buffer_pool       = None
+
         # Data will be copied from the buffer to here at the end of a run.
         self.__data       = None
+
+        # Samples the DataValidity channel flagged as lost, per block, of the current (or last) run.
+        self.__lost_samples = LostSampleIndex()
+
+        # Optional streaming writer, persists blocks while the acquisition is running. Set up through stream_data().
+        self.__stream      = None
+        self.__last_stream = None
+
+        # Writer thread of write_data_async(), started on first use. At most write_queue_size runs wait to be written.
+        self.__background_writer = None
+        self.__write_queue_size  = 2
+
+        # Hands finished blocks to block callbacks and iter_blocks() while the acquisition is running.
+        self.__dispatcher  = BlockDispatcher()
         
-        # Are we ready for data? Read-only so internal param.
-        self.__ready_for_data = False
+        # Are we ready for data? Read-only so internal param. Events instead of flags, so nobody has to poll them:
+        # __start_event wakes the idle acquisition thread, __stop_event interrupts a trigger wait, __idle_event is set while
+        # no run is going on (or winding down).
+        self.__ready_for_data = Event()
+        self.__ready_callbacks = []
+        self.__ready_lock     = Lock()
+        self.__start_event    = Event()
+        self.__stop_event     = Event()
+        self.__idle_event     = Event()
+        self.__idle_event.set()
+
+        # How we poll the device for the trigger, see TriggerPoll.
+        self.__trigger_poll   = TriggerPoll()
+
+        # Instrumentation of the acquisition loop, off by default. See Telemetry.
+        self.__telemetry      = Telemetry()
 
         # Guess this requires another @property.
         self.__chunk_size     = 1000
         self.__acq_timeout    = 100
 
-        # Start the acq thread.
-        self.__acquisition_thread.start()
-
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the acquisition thread and the writer thread of write_data_async(), after it wrote the runs still queued. Call
+        this when done with the vibrometer, the script does not end while the acquisition thread runs, and __del__ is never
+        called by itself before that, since the thread holds a reference to the Vibrometer."""
         self.__acq_loop = False
-        self.__acquisition_thread.join()
+        if self.__acquisition_thread is not None:
+            self.__start_event.set()
+            self.__stop_event.set()
+            self.__acquisition_thread.join()
+
+        # Runs handed to write_data_async() are still written.
+        if self.__background_writer is not None:
+            self.__background_writer.close()
+            self.__background_writer = None
 
     @staticmethod
-    def from_ip(ip):
-        """Constructor which creates the class from a provided IP address (string). No checks on validity of the IP."""
-        return Vibrometer(DeviceCommunication(ip))
+    def from_ip(ip,capabilities_file=None):
+        """Constructor which creates the class from a provided IP address (string). No checks on validity of the IP.
+        Capabilities saved earlier in capabilities_file (see save_capabilities) are loaded, so the device is not queried for them."""
+        vib = Vibrometer(DeviceCommunication(ip))
+        vib.device_identity = ip
+        if capabilities_file is not None:
+            vib.load_capabilities(capabilities_file)
+        return vib
 
     def to_dict(self):
         """Dictionary representation of the Vibrometer state."""
@@ -84,33 +161,111 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
         _dict["chunk_size"] = self.chunk_size
         _dict["acq_timeout"] = self.acq_timeout
         _dict["auto_af"] = self.auto_af
+        _dict["pack_overrange"] = self.pack_overrange
+        _dict["trigger_spin_time"] = self.trigger_spin_time
+        _dict["trigger_poll_interval"] = self.trigger_poll_interval
+        _dict["accumulate"] = self.accumulate
+        _dict["accumulate_envelope"] = self.accumulate_envelope
+        _dict["capture_windows"] = json.dumps(self.capture_windows)
+        _dict["filters"] = json.dumps({ch_name: online_filter.describe() for ch_name,online_filter in self.__filters.items()})
 
         return _dict
 
+    # Settable properties and their types, in the order they are applied: the DAQ mode before the block settings, the trigger
+    # mode before what depends on it, the maximum velocity range before the range.
+    SETTINGS = {"daq_mode": str, "block_count": int, "block_size": int, "trigger_mode": str, "trigger_edge": str,
+                "analog_trigger_source": str, "analog_trigger_level": float, "gated_trigger": bool, "pre_post_trigger": int,
+                "max_velocity_range": str, "range": str, "bandwidth": str, "tracking_filter": str, "high_pass_filter": str,
+                "qtec": bool, "chunk_size": int, "acq_timeout": int, "auto_af": bool, "pack_overrange": bool,
+                "trigger_spin_time": float, "trigger_poll_interval": float, "accumulate": bool, "accumulate_envelope": bool}
+
+    # Validation of the device settings before anything is written: the list of available items or the (min, max) range.
+    SETTING_ITEMS  = {"daq_mode": "available_daq_modes", "trigger_mode": "available_trigger_modes",
+                      "trigger_edge": "available_trigger_edges", "analog_trigger_source": "available_analog_trigger_sources",
+                      "max_velocity_range": "all_max_velocity_range", "range": "all_range", "bandwidth": "all_bandwidth",
+                      "tracking_filter": "all_tracking_filter", "high_pass_filter": "all_high_pass_filter"}
+    SETTING_RANGES = {"block_count": "block_count_range", "block_size": "block_size_range",
+                      "analog_trigger_level": "analog_trigger_level_range", "pre_post_trigger": "pre_post_trigger_range"}
+
+    # Settings whose available items or range change with other settings: the velocity range follows the maximum velocity
+    # range, and the block settings share the memory of the device. These are validated once the settings they follow are
+    # written, their setters drop the capabilities that changed with them (see CapabilityCache).
+    SETTING_DEPENDS = {"range": ("max_velocity_range",), "block_count": ("block_size",),
+                       "pre_post_trigger": ("block_count","block_size")}
+
     def settings_from_dict(self,settings_dict):
-        """Set the properties of the vibrometer state from the dictionary. Coded out manually, since order matters."""
+        """Set the properties of the vibrometer state from the dictionary.
 
-        # A dictionary with all setable parameters.
-        property_dtype_dict = {"daq_mode": str,"block_count": int, "block_size": int, "trigger_mode": str,
-                "trigger_edge": str,"analog_trigger_source":str,"analog_trigger_level":float,"gated_trigger":bool,
-                "pre_post_trigger":int,"bandwidth":str,"range":str,"tracking_filter":str,"high_pass_filter":str,
-                "max_velocity_range":str,"qtec":bool,"chunk_size":int,"acq_timeout":int,"auto_af":bool}
+        Only settings that differ from the current state (as cached, see settings_cache) are written, in the order of
+        SETTINGS, but after the settings they depend on (see SETTING_DEPENDS). Values are validated before they are written,
+        so an invalid dictionary changes nothing: what was written is set back before the ConfigurationError. Returns a
+        report: {"changed": {key: {"old", "new", "seconds"}}, "unchanged": [keys], "ignored": [keys], "seconds": total}."""
+        start = perf_counter()
 
+        values = dict()
         for key in settings_dict:
-            if key in property_dtype_dict:
+            if key in self.SETTINGS:
                 try:
-                    val = property_dtype_dict[key](settings_dict[key])
+                    values[key] = self.SETTINGS[key](settings_dict[key])
                 except:
-                    raise ValueError(f"Could not convert {key} to type {property_dtype_dict[key]}.")
-
-                setattr(self,key,val)
-
+                    raise ValueError(f"Could not convert {key} to type {self.SETTINGS[key]}.")
+
+        current = self.to_dict()
+        changed = [key for key in self.SETTINGS if key in values and not self.__same_setting(current[key],values[key])]
+
+        report = {"changed": dict(), "unchanged": [key for key in values if key not in changed],
+                  "ignored": [key for key in settings_dict if key not in self.SETTINGS]}
+
+        # In stages: a setting is validated and written once none of the settings it depends on are still to be written.
+        pending = changed
+        while pending:
+            stage   = [key for key in pending if not any(parent in pending for parent in self.SETTING_DEPENDS.get(key,()))]
+            pending = [key for key in pending if key not in stage]
+
+            errors = self.__validate_settings({key: values[key] for key in stage})
+            if errors:
+                for key in reversed(list(report["changed"])):
+                    setattr(self,key,current[key])
+                raise ConfigurationError("Invalid settings, nothing was changed. "+"; ".join(errors))
+
+            for key in stage:
+                write_start = perf_counter()
+                setattr(self,key,values[key])
+                report["changed"][key] = {"old": current[key], "new": values[key], "seconds": perf_counter()-write_start}
+
+        report["seconds"] = perf_counter()-start
+        return report
+
+    def __validate_settings(self,values):
+        """Check values against the available items or ranges the device reports right now. Returns the errors."""
+        errors = []
+        for key,value in values.items():
+            if key in self.SETTING_ITEMS:
+                available = getattr(self,self.SETTING_ITEMS[key])()
+                if value not in available:
+                    errors.append(f"{key}: {value} not in {available}")
+            elif key in self.SETTING_RANGES:
+                value_range = getattr(self,self.SETTING_RANGES[key])()
+                if not value_range[0] <= value <= value_range[1]:
+                    errors.append(f"{key}: {value} out of range [{value_range[0]}, {value_range[1]}]")
+        return errors
 
+    @staticmethod
+    def __same_setting(current,new):
+        """Compare a setting as read back with the requested value. The device stores floats in single precision."""
+        if isinstance(new,float):
+            return np.isclose(current,new,rtol=1e-6,atol=0)
+        return current == new
 
     # Need this to be a read-only property.
     @property
     def ready_for_data(self):
-        return self.__ready_for_data
+        return self.__ready_for_data.is_set()
+
+    @property
+    def acquiring(self):
+        """Is a run armed or going on? False again once it is over, however it ended."""
+        return self.__acquiring
 
     @property
     def chunk_size(self):
@@ -147,6 +302,224 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
         
         self.__auto_af = val
 
+    @property
+    def pack_overrange(self):
+        return self.__pack_overrange
+
+    @pack_overrange.setter
+    def pack_overrange(self,val):
+        if val != True and val != False:
+            raise ValueError("pack_overrange needs to be either True or False.")
+
+        self.__pack_overrange = val
+
+    @property
+    def accumulate(self):
+        """Accumulate mode: keep the running sum, mean, variance and overrange counts of every channel over the blocks of a run
+        instead of the blocks themselves. Available as statistics after the run, written by write_data."""
+        return self.__accumulate
+
+    @accumulate.setter
+    def accumulate(self,val):
+        if val != True and val != False:
+            raise ValueError("accumulate needs to be either True or False.")
+
+        self.__accumulate = val
+
+    @property
+    def accumulate_envelope(self):
+        """Also keep the min/max envelope in accumulate mode."""
+        return self.__accumulate_envelope
+
+    @accumulate_envelope.setter
+    def accumulate_envelope(self,val):
+        if val != True and val != False:
+            raise ValueError("accumulate_envelope needs to be either True or False.")
+
+        self.__accumulate_envelope = val
+
+    @property
+    def capture_windows(self):
+        """List of (start, stop) time windows in s relative to the trigger, the parts of every block that are kept. Samples
+        outside all windows are dropped during the acquisition. None keeps the whole block."""
+        return None if self.__capture_windows is None else list(self.__capture_windows)
+
+    @capture_windows.setter
+    def capture_windows(self,val):
+        if val is not None:
+            try:
+                val = [(float(start),float(stop)) for start,stop in val]
+            except (TypeError,ValueError):
+                raise ValueError("capture_windows must be a list of (start, stop) pairs, or None.")
+            if len(val) == 0 or any(start >= stop for start,stop in val):
+                raise ValueError("capture_windows needs at least one window, each with start < stop.")
+
+        self.__capture_windows = val
+
+    @property
+    def filters(self):
+        """Dict of channel name to the OnlineFilter applied to it. Use set_filter() and clear_filter() to change it."""
+        return dict(self.__filters)
+
+    def set_filter(self,ch_name,online_filter):
+        """Filter and decimate a channel (e.g. "Velocity") during the acquisition, see OnlineFilter. Only the filtered data
+        is kept, as float32 in raw units. Takes effect from the next run."""
+        if not isinstance(online_filter,OnlineFilter):
+            raise ValueError("online_filter must be an OnlineFilter.")
+        if ch_name in ["Trigger","DataValidity"]:
+            raise ValueError(f"Channel {ch_name} holds flags, it cannot be filtered.")
+
+        self.__filters[ch_name] = online_filter
+
+    def clear_filter(self,ch_name=None):
+        """Stop filtering a channel, or all channels if none is given."""
+        if ch_name is None:
+            self.__filters = dict()
+        else:
+            self.__filters.pop(ch_name,None)
+
+    @property
+    def statistics(self):
+        """Running statistics of the current (or last) accumulate run: dict of channel name to a dict with the channel
+        metadata (Type, ID, ScaleFactor, Unit) and a RunningStatistics under "Statistics". None outside accumulate mode."""
+        return self.__statistics
+
+    @property
+    def buffer_allocator(self):
+        """Callable allocator(ch_name, kind, shape, dtype) returning a zeroed array for the run buffers, or None for numpy."""
+        return self.__buffer_allocator
+
+    @buffer_allocator.setter
+    def buffer_allocator(self,val):
+        if val is not None and not callable(val):
+            raise ValueError("buffer_allocator must be callable or None.")
+        if self.__acquiring:
+            raise RuntimeError("Cannot change buffer_allocator while acquiring.")
+        self.__buffer_allocator = val
+
+        # Pooled arrays came from the old allocator, start over.
+        if self.__buffer_pool is not None:
+            self.__buffer_pool = BufferPool(val)
+
+    @property
+    def reuse_buffers(self):
+        """Reuse the run buffers across runs with the same layout instead of allocating them for every run."""
+        return self.__buffer_pool is not None
+
+    @reuse_buffers.setter
+    def reuse_buffers(self,val):
+        if val != True and val != False:
+            raise ValueError("reuse_buffers needs to be either True or False.")
+        if self.__acquiring:
+            raise RuntimeError("Cannot change reuse_buffers while acquiring.")
+
+        if not val:
+            self.__buffer_pool = None
+        elif self.__buffer_pool is None:
+            self.__buffer_pool = BufferPool(self.__buffer_allocator)
+
+    @property
+    def buffer_pool(self):
+        """The BufferPool in use (for its hit/miss counters), None without reuse_buffers."""
+        return self.__buffer_pool
+
+    @property
+    def memmap_dir(self):
+        """Directory in which the run buffers are memory-mapped (see MemmapAllocator), None when they are kept in RAM."""
+        if isinstance(self.__buffer_allocator,MemmapAllocator):
+            return self.__buffer_allocator.directory
+        return None
+
+    @memmap_dir.setter
+    def memmap_dir(self,val):
+        self.buffer_allocator = MemmapAllocator(val) if val else None
+
+    @property
+    def buffer(self):
+        """The buffer of the run in progress (see __generate_buffer), None when not acquiring. Treat as read-only."""
+        return self.__buffer
+
+    @property
+    def trigger_spin_time(self):
+        """Time (s) the trigger wait polls the device without sleeping, before it starts backing off."""
+        return self.__trigger_poll.spin_time
+
+    @trigger_spin_time.setter
+    def trigger_spin_time(self,val):
+        if not isinstance(val,(int,float)):
+            raise ValueError("trigger_spin_time must be a number.")
+        self.__trigger_poll.spin_time = val
+
+    @property
+    def trigger_poll_interval(self):
+        """Longest interval (s) between two trigger polls, reached after backing off."""
+        return self.__trigger_poll.max_interval
+
+    @trigger_poll_interval.setter
+    def trigger_poll_interval(self,val):
+        if not isinstance(val,(int,float)):
+            raise ValueError("trigger_poll_interval must be a number.")
+        self.__trigger_poll.max_interval = val
+
+    @property
+    def settings_cache(self):
+        """The SettingsCache the device settings are read through, with its hit/miss counters."""
+        return self._settings_cache
+
+    def snapshot_settings(self):
+        """Read all settings that are not cached yet. Done when a run is armed."""
+        DaqConfig.to_dict(self)
+        VelEncConfig.to_dict(self)
+        MiscConfig.to_dict(self)
+
+    def refresh_settings(self):
+        """Read all settings from the device again, for when they were changed elsewhere (front panel, other software)."""
+        self._settings_cache.refresh()
+        self.snapshot_settings()
+
+    @property
+    def capabilities(self):
+        """The CapabilityCache of the connection: available items and ranges of the settings, with hit/miss counters."""
+        return self._capabilities
+
+    def sweep_capabilities(self):
+        """Read the available items and ranges of all settings in one go, instead of on first use."""
+        for method in list(self.SETTING_ITEMS.values())+list(self.SETTING_RANGES.values()):
+            getattr(self,method)()
+
+    def save_capabilities(self,filename,identity=None):
+        """Save the capabilities to the JSON file filename, under identity (default: device_identity). Sweeps first."""
+        self.sweep_capabilities()
+        self._capabilities.save(filename,self.__identity(identity))
+
+    def load_capabilities(self,filename,identity=None):
+        """Load capabilities saved by save_capabilities. Returns False when there are none for this device."""
+        return self._capabilities.load(filename,self.__identity(identity))
+
+    def __identity(self,identity):
+        identity = identity if identity is not None else self.device_identity
+        if identity is None:
+            raise ValueError("No device identity, set device_identity or pass one.")
+        return identity
+
+    @property
+    def telemetry(self):
+        """Telemetry of the current (or last) run, see Telemetry. Only recorded when telemetry_enabled is set."""
+        return self.__telemetry
+
+    @property
+    def telemetry_enabled(self):
+        return self.__telemetry.enabled
+
+    @telemetry_enabled.setter
+    def telemetry_enabled(self,val):
+        if not isinstance(val,bool):
+            raise ValueError("telemetry_enabled must be a bool.")
+        self.__telemetry.enabled = val
+
+    def telemetry_snapshot(self):
+        """Telemetry.snapshot() of the current (or last) run, as a plain dict."""
+        return self.__telemetry.snapshot()
 
     # Relevant configuration settings from daq config for acquisition.
     """
@@ -176,41 +549,160 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
         """Calculate the factor stemming from sampling frequency."""
         return self.daq_sample_rate // self.daq_base_sample_rate
 
+    def __allocate(self,ch_name,kind,shape,dtype):
+        """Allocate a zeroed run buffer array, through buffer_allocator if one is set. Pooled arrays are not zeroed."""
+        if self.__buffer_pool is not None:
+            return self.__buffer_pool(ch_name,kind,shape,dtype)
+        if self.__buffer_allocator is None:
+            return np.zeros(shape,dtype=dtype)
+        return self.__buffer_allocator(ch_name,kind,shape,dtype)
+
     def __generate_buffer(self,output=False):
         """Generated buffers in the "Samples" area of the provided active channels of get_active_channels."""
         active_channels = self.__get_active_channels()
+
+        # When streaming, finished blocks are copied to the writer, so a single row is reused for every block. Same when
+        # accumulating, a block is only needed until it has been added to the statistics.
+        rows = 1 if self.__stream or self.__accumulate else self.block_count
+
+        self.__overrange_scratch = dict()
+        self.__sample_scratch    = dict()
+        self.__window_index      = dict()
+
+        if self.__capture_windows is not None:
+            sample_rate, base_sample_rate, pre_trigger = self.daq_sample_rate, self.daq_base_sample_rate, self.pre_post_trigger
+
         for ch_type,channel in active_channels.items():
             freq_factor = 1 if channel["Type"] == ChannelType.RSSI else self.__freq_factor()
+            num_samples = self.block_size*freq_factor
+
+            # A filtered channel only keeps the decimated samples, which are no longer integers.
+            online_filter = self.__filters.get(ch_type)
+            active_channels[ch_type]["Filter"] = online_filter
+            if online_filter is not None:
+                online_filter.reset()
+                num_samples = online_filter.output_count(num_samples)
+
+            # Which samples of the block are kept. The full block is collected in a scratch row.
+            windows = None
+            if self.__capture_windows is not None:
+                if channel["Type"] == ChannelType.RSSI:
+                    windows = self.__window_ranges(num_samples,base_sample_rate,pre_trigger//self.__freq_factor())
+                else:
+                    windows = self.__window_ranges(num_samples,sample_rate,pre_trigger,
+                                                   online_filter.decimation if online_filter is not None else 1)
+                self.__window_index[ch_type] = np.concatenate([np.arange(start,stop) for start,stop in windows])
+            active_channels[ch_type]["Windows"] = windows
+            full_samples = num_samples
+            if windows is not None:
+                num_samples = len(self.__window_index[ch_type])
 
             if channel["Unit"] == "bool":
                 data_type = bool # 1 byte
+            elif online_filter is not None:
+                data_type = np.float32
             else:
-                data_type = int # 4 bytes (=32bit)
+                data_type = np.int32 # 4 bytes (=32bit), same width as get_int32_data
 
-
-            active_channels[ch_type]["Samples"] = np.zeros((self.block_count,self.block_size*freq_factor),dtype=data_type)
+            active_channels[ch_type]["Samples"] = self.__allocate(ch_type,"Samples",(rows,num_samples),data_type)
+            active_channels[ch_type]["OverrangePacked"] = False
+            if windows is not None:
+                self.__sample_scratch[ch_type] = np.zeros(full_samples,dtype=data_type)
             
             # If this is a measurement channel, also create the overrange array.
             if channel["Type"] in [ChannelType.Velocity, ChannelType.Displacement, ChannelType.Acceleration]:
-                active_channels[ch_type]["Overrange"] = np.zeros((self.block_count,self.block_size*freq_factor),dtype=bool)
+                if self.__pack_overrange:
+                    # The device hands out overrange per chunk, which need not line up with bytes. So we collect a block in
+                    # a single bool row and pack it when the block is done.
+                    active_channels[ch_type]["Overrange"] = self.__allocate(ch_type,"Overrange",(rows,(num_samples+7)//8),np.uint8)
+                    active_channels[ch_type]["OverrangePacked"] = True
+                else:
+                    active_channels[ch_type]["Overrange"] = self.__allocate(ch_type,"Overrange",(rows,num_samples),bool)
+
+                if self.__pack_overrange or windows is not None:
+                    self.__overrange_scratch[ch_type] = np.zeros(full_samples,dtype=bool)
 
         self.__buffer = active_channels
 
+        if self.__accumulate:
+            self.__statistics = dict()
+            for ch_name,channel in active_channels.items():
+                self.__statistics[ch_name] = {key: channel[key] for key in ["Type","ID","ScaleFactor","Unit","Filter","Windows"]}
+                self.__statistics[ch_name]["Statistics"] = RunningStatistics(channel["Samples"].shape[1],
+                        envelope=self.__accumulate_envelope,overrange=channel["Overrange"] is not None,
+                        dtype=channel["Samples"].dtype)
+        else:
+            self.__statistics = None
+
         if output:
             return self.__buffer
     
-    def start_acq(self,block=False):
-        """Start the acquisition. Call after all settings are set. When block is true, will pause until ready for data."""
+    def __window_ranges(self,num_samples,sample_rate,pre_trigger,decimation=1):
+        """Sample ranges [start, stop) of the capture windows in a block of num_samples (stored) samples. Sample i is at
+        (i*decimation - pre_trigger)/sample_rate s from the trigger. Overlapping windows are merged."""
+        ranges = []
+        for start,stop in sorted(self.__capture_windows):
+            # The small margin keeps rounding errors from shifting a window that starts exactly on a sample.
+            first = int(np.clip(np.ceil((start*sample_rate + pre_trigger)/decimation - 1e-9),0,num_samples))
+            last  = int(np.clip(np.ceil((stop*sample_rate + pre_trigger)/decimation - 1e-9),0,num_samples))
+
+            if last <= first:
+                continue
+            if len(ranges) > 0 and first <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1],last)
+            else:
+                ranges.append([first,last])
+
+        if len(ranges) == 0:
+            raise ValueError(f"None of the capture windows {self.__capture_windows} overlaps with the block.")
+
+        return np.array(ranges,dtype=np.int64)
+
+    def start_acq(self,block=False,timeout=None):
+        """Start the acquisition. Call after all settings are set. When block is true, will pause until ready for data, at most
+        timeout (s), then raises TimeoutError. The acquisition stays armed, call stop_acq() to give up on it: the run ends
+        without keeping any data, and the next start_acq() arms a new one."""
+        # A stopped run may still be winding down, it has to be over before the next one is armed.
+        if not self.__acquiring:
+            self.__idle_event.wait()
+
+        self.__stop_event.clear()
         self.__acquiring = True
 
-        if block:
-            while not self.__ready_for_data:
-                sleep(0.1)
+        # Start the acq thread, on the first run.
+        if self.__acquisition_thread is None:
+            self.__acquisition_thread = Thread(target = self.__acquisition_loop)
+            self.__acquisition_thread.start()
+        self.__start_event.set()
+
+        if block and not self.__ready_for_data.wait(timeout):
+            raise TimeoutError(f"Not ready for data within {timeout} s.")
     
+    def add_ready_callback(self,callback):
+        """Call callback() once, from the acquisition thread, as soon as the device is ready for data. Called right away when it
+        already is. Meant for code that cannot block on start_acq, callback must not block either."""
+        with self.__ready_lock:
+            if not self.__ready_for_data.is_set():
+                self.__ready_callbacks.append(callback)
+                return
+
+        callback()
+
+    def remove_ready_callback(self,callback):
+        """Forget a callback added with add_ready_callback that was not called yet."""
+        with self.__ready_lock:
+            self.__ready_callbacks = [cb for cb in self.__ready_callbacks if cb is not callback]
+
     def stop_acq(self):
-        """Stop the acquisition. Some stuff to deal with the acquisition being ended prematurely."""
+        """Stop the acquisition. Some stuff to deal with the acquisition being ended prematurely. Returns once the run is over
+        and the block consumers heard so, the run keeps no data."""
         if self.__acquiring:
             self.__acquiring = False
+            self.__stop_event.set()
+
+            # Not from a block callback, the acquisition thread cannot wait for itself.
+            if current_thread() is not self.__acquisition_thread:
+                self.__idle_event.wait()
             return False
         else:
             return True
@@ -219,7 +711,8 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
     def __acquisition_loop(self):
         while self.__acq_loop:
             while (not self.__acquiring) and (self.__acq_loop):
-                sleep(0.1)
+                self.__start_event.wait()
+                self.__start_event.clear()
 
             if not self.__acq_loop:
                 print("Dropping out of acq loop.")
@@ -229,103 +722,413 @@ class Vibrometer(DaqConfig, VelEncConfig, MiscConfig, HDF5Writer):
             if not self.__buffer == None:
                 raise RuntimeError("Buffer was defined before acquisition started. This should not be possible.")
 
-            self.__generate_buffer()
+            # The run may have been stopped before we got here. Cleared before looking, so stop_acq() either finds it cleared
+            # and waits for the run to end, or the stop is seen here.
+            self.__idle_event.clear()
+            if not self.__acquiring:
+                self.__idle_event.set()
+                continue
+
+            started = completed = False
+            stream  = None
+            try:
+                # Settings are read once per run, from here on the loop and write_data are served from the cache.
+                self.snapshot_settings()
+
+                if self.__acquisition is None:
+                    self.__acquisition = DataAcquisition(self.__communication,10000000)
+
+                self.__generate_buffer()
+                self.__telemetry.reset()
+                self.__lost_samples = LostSampleIndex()
+
+                # The streaming writer opens its file in its own thread, we only tell it what the channels look like.
+                stream = self.__stream
+                if stream:
+                    stream.start(self.__buffer)
+
+                ## Do we want to auto af? If so, do a blocking AF
+                if self.__auto_af:
+                    self.autofocus(block=True)
+
+                ## Start data acquisition
+                self.__acquisition.start_data_acquisition()
+                started = True
+                with self.__ready_lock:
+                    self.__ready_for_data.set()
+                    ready_callbacks, self.__ready_callbacks = self.__ready_callbacks, []
+
+                for callback in ready_callbacks:
+                    callback()
+
+                print("Ready for data.")
+
+                completed = self.__acquire_blocks(stream)
+            except Exception:
+                # A failed run does not take the acquisition thread down with it, the next start_acq() arms a new one.
+                traceback.print_exc()
+            finally:
+                # Whatever happens, the streaming writer gets to finish the blocks it already has.
+                if stream:
+                    stream.close()
+                    self.__last_stream = stream
+                    self.__stream = None
+
+                # Stopped or failed runs end here too, so the next start_acq() finds everything as before the run.
+                try:
+                    self.__end_run(started,completed,stream is not None)
+                finally:
+                    self.__idle_event.set()
+
+            if not completed:
+                print("Acquisition halted prematurely, no data will be saved.")
+
+    def __end_run(self,started,completed,streamed):
+        """Wrap up a run, however it ended. The device stops acquiring, a completed run goes to write_data and the block
+        consumers hear that the run is over. Nothing of a run that was stopped (or failed) is kept."""
+        # Let's tell the device it can stop acquiring.
+        if started:
+            self.__acquisition.stop_data_acquisition()
+            self.__telemetry.end_run()
+
+        ## Do the acquisition thing.
+        # This comes down to:
+        # x Reserve memory (dict with numpy arrays in it)
+        # x Start the acquisition
+        # x Wait for the trigger
+        # x As data comes in, write it to memory (Maybe the lib already does this? Don't know, we'll handle it here.)
+        #   - As for structuring the buffer: Each channel can have a different sample rate (DaqRate / DaqBaseRate)
+        #     so we will store the data as ... / <channelname> / <number of block>
+
+        # The above is slightly outdated but leaving it there for now
+
+        # Set the buffer back to None. Set acquiring to false.
+        # A streamed run is already on disk and an accumulated run is in the statistics, the single reused row is of no
+        # use to write_data.
+        single_row = streamed or self.__statistics is not None
+        if completed:
+            self.__data = None if single_row else self.__buffer
+        if self.__buffer is not None and not (completed and not single_row):
+            self.release_data(self.__buffer)
+        if not completed:
+            self.__statistics = None
+        self.__buffer = None
+        self.__acquiring = False
+        self.__ready_for_data.clear()
+
+        # Only now, so whoever listens for the end of the run finds the data in place.
+        self.__dispatcher.end_run()
+
+    def __acquire_blocks(self,stream=None):
+        """Main acquisition/data storage loop. Inspired by __acquire_data_to_csv from acquire_to_csv. Returns False when the
+        acquisition was stopped before all blocks were in."""
+        # Without telemetry the device calls go straight through, nothing gets timed.
+        telemetry = self.__telemetry if self.__telemetry.enabled else None
+        timed     = telemetry.timed if telemetry else untimed
+
+        # The settings cannot change during the run.
+        freq_factor  = self.__freq_factor()
+        block_size   = self.block_size
+        trigger_mode = self.trigger_mode
+
+        # Loop over blocks.
+        for block_id in range(self.block_count):
+            #print(f"Entering block {block_id}.")
+
+            if not self.__acquiring:
+                return False
+
+            # Streaming and accumulate runs reuse a single buffer row.
+            row = 0 if stream or self.__statistics is not None else block_id
+
+            #print("Waiting for trigger.")
+            wait_start = perf_counter()
+            if not wait_for_trigger(self.__acquisition, trigger_mode, self.__trigger_poll, self.__stop_event):
+                return False
+            trigger_time = perf_counter()
+            if telemetry:
+                telemetry.record_trigger_wait(block_id,trigger_time-wait_start)
+            #print("Past wait for trigger.")
+        
+            for channel in self.__buffer.values():
+                if channel["Filter"] is not None:
+                    channel["Filter"].start_block()
+
+            # Polytec pulls the data off the device in chunks. I don't really see the need, but we'll mimick it.
+            samples_this_block = 0
+            while samples_this_block < block_size:
+                # Debug thing
+                #print(f"Block {block_id}, Samples: {samples_this_block}/{block_size}.")
+
+
+                # Read the chunk size, or at most what we still have to buffer
+                read_this_loop = min(block_size - samples_this_block, self.__chunk_size)
+
+                if telemetry:
+                    telemetry.record_fill(self.__acquisition.available_samples())
+
+                # Blocks until timeout is reached. read_this_loop in base sample frequency
+                timed("read_data",self.__acquisition.read_data,read_this_loop,self.__acq_timeout)
+
+                # Fetch the data and write it to buffer
+                for ch_name,channel in self.__buffer.items():
+                    start_index = samples_this_block if channel["Type"] == ChannelType.RSSI else freq_factor*samples_this_block
+                    sample_count = timed("extracted_sample_count",self.__acquisition.extracted_sample_count,channel["Type"],channel["ID"])
+
+                    # With capture windows the full block goes into the scratch row first.
+                    samples_row = self.__sample_scratch[ch_name] if ch_name in self.__sample_scratch else channel["Samples"][row]
+
+                    # Here we differ from the example code, writing it directly into the numpy array.
+                    online_filter = channel["Filter"]
+                    if online_filter is None:
+                        samples_row[start_index:start_index+sample_count] = \
+                                timed("get_int32_data",self.__acquisition.get_int32_data,channel["Type"],channel["ID"],sample_count)
+                    else:
+                        # Filtered channels store the decimated output, the filter works out where it goes in the row.
+                        online_filter.process(timed("get_int32_data",self.__acquisition.get_int32_data,channel["Type"],
+                                                    channel["ID"],sample_count),start_index,samples_row)
+                    if telemetry:
+                        telemetry.record_samples(sample_count,sample_count*self.__buffer[ch_name]["Samples"].itemsize)
+
+                    # If we are on a "measurement" channel, register overrange too
+                    if channel["Type"] in [ChannelType.Velocity, ChannelType.Displacement, ChannelType.Acceleration]:
+                        if ch_name in self.__overrange_scratch:
+                            overrange_row = self.__overrange_scratch[ch_name]
+                        else:
+                            overrange_row = channel["Overrange"][row]
+
+                        overrange = timed("get_overrange",self.__acquisition.get_overrange,channel["Type"],channel["ID"],sample_count)
+                        if online_filter is None:
+                            overrange_row[start_index:start_index+sample_count] = overrange
+                        else:
+                            online_filter.process_flags(overrange,start_index,overrange_row)
+                    elif channel["Type"] == ChannelType.DataValidity:
+                        # Polytec raises on the first lost packet, sample by sample. We check the chunk in one go and keep track.
+                        valid = samples_row[start_index:start_index+sample_count]
+                        if not valid.all():
+                            lost = lost_sample_ranges(valid,start_index)
+                            self.__lost_samples.add(block_id,lost)
+                            if telemetry:
+                                telemetry.record_lost(block_id,int(np.sum(lost[:,1]-lost[:,0])))
+
+                # Here Polytec goes on to write the chunks to csv, but we don't do that.
+                # (also, why do they do that? I/O during data acq is a big no-no)
+                # We do need to update the number of samples written this block.
+                # Note that we update with read_this_loop, since we're tracking the base sample rate.
+                samples_this_block += read_this_loop
+
+            # Go to the next data block
+            timed("next_data_acquisition_block",self.__acquisition.next_data_acquisition_block)
+
+            # Cut the capture windows out of the block. The lost samples were found in the full block, so they move along.
+            for ch_name,samples_row in self.__sample_scratch.items():
+                np.take(samples_row,self.__window_index[ch_name],out=self.__buffer[ch_name]["Samples"][row])
+                if self.__buffer[ch_name]["Type"] == ChannelType.DataValidity:
+                    self.__lost_samples.to_windows(block_id,self.__buffer[ch_name]["Windows"])
+
+            # Same for the overrange flags, and pack them if requested.
+            overrange_flags = dict()
+            for ch_name,overrange_row in self.__overrange_scratch.items():
+                flags = overrange_row[self.__window_index[ch_name]] if ch_name in self.__window_index else overrange_row
+                if self.__buffer[ch_name]["OverrangePacked"]:
+                    self.__buffer[ch_name]["Overrange"][row] = np.packbits(flags)
+                else:
+                    self.__buffer[ch_name]["Overrange"][row] = flags
+                overrange_flags[ch_name] = flags
+
+            if self.__statistics is not None:
+                for ch_name,channel in self.__buffer.items():
+                    if ch_name in overrange_flags:
+                        overrange = overrange_flags[ch_name]
+                    else:
+                        overrange = channel["Overrange"][row] if channel["Overrange"] is not None else None
+                    self.__statistics[ch_name]["Statistics"].update(channel["Samples"][row],overrange)
+
+            # Hand the finished block to the streaming writer and the block consumers. Neither waits on anyone.
+            if stream or self.__dispatcher.active:
+                # When streaming or accumulating the row gets reused for the next block, so everyone gets a copy instead of a view.
+                blocks = self.__block_rows(row,copy=stream is not None or self.__statistics is not None)
+
+                lost_ranges = self.__lost_samples.ranges(block_id)
+
+                if stream:
+                    stream.put_block(block_id,blocks,lost_ranges)
+
+                if self.__dispatcher.active:
+                    packed = [ch_name for ch_name,channel in self.__buffer.items() if channel["OverrangePacked"]]
+                    self.__dispatcher.publish(Block(block_id,{ch_name: rows[0] for ch_name,rows in blocks.items()},
+                                                    {ch_name: rows[1] for ch_name,rows in blocks.items()},packed,trigger_time,
+                                                    lost_ranges))
+
+        return True
+
+    def __block_rows(self,row,copy=False):
+        """The (samples, overrange) rows of all channels for a single buffer row, as views unless copy is True."""
+        blocks = dict()
+        for ch_name,channel in self.__buffer.items():
+            samples   = channel["Samples"][row]
+            overrange = channel["Overrange"][row] if channel["Overrange"] is not None else None
+
+            if copy:
+                samples   = samples.copy()
+                overrange = overrange.copy() if overrange is not None else None
+
+            blocks[ch_name] = (samples,overrange)
+
+        return blocks
 
-            ## Do we want to auto af? If so, do a blocking AF
-            if self.__auto_af:
-                self.autofocus(block=True)
+    ### Data storage related functions, insofar they're not in the HDF5Writer class.
+    def write_data(self,filename,_dict=dict(),overwrite=False):
+        """Write data to the disk. After an accumulate run, the statistics are written instead of the blocks."""
+        if self.__data == None and self.__statistics == None:
+            raise Exception("No data available for writing.")
 
-            ## Start data acquisition
-            self.__acquisition.start_data_acquisition()
-            self.__ready_for_data = True
+        _dict["vibrometer"] = self.to_dict()
 
-            print("Ready for data.")
+        self.write_run(filename,_dict,self.__data,self.__statistics,self.__lost_samples,overwrite)
 
-            ## Main acquisition/data storage loop. Inspired by __acquire_data_to_csv from acquire_to_csv.
-            # Loop over blocks.
-            for block_id in range(self.block_count):
-                #print(f"Entering block {block_id}.")
+        # Dereference the data point and garbage coll. will get it. Pooled buffers go back to the pool.
+        if self.__data is not None:
+            self.release_data(self.__data)
+            self.__data = None
 
-                if not self.__acquiring:
-                    raise Exception("Acquisition halted prematurely, no data will be saved.")
+    def write_data_async(self,filename,_dict=dict(),overwrite=False,timeout=None):
+        """Like write_data, but the file is written by a writer thread (see HDF5BackgroundWriter), so the next run can be
+        acquired while this one is written. Returns a concurrent.futures.Future, done once the file is written and fsynced.
 
-                freq_factor = self.__freq_factor()
-                block_size  = self.block_size
-                
-                #print("Waiting for trigger.")
-                wait_for_trigger(self.__acquisition, self.trigger_mode)
-                #print("Past wait for trigger.")
-            
-                # Polytec pulls the data off the device in chunks. I don't really see the need, but we'll mimick it.
-                samples_this_block = 0
-                while samples_this_block < block_size:
-                    # Debug thing
-                    #print(f"Block {block_id}, Samples: {samples_this_block}/{block_size}.")
+        The data is handed over to the writer, like take_data, and released once it is written. When writing fails, the
+        exception of the future carries the data as its data attribute, to write it elsewhere. Metadata and compression are
+        taken at this point. Files are written in the order they were queued. When write_queue_size runs are already waiting,
+        this blocks until one is written, at most timeout (s), then raises queue.Full. See flush_writes() to wait for all, and
+        close() to stop the writer when done."""
+        if self.__data == None and self.__statistics == None:
+            raise Exception("No data available for writing.")
 
+        # Copied, the caller may well change the dicts for the next run before this one is written.
+        metadata = {key: dict(value) for key,value in _dict.items()}
+        metadata["vibrometer"] = self.to_dict()
 
-                    # Read the chunk size, or at most what we still have to buffer
-                    read_this_loop = min(block_size - samples_this_block, self.__chunk_size)
+        if self.__background_writer is None:
+            self.__background_writer = HDF5BackgroundWriter(self.__write_queue_size)
 
-                    # Blocks until timeout is reached. read_this_loop in base sample frequency
-                    self.__acquisition.read_data(read_this_loop, self.__acq_timeout)
+        future = self.__background_writer.put(filename,metadata,self.__data,self.__statistics,self.__lost_samples,overwrite,
+                                              self.compression,self.release_data,timeout)
+        self.__data = None
+        return future
 
-                    # Fetch the data and write it to buffer
-                    for ch_name,channel in self.__buffer.items():
-                        start_index = samples_this_block if channel["Type"] == ChannelType.RSSI else freq_factor*samples_this_block
-                        sample_count = self.__acquisition.extracted_sample_count(channel["Type"], channel["ID"])
+    def flush_writes(self):
+        """Wait until all runs handed to write_data_async() are written."""
+        if self.__background_writer is not None:
+            self.__background_writer.flush()
 
-                        # Here we differ from the example code, writing it directly into the numpy array.
-                        self.__buffer[ch_name]["Samples"][block_id, start_index:start_index+sample_count] = \
-                                self.__acquisition.get_int32_data(channel["Type"],channel["ID"],sample_count)
+    @property
+    def pending_writes(self):
+        """Number of runs handed to write_data_async() that are not written yet."""
+        return self.__background_writer.pending if self.__background_writer is not None else 0
 
-                        # If we are on a "measurement" channel, register overrange too
-                        if channel["Type"] in [ChannelType.Velocity, ChannelType.Displacement, ChannelType.Acceleration]:
-                            self.__buffer[ch_name]["Overrange"][block_id, start_index:start_index+sample_count] = \
-                                    self.__acquisition.get_overrange(channel["Type"],channel["ID"],sample_count)
+    @property
+    def write_queue_size(self):
+        """Maximum number of runs waiting for write_data_async() to write them. Every run holds its buffers until written."""
+        return self.__write_queue_size
 
-                    # Here Polytec goes on to write the chunks to csv, but we don't do that.
-                    # (also, why do they do that? I/O during data acq is a big no-no)
-                    # We do need to update the number of samples written this block.
-                    # Note that we update with read_this_loop, since we're tracking the base sample rate.
-                    samples_this_block += read_this_loop
+    @write_queue_size.setter
+    def write_queue_size(self,val):
+        if not isinstance(val,int) or val < 1:
+            raise ValueError("write_queue_size must be a positive int.")
 
-                # Go to the next data block
-                self.__acquisition.next_data_acquisition_block()
-    
+        # The queue size is fixed once the writer thread runs, so a new one is started on the next write_data_async().
+        if self.__background_writer is not None:
+            self.__background_writer.close()
+            self.__background_writer = None
+        self.__write_queue_size = val
 
-            # The above should wrap up the main acquisition loop. We haven't stored any data yet.
-            # Let's tell the device it can stop acquiring.
-            self.__acquisition.stop_data_acquisition()
+    @property
+    def has_data(self):
+        """Is there data of the last run that was not written or taken yet?"""
+        return self.__data is not None
 
-            ## Do the acquisition thing.
-            # This comes down to:
-            # x Reserve memory (dict with numpy arrays in it)
-            # x Start the acquisition
-            # x Wait for the trigger
-            # x As data comes in, write it to memory (Maybe the lib already does this? Don't know, we'll handle it here.)
-            #   - As for structuring the buffer: Each channel can have a different sample rate (DaqRate / DaqBaseRate)
-            #     so we will store the data as ... / <channelname> / <number of block>
+    def take_data(self):
+        """Hand the data of the last run over to the caller, for writing it some other way than write_data. The Vibrometer
+        lets go of it, like after write_data."""
+        if self.__data == None:
+            raise Exception("No data available for writing.")
 
-            # The above is slightly outdated but leaving it there for now
+        data, self.__data = self.__data, None
+        return data
 
-            # Set the buffer back to None. Set acquiring to false.
-            self.__data = self.__buffer
-            self.__buffer = None
-            self.__acquiring = False
-            self.__ready_for_data = False
+    @property
+    def lost_samples(self):
+        """DataValidity.LostSampleIndex of the current (or last) run: which samples of which block were lost. With capture
+        windows, the indices are those of the stored DataValidity samples."""
+        return self.__lost_samples
 
-    ### Data storage related functions, insofar they're not in the HDF5Writer class.
-    def write_data(self,filename,_dict=dict(),overwrite=False):
-        """Write data to the disk."""
-        if self.__data == None:
-            raise Exception("No data available for writing.")
+    def release_data(self,data):
+        """Hand data obtained through take_data back once it has been persisted, so the buffers can be reused by a later run
+        (see reuse_buffers). Do not touch the arrays afterwards. Does nothing without reuse_buffers."""
+        if self.__buffer_pool is not None:
+            self.__buffer_pool.release(data)
+
+    def stream_data(self,filename,_dict=dict(),overwrite=False,swmr=False,flush_interval=0.):
+        """Stream the next run to disk while it is being acquired, instead of holding it in memory until write_data.
+
+        Call before start_acq. Every block is appended to the file by a writer thread as soon as it is complete, the file is
+        readable even if the run is aborted. Metadata is taken at this point, since the file is written from the start.
+
+        The file is flushed after every block, or at most every flush_interval (s). With swmr, other processes can read the
+        flushed blocks while the run is still going, see HDF5Reader.follow."""
+        if self.__acquiring:
+            raise RuntimeError("Cannot set up streaming while acquiring.")
 
         _dict["vibrometer"] = self.to_dict()
 
-        self.open_file(filename,overwrite=overwrite)
-        self.write_channel_data(self.__data)
-        self.write_metadata(_dict)
-        self.close_file()
+        self.__stream = HDF5StreamWriter(filename,_dict,overwrite=overwrite,compression=self.compression,swmr=swmr,
+                                         flush_interval=flush_interval)
+
+    ### Online access to blocks while the acquisition is running.
+    def register_block_callback(self,callback):
+        """Call callback(block) for every finished block, see BlockDispatcher.Block for how long its samples stay valid.
+        Callbacks run in a separate thread; if they cannot keep up, blocks are dropped rather than slowing down the
+        acquisition (see dropped_blocks)."""
+        self.__dispatcher.register_callback(callback)
+
+    def unregister_block_callback(self,callback):
+        self.__dispatcher.unregister_callback(callback)
+
+    def iter_blocks(self,timeout=None,maxsize=None):
+        """Iterate over the finished blocks of the current (or next) run. Ends when the run is over. At most maxsize blocks are
+        kept for a slow consumer, further blocks are dropped (see dropped_blocks). Raises queue.Empty if timeout (s) passes
+        without a new block. The blocks of a regular run are views on its buffer, those of a streaming or accumulate run are
+        copies, see BlockDispatcher.Block."""
+        # Subscribe right away, not on the first next(), or we might miss the first blocks.
+        queue = self.subscribe_blocks(maxsize)
+
+        def block_generator():
+            try:
+                while True:
+                    block = queue.get(timeout=timeout)
+                    if block is BlockDispatcher.END_OF_RUN:
+                        return
+                    yield block
+            finally:
+                self.unsubscribe_blocks(queue)
+
+        return block_generator()
+
+    def subscribe_blocks(self,maxsize=None,queue=None):
+        """Low-level access to the block distribution, see BlockDispatcher.subscribe. Prefer iter_blocks()."""
+        return self.__dispatcher.subscribe(maxsize,queue)
+
+    def unsubscribe_blocks(self,queue):
+        self.__dispatcher.unsubscribe(queue)
 
-        # Dereference the data point and garbage coll. will get it.
-        self.__data = None
+    @property
+    def dropped_blocks(self):
+        """Number of blocks that block callbacks and iter_blocks() consumers missed because they were too slow."""
+        return self.__dispatcher.dropped_blocks
+
+    def wait_for_stream(self,timeout=None):
+        """Block until the streaming writer of the last run has written all blocks and closed its file."""
+        if self.__last_stream is None:
+            raise Exception("No streamed run to wait for.")
+
+        self.__last_stream.join(timeout)
@@ -9,16 +9,17 @@ import time
 
 # JS 2022, commented out
 #from acquisition_control.config import DaqConfig, ConfigurationError, log_config
+from .DaqConfig import DaqConfig, ConfigurationError, log_config
 
-from polytec.io.channel_activation import ChannelActivation
-from polytec.io.data_acquisition import DataAcquisition
-from polytec.io.channel_type import ChannelType
-from polytec.io.device_command import DeviceCommand
-from polytec.io.device_type import DeviceType
-from polytec.io.item_list import ItemList
-from polytec.io.miscellaneous_tag import MiscellaneousTag
+# JS 2022, imported through Backend, so a simulated device can be used instead of the polytec library
+from .Backend import ChannelActivation, DataAcquisition, ChannelType, DeviceCommand, DeviceType, ItemList, \
+        MiscellaneousTag, value_from_quantity_string
 
-from polytec.quantity_conversion import value_from_quantity_string
+# JS 2022, adaptive trigger polling
+from .TriggerPoll import TriggerPoll
+
+# JS 2022, vectorized data validity check
+import numpy as np
 
 
 def __channel_scale_factor_and_unit(communication, data_acquisition, channel_type):
@@ -110,18 +111,24 @@ def __calculate_frequency_factor(communication):
                    / communication.get_int32(DeviceType.SignalProcessing, DeviceCommand.DaqBaseSampleRate))
 
 
-def __wait_for_trigger(data_acquisition, trigger_mode):
+def __wait_for_trigger(data_acquisition, trigger_mode, poll=None, abort_event=None):
     """
     This function blocks until the configured trigger condition (if any) has been satisfied.
 
     Args:
         data_acquisition:   The DataAcquisition instance
         trigger_mode:       The active trigger mode
+        poll:               The TriggerPoll strategy used to query the device (JS 2022, was a fixed 10 ms sleep)
+        abort_event:        Optional threading.Event, setting it ends the wait early
+    Returns:
+        False if the wait was aborted, True otherwise
     """
     if trigger_mode != "None":
         logging.info(f"Waiting for {trigger_mode} trigger...")
-        while data_acquisition.available_samples() == 0:
-            time.sleep(0.01)
+        if poll is None:
+            poll = TriggerPoll()
+        return poll.wait(lambda: data_acquisition.available_samples() != 0, abort_event)
+    return True
 
 
 def __write_csv_headers(csv_file, active_channels):
@@ -155,6 +162,12 @@ def __write_chunk_data_to_csv(csv_file, active_channels, base_sample_count, freq
         chunk_timestamp:    The timestamp of the first sample in this data chunk
         sample_interval:    The time interval between two signal samples
     """
+    # JS 2022: check the data validity of the whole chunk in one numpy pass instead of sample by sample below.
+    for channel in active_channels:
+        if channel["Type"] == ChannelType.DataValidity and \
+                not np.all(channel["Samples"][:base_sample_count * frequency_factor]):
+            raise RuntimeError("Data packet lost")
+
     for base_id in range(base_sample_count):
         for sample_id in range(frequency_factor):
             csv_file.write(f"{chunk_timestamp + (base_id * frequency_factor + sample_id) * sample_interval:.8e}")
@@ -162,12 +175,9 @@ def __write_chunk_data_to_csv(csv_file, active_channels, base_sample_count, freq
             for channel in active_channels:
                 index = base_id if channel["Type"] == ChannelType.RSSI else base_id * frequency_factor + sample_id
 
-                if channel["Type"] == ChannelType.DataValidity:
-                    if not channel["Samples"][index]:
-                        raise RuntimeError("Data packet lost")
-                elif channel["Type"] == ChannelType.Trigger:
+                if channel["Type"] == ChannelType.Trigger:
                     csv_file.write(f";{channel['Samples'][index]}")
-                else:
+                elif channel["Type"] != ChannelType.DataValidity:
                     csv_file.write(f";{channel['ScaleFactor'] * channel['Samples'][index]:.8e}")
                     if channel["Type"] in [ChannelType.Velocity, ChannelType.Displacement, ChannelType.Acceleration]:
                         csv_file.write(f";{channel['Overrange'][index]}")
@@ -274,7 +284,8 @@ def acquire_data(communication, sample_count=None, base_samples_chunk_size=250,
     __test_not_iq_mode(communication)
 
     # Load the data acquisition configuration
-    daq_config = DaqConfig(communication)
+    # JS 2022, DaqConfig only takes over the connection with init_connection
+    daq_config = DaqConfig(communication, init_connection=True)
 
     if daq_config.daq_mode == "Streaming" and sample_count is None:
         raise RuntimeError("No sample count specified. Sample count is mandatory for streaming.")
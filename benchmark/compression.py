@@ -0,0 +1,178 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Size and speed of the compression methods of HDF5Writer (see Compression), to pick settings that shrink the archive without
+# slowing down the turnaround between runs. Per method and channel: the compression ratio, and the write and read throughput
+# (MB/s of raw data) of write_channel_data and of reading all blocks back, the median over --repeats.
+#
+# The traces are generated: a ringing burst after the trigger on top of white noise (--noise, in counts of the 24 bit velocity
+# range), a slowly drifting RSSI, a trigger flag and a few overrange samples per block. The compression ratio depends mostly on
+# the noise level, so use --input to run on the blocks of a recorded file instead. Run from the directory containing the package:
+#
+#   python -m <package>.benchmark.compression [--methods none,gzip-4+shuffle,lzf] [--input run.h5] [--output results.json]
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+
+from shutil import rmtree
+from time import perf_counter
+
+import h5py
+import numpy as np
+
+from ..Compression import Compression
+from ..DataManagement import HDF5Writer
+
+METHODS = ["none","gzip-1","gzip-4","gzip-4+shuffle","gzip-9+shuffle","lzf","lzf+shuffle","bitshuffle"]
+
+
+def generate_traces(block_count,block_size,freq_factor,noise,seed=0):
+    """channel_data as from Vibrometer.generate_buffers, with generated traces."""
+    rng     = np.random.default_rng(seed)
+    samples = block_size*freq_factor
+
+    # Ringing burst from 10% into the block, with a random amplitude per block.
+    t         = np.arange(samples)-samples//10
+    burst     = np.where(t >= 0,np.exp(-t/(samples/8))*np.sin(2*np.pi*t/200),0.)
+    amplitude = 2**18*rng.uniform(0.5,1.,(block_count,1))
+    velocity  = np.round(amplitude*burst+noise*rng.standard_normal((block_count,samples))).astype(np.int32)
+
+    rssi = np.round(2**16*(0.7+0.05*np.sin(np.linspace(0,np.pi,block_size))+0.005*rng.standard_normal((block_count,block_size))))
+
+    trigger = np.zeros((block_count,samples),dtype=bool)
+    trigger[:,samples//10:samples//10+freq_factor*10] = True
+
+    overrange = np.zeros((block_count,samples),dtype=bool)
+    overrange[rng.integers(block_count,size=block_count//10),rng.integers(samples,size=block_count//10)] = True
+
+    def channel(unit,scalefactor,data,overrange=None):
+        return {"Type": None, "ID": 0, "ScaleFactor": scalefactor, "Unit": unit, "Samples": data, "Overrange": overrange}
+
+    return {"Velocity": channel("m/s",1/2**23,velocity,overrange),
+            "RSSI":     channel("V",1/2**16,rssi.astype(np.int32)),
+            "Trigger":  channel("bool",1,trigger)}
+
+def load_traces(filename,block_count=None):
+    """channel_data with the blocks of a file written by HDF5Writer."""
+    from ..HDF5Reader import HDF5Reader
+
+    channel_data = dict()
+    with HDF5Reader(filename) as reader:
+        count = reader.block_count if block_count is None else min(block_count,reader.block_count)
+        for ch_name in reader:
+            if not isinstance(reader[ch_name],h5py.Group) or "scalefactor" not in reader[ch_name]:
+                continue
+
+            has_overrange = "overrange" in reader[ch_name]
+            channel_data[ch_name] = {"Type": None, "ID": reader[f"{ch_name}/ID"][()], "Unit": reader[f"{ch_name}/unit"][()].decode(),
+                                     "ScaleFactor": reader[f"{ch_name}/scalefactor"][()],
+                                     "Samples": reader.blocks(ch_name,0,count),
+                                     "Overrange": np.array([reader.overrange(ch_name,num) for num in range(count)])
+                                                  if has_overrange else None}
+
+    return channel_data
+
+def raw_bytes(channel):
+    return channel["Samples"].nbytes+(channel["Overrange"].nbytes if channel["Overrange"] is not None else 0)
+
+def stored_bytes(ch_grp):
+    return sum(dataset.id.get_storage_size() for dataset in ch_grp.values() if isinstance(dataset,h5py.Dataset))
+
+
+def benchmark_method(method,channel_data,directory,repeats):
+    writer = HDF5Writer()
+    writer.set_compression(Compression.from_string(method))
+    filename = os.path.join(directory,f"{method}.h5")
+
+    write_times, read_times = {ch_name: [] for ch_name in channel_data}, {ch_name: [] for ch_name in channel_data}
+    for _ in range(repeats):
+        writer.open_file(filename,overwrite=True)
+        for ch_name,channel in channel_data.items():
+            start = perf_counter()
+            writer.write_channel_data({ch_name: channel})
+            write_times[ch_name].append(perf_counter()-start)
+        writer.close_file()
+
+        # Read back the way HDF5Reader does, a chunk row at a time.
+        with h5py.File(filename,"r") as read_file:
+            for ch_name in channel_data:
+                start = perf_counter()
+                for name in ["blocks","overrange"]:
+                    if name in read_file[ch_name]:
+                        dataset = read_file[ch_name][name]
+                        for row in range(0,dataset.shape[0],dataset.chunks[0]):
+                            dataset[row:row+dataset.chunks[0]]
+                read_times[ch_name].append(perf_counter()-start)
+
+    result = {"method": method, "file_bytes": os.path.getsize(filename), "channels": dict()}
+    with h5py.File(filename,"r") as read_file:
+        for ch_name,channel in channel_data.items():
+            size = raw_bytes(channel)
+            result["channels"][ch_name] = {"raw_bytes": size, "stored_bytes": stored_bytes(read_file[ch_name]),
+                                           "ratio": size/stored_bytes(read_file[ch_name]),
+                                           "write_mb_per_second": size/2**20/float(np.median(write_times[ch_name])),
+                                           "read_mb_per_second":  size/2**20/float(np.median(read_times[ch_name]))}
+
+    total = sum(raw_bytes(channel) for channel in channel_data.values())
+    result["ratio"]               = total/sum(channel["stored_bytes"] for channel in result["channels"].values())
+    result["write_mb_per_second"] = total/2**20/sum(float(np.median(times)) for times in write_times.values())
+    result["read_mb_per_second"]  = total/2**20/sum(float(np.median(times)) for times in read_times.values())
+    return result
+
+
+def available(method):
+    try:
+        Compression.from_string(method)
+    except ImportError:
+        return False
+    return True
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "h5py": h5py.__version__,
+            "hdf5": h5py.version.hdf5_version, "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+def report(result):
+    channels = "   ".join(f"{ch_name} x{channel['ratio']:6.2f}" for ch_name,channel in result["channels"].items())
+    print(f"{result['method']:<16} x{result['ratio']:6.2f}   write {result['write_mb_per_second']:8.1f} MB/s   "
+          f"read {result['read_mb_per_second']:8.1f} MB/s   {channels}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compression ratio and throughput of the HDF5Writer compression methods.")
+    parser.add_argument("--methods",default=",".join(METHODS),help="comma separated, as Compression.from_string")
+    parser.add_argument("--input",help="take the blocks from this file (written by HDF5Writer) instead of generating them")
+    parser.add_argument("--block-count",type=int,default=200)
+    parser.add_argument("--block-size",type=int,default=40000)
+    parser.add_argument("--freq-factor",type=int,default=2)
+    parser.add_argument("--noise",type=float,default=2**10,help="standard deviation of the velocity noise (counts)")
+    parser.add_argument("--repeats",type=int,default=3)
+    parser.add_argument("--output",help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.input:
+        channel_data = load_traces(args.input,args.block_count)
+    else:
+        channel_data = generate_traces(args.block_count,args.block_size,args.freq_factor,args.noise)
+
+    methods = [method for method in args.methods.split(",") if available(method)]
+    for method in sorted(set(args.methods.split(","))-set(methods)):
+        print(f"Skipping {method}, hdf5plugin is not installed.")
+
+    directory = tempfile.mkdtemp(prefix="compression_")
+    results = []
+    try:
+        for method in methods:
+            results.append(benchmark_method(method,channel_data,directory,args.repeats))
+            report(results[-1])
+    finally:
+        rmtree(directory,ignore_errors=True)
+
+    if args.output:
+        with open(args.output,"w") as output:
+            json.dump({"environment": environment(), "input": args.input or vars(args), "results": results},output,indent=1)
+
+
+if __name__ == "__main__":
+    main()
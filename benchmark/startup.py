@@ -0,0 +1,159 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Startup cost of the package for tools that only do a little: import Vibrometer, create one and read a setting; or only open
+# an HDF5Reader. Also how long the first start_acq takes, since that is where the DataAcquisition and the acquisition thread
+# are set up now. Every measurement runs in a fresh interpreter, so nothing is imported or cached yet, against the simulated
+# device with command_latency standing in for the network round-trip. Run from the directory containing the package:
+#
+#   python -m <package>.benchmark.startup [--latency 0.002] [--repeats 5] [--output results.json]
+
+import os
+
+# Has to be set before anything imports Backend.
+os.environ.setdefault("POLYTEC_BACKEND","simulated")
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+
+from shutil import rmtree
+from statistics import median
+
+
+PACKAGE     = __package__.rsplit(".",1)[0]
+SEARCH_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Every scenario prints a JSON dict of durations (s) and device command counts.
+IMPORT = """
+import json
+from time import perf_counter
+start = perf_counter()
+import {package}.Vibrometer
+print(json.dumps({{"import": perf_counter()-start}}))
+"""
+
+READ_SETTING = """
+import json
+from time import perf_counter
+start = perf_counter()
+from {package}.Vibrometer import Vibrometer
+from {package}.SimulatedDevice import SimulatedDevice, DeviceCommunication
+imported = perf_counter()
+
+# Setting up the simulated device itself does not count.
+communication = DeviceCommunication("simulated",SimulatedDevice(command_latency={latency},realtime=False))
+device, construct_start = communication.device, perf_counter()
+vib = Vibrometer(communication)
+constructed, construct_commands = perf_counter(), device.command_count
+vib.block_size
+read = perf_counter()
+
+print(json.dumps({{"import": imported-start, "construct": constructed-construct_start, "first_setting": read-constructed,
+                  "total": (imported-start)+(read-construct_start), "construct_commands": construct_commands,
+                  "commands": device.command_count}}))
+vib.close()
+"""
+
+FIRST_RUN = """
+import json
+from time import perf_counter
+from {package}.Vibrometer import Vibrometer
+from {package}.SimulatedDevice import SimulatedDevice, DeviceCommunication
+
+device = SimulatedDevice(command_latency={latency},realtime=False,trigger_delay=0.)
+vib = Vibrometer(DeviceCommunication("simulated",device))
+vib.block_count = 1
+blocks = vib.iter_blocks(timeout=10)
+try:
+    start, commands = perf_counter(), device.command_count
+    vib.start_acq(block=True)
+    ready = perf_counter()
+    for block in blocks:
+        pass
+finally:
+    vib.close()
+
+print(json.dumps({{"first_arm": ready-start, "first_arm_commands": device.command_count-commands}}))
+"""
+
+OPEN_READER = """
+import json
+from time import perf_counter
+start = perf_counter()
+from {package}.DataManagement import HDF5Reader
+imported = perf_counter()
+with HDF5Reader({filename!r}) as reader:
+    opened = perf_counter()
+    reader.velocity(0)
+read = perf_counter()
+
+print(json.dumps({{"import": imported-start, "open": opened-imported, "first_block": read-opened, "total": read-start}}))
+"""
+
+# Writes the file for OPEN_READER.
+WRITE_FILE = """
+from {package}.Vibrometer import Vibrometer
+from {package}.SimulatedDevice import SimulatedDevice, DeviceCommunication
+
+vib = Vibrometer(DeviceCommunication("simulated",SimulatedDevice(realtime=False,trigger_delay=0.)))
+vib.block_count = 4
+blocks = vib.iter_blocks(timeout=10)
+try:
+    vib.start_acq(block=True)
+    for block in blocks:
+        pass
+    vib.write_data({filename!r},{{"traces": {{"n": 4}}}})
+finally:
+    vib.close()
+"""
+
+
+def run(code,**kwargs):
+    """Run code in a fresh interpreter, returns the JSON it printed (Vibrometer prints progress too)."""
+    result = subprocess.run([sys.executable,"-c",code.format(package=PACKAGE,**kwargs)],cwd=SEARCH_PATH,
+                            capture_output=True,text=True,check=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    return json.loads(lines[-1]) if lines else None
+
+def measure(code,repeats,**kwargs):
+    """Median of every number over repeats runs."""
+    runs = [run(code,**kwargs) for _ in range(repeats)]
+    return {key: median(result[key] for result in runs) for key in runs[0]}
+
+def report(name,result):
+    fields = [f"{key} {1000*value:8.2f} ms" if isinstance(value,float) else f"{key} {value}" for key,value in result.items()]
+    print(f"{name:<14} "+"   ".join(fields))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup cost against the simulated device.")
+    parser.add_argument("--latency",type=float,default=0.002,help="device round-trip time (s)")
+    parser.add_argument("--repeats",type=int,default=5)
+    parser.add_argument("--output",help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="startup_")
+    try:
+        filename = os.path.join(directory,"run.h5")
+        run(WRITE_FILE,filename=filename)
+
+        results = {"import":       measure(IMPORT,args.repeats),
+                   "read_setting": measure(READ_SETTING,args.repeats,latency=args.latency),
+                   "first_run":    measure(FIRST_RUN,args.repeats,latency=args.latency),
+                   "open_reader":  measure(OPEN_READER,args.repeats,filename=filename)}
+    finally:
+        rmtree(directory,ignore_errors=True)
+
+    print(f"Startup, median of {args.repeats} fresh interpreters, {1000*args.latency:.1f} ms per device command")
+    for name,result in results.items():
+        report(name,result)
+
+    if args.output:
+        with open(args.output,"w") as output:
+            json.dump({"latency": args.latency, "repeats": args.repeats, "results": results},output,indent=1)
+
+
+if __name__ == "__main__":
+    main()
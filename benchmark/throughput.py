@@ -0,0 +1,278 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# End-to-end throughput of the acquisition against the simulated device (see SimulatedDevice), so changes to the acquisition
+# loop, the CSV example and the HDF5 writer can be compared on any machine, without hardware. Two paths are measured:
+# - vibrometer: the Vibrometer acquisition loop filling the run buffer, followed by write_data to an HDF5 file;
+# - csv:        acquire_to_csv, the polytec example writing every block to a CSV file.
+#
+# Swept over chunk size, block size, frequency factor (sample rate / base sample rate) and the number of active channels. Per
+# configuration: samples/s stored, wall time per block, peak RSS, the HDF5 write time, and the dead time between runs (end of
+# one run until the next one is ready for data, writing included unless --async-write). Every configuration runs in a fresh
+# process, so the peak RSS is that of the configuration alone.
+#
+# The device runs untriggered, and by default delivers a block the moment it is read (no --realtime), so this measures the
+# software alone. Results are printed, and written as JSON with --output. Run from the directory containing the package:
+#
+#   python -m <package>.benchmark.throughput [--output results.json] [--paths vibrometer,csv] [--realtime] ...
+
+import os
+
+# Has to be set before anything imports Backend.
+os.environ.setdefault("POLYTEC_BACKEND","simulated")
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+
+from itertools import product
+from queue import Empty
+from shutil import rmtree
+from threading import Event
+from time import perf_counter
+
+import numpy as np
+
+from .. import acquire_to_csv
+from ..Backend import BACKEND, DataAcquisition, DeviceCommand, DeviceCommunication, DeviceType
+from ..DaqConfig import DaqConfig
+
+
+BASE_SAMPLE_RATE = 625000
+
+# Active channels per channel count. RSSI runs at the base sample rate, the others at the full sample rate.
+CHANNEL_SETS = {1: ("Velocity",),
+                2: ("Velocity","RSSI"),
+                4: ("Velocity","RSSI","Trigger","DataValidity")}
+
+
+def make_device(config):
+    from ..SimulatedDevice import SimulatedDevice
+
+    settings = {(DeviceType.SignalProcessing,DeviceCommand.DaqTriggerMode): "None",
+                (DeviceType.SignalProcessing,DeviceCommand.DaqBlockCount):  config["block_count"],
+                (DeviceType.SignalProcessing,DeviceCommand.DaqBlockSize):   config["block_size"]}
+
+    return SimulatedDevice(sample_rate=BASE_SAMPLE_RATE*config["freq_factor"],base_sample_rate=BASE_SAMPLE_RATE,
+                           channels=CHANNEL_SETS[config["channels"]],realtime=config["realtime"],settings=settings)
+
+def samples_per_block(config):
+    """Samples stored per block, over all channels."""
+    return sum(config["block_size"]*(1 if channel == "RSSI" else config["freq_factor"])
+               for channel in CHANNEL_SETS[config["channels"]])
+
+def peak_rss_mb():
+    """Peak resident set size of this process (MB), None where the resource module is not available (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10 # bytes on macOS, kB on Linux
+
+def summary(values):
+    if len(values) == 0:
+        return None
+    return {"median": float(np.median(values)), "p95": float(np.percentile(values,95)), "max": float(np.max(values))}
+
+
+class BlockClock:
+    """Block subscriber (see Vibrometer.subscribe_blocks) which notes when every block is published, from the acquisition
+    thread itself, so consumer latency does not end up in the numbers."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times   = []
+        self.samples = 0
+        self.bytes   = 0
+        self.done    = Event()
+
+    def put_nowait(self,block):
+        now = perf_counter()
+        if block is None:
+            self.end = now
+            self.done.set()
+            return
+
+        self.times.append(now)
+        for samples in block.samples.values():
+            self.samples += samples.size
+            self.bytes   += samples.nbytes
+
+    def get_nowait(self):
+        raise Empty
+
+
+class TimedDataAcquisition(DataAcquisition):
+    """DataAcquisition which notes when the acquisition starts and stops and when every block is done, for the CSV path."""
+
+    def start_data_acquisition(self):
+        super().start_data_acquisition()
+        self.start      = perf_counter()
+        self.block_ends = []
+
+    def next_data_acquisition_block(self):
+        self.block_ends.append(perf_counter())
+        super().next_data_acquisition_block()
+
+    def stop_data_acquisition(self):
+        self.stop = perf_counter()
+        super().stop_data_acquisition()
+
+
+def benchmark_vibrometer(config,directory):
+    from ..Vibrometer import Vibrometer
+
+    vib = Vibrometer(DeviceCommunication("simulated",make_device(config)))
+    vib.chunk_size = config["chunk_size"]
+
+    clock = BlockClock()
+    vib.subscribe_blocks(queue=clock)
+
+    rates, block_times, write_times, dead_times, futures = [], [], [], [], []
+    last_end = None
+    try:
+        for run in range(config["runs"]):
+            clock.reset()
+            ready = []
+            vib.add_ready_callback(lambda: ready.append(perf_counter()))
+            vib.start_acq(block=True)
+            if not clock.done.wait(config["timeout"]):
+                raise RuntimeError(f"Run {run} did not finish within {config['timeout']} s.")
+
+            if last_end is not None:
+                dead_times.append(ready[0]-last_end)
+            last_end = clock.end
+            rates.append(clock.samples/(clock.end-ready[0]))
+            block_times += np.diff([ready[0]]+clock.times).tolist()
+
+            filename = os.path.join(directory,f"run{run}.h5")
+            start = perf_counter()
+            if config["async_write"]:
+                # Timed until the file is written, while the next run is already being acquired.
+                future = vib.write_data_async(filename,{"benchmark": {"run": run}},overwrite=True)
+                future.add_done_callback(lambda future,start=start: write_times.append(perf_counter()-start))
+                futures.append(future)
+            else:
+                vib.write_data(filename,{"benchmark": {"run": run}},overwrite=True)
+                write_times.append(perf_counter()-start)
+
+        vib.flush_writes()
+        for future in futures:
+            future.result()
+    finally:
+        vib.close()
+
+    write_rates = [os.path.getsize(os.path.join(directory,f"run{run}.h5"))/2**20/write_time
+                   for run,write_time in enumerate(write_times)]
+
+    return {"samples_per_second": float(np.median(rates)),
+            "block_seconds":      summary(block_times),
+            "write_seconds":      summary(write_times),
+            "write_mb_per_second":float(np.median(write_rates)),
+            "dead_time_seconds":  summary(dead_times)}
+
+
+def benchmark_csv(config,directory):
+    communication = DeviceCommunication("simulated",make_device(config))
+    chunk_size    = config["chunk_size"]
+
+    rates, block_times, dead_times = [], [], []
+    last_stop = None
+    for run in range(config["runs"]):
+        # The setup acquire_to_csv.acquire_data does for every run, so it counts towards the dead time.
+        daq_config  = DaqConfig(communication,init_connection=True)
+        acquisition = TimedDataAcquisition(communication,10*chunk_size)
+        acquire_to_csv.__acquire_data_to_csv(communication,acquisition,daq_config,None,chunk_size,2000,
+                                             os.path.join(directory,f"run{run}_{{block_id}}.csv"))
+
+        if last_stop is not None:
+            dead_times.append(acquisition.start-last_stop)
+        last_stop = acquisition.stop
+        rates.append(config["block_count"]*samples_per_block(config)/(acquisition.stop-acquisition.start))
+        block_times += np.diff([acquisition.start]+acquisition.block_ends).tolist()
+
+    return {"samples_per_second": float(np.median(rates)),
+            "block_seconds":      summary(block_times),
+            "dead_time_seconds":  summary(dead_times)}
+
+
+BENCHMARKS = {"vibrometer": benchmark_vibrometer, "csv": benchmark_csv}
+
+def run_config(config):
+    """Run one configuration, in a process of its own (see main)."""
+    directory = tempfile.mkdtemp(prefix="throughput_")
+    try:
+        rss_before = peak_rss_mb()
+        result = BENCHMARKS[config["path"]](config,directory)
+    finally:
+        rmtree(directory,ignore_errors=True)
+
+    result.update(config)
+    result["rss_before_mb"] = rss_before
+    result["peak_rss_mb"]   = peak_rss_mb()
+    return result
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(), "backend": BACKEND}
+
+def report(result):
+    rss   = f"{result['peak_rss_mb']:8.1f} MB" if result["peak_rss_mb"] is not None else "       n/a"
+    dead  = f"{1000*result['dead_time_seconds']['median']:8.2f} ms" if result["dead_time_seconds"] else "       n/a"
+    write = f"{result['write_mb_per_second']:8.1f} MB/s" if "write_mb_per_second" in result else ""
+    print(f"{result['path']:<10} chunk {result['chunk_size']:>6} block {result['block_size']:>7} "
+          f"x{result['freq_factor']} {result['channels']} ch   {result['samples_per_second']/1e6:8.3f} MS/s   "
+          f"block {1000*result['block_seconds']['median']:8.2f} ms   dead {dead}   RSS {rss}   {write}")
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end acquisition throughput against the simulated device.")
+    parser.add_argument("--paths",default="vibrometer,csv",help="comma separated, from: "+", ".join(BENCHMARKS))
+    parser.add_argument("--chunk-sizes",type=int_list,default=[250,1000,4000])
+    parser.add_argument("--block-sizes",type=int_list,default=[4000,40000])
+    parser.add_argument("--freq-factors",type=int_list,default=[1,2])
+    parser.add_argument("--channels",type=int_list,default=sorted(CHANNEL_SETS),
+                        help="channel counts, from: "+", ".join(str(count) for count in CHANNEL_SETS))
+    parser.add_argument("--block-count",type=int,default=10)
+    parser.add_argument("--csv-block-count",type=int,default=2,help="the CSV path writes every sample in Python, keep it short")
+    parser.add_argument("--runs",type=int,default=3,help="runs per configuration, at least 2 for the dead time")
+    parser.add_argument("--realtime",action="store_true",help="let samples come in at the device sample rate")
+    parser.add_argument("--async-write",action="store_true",help="write with write_data_async, overlapping the next run")
+    parser.add_argument("--timeout",type=float,default=600.,help="maximum time per run (s)")
+    parser.add_argument("--output",help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if BACKEND != "simulated":
+        parser.error("The throughput benchmark needs POLYTEC_BACKEND=simulated.")
+
+    configs = [{"path": path, "chunk_size": chunk_size, "block_size": block_size, "freq_factor": freq_factor,
+                "channels": channels, "block_count": args.csv_block_count if path == "csv" else args.block_count,
+                "runs": args.runs, "realtime": args.realtime, "async_write": args.async_write, "timeout": args.timeout}
+               for path,chunk_size,block_size,freq_factor,channels in product(args.paths.split(","),args.chunk_sizes,
+                                                                               args.block_sizes,args.freq_factors,args.channels)]
+
+    # A fresh process per configuration: peak RSS only ever goes up within a process.
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for config in configs:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_config,(config,)))
+        report(results[-1])
+
+    if args.output:
+        with open(args.output,"w") as output:
+            json.dump({"environment": environment(), "results": results},output,indent=1)
+
+
+if __name__ == "__main__":
+    main()
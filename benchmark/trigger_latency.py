@@ -0,0 +1,153 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Latency between an event on the device and the moment our code notices it, measured on the real acquisition paths against
+# the simulated device (see SimulatedDevice), so it runs without hardware:
+# - trigger: from the trigger on the device (SimulatedDevice.trigger_times) until the acquisition loop is past its trigger
+#   wait. For Vibrometer that is Block.trigger_time, with the default TriggerPoll and with polling at a fixed 10 ms without
+#   spinning (the old behaviour), for acquire_to_csv the first poll of available_samples() that sees data;
+# - ready: from the acquisition thread being ready for data until a blocking Vibrometer.start_acq() returns.
+#
+# The triggers come at a random phase (trigger_jitter), so the polling interval shows up in the spread. Run from the directory
+# containing the package:
+#
+#   python -m <package>.benchmark.trigger_latency [repeats]
+
+import os
+
+# Has to be set before anything imports Backend.
+os.environ.setdefault("POLYTEC_BACKEND","simulated")
+
+import sys
+import tempfile
+
+from shutil import rmtree
+from statistics import median
+from time import perf_counter
+
+from .. import acquire_to_csv
+from ..Backend import DataAcquisition, DeviceCommunication
+from ..DaqConfig import DaqConfig
+
+BLOCK_COUNT = 10
+BLOCK_SIZE  = 1000
+CHUNK_SIZE  = 250
+
+
+def make_device(trigger_interval=0.02,realtime=True):
+    from ..SimulatedDevice import SimulatedDevice
+
+    return SimulatedDevice(realtime=realtime,trigger_delay=0.005,trigger_interval=trigger_interval,trigger_jitter=0.02)
+
+
+class NoticingDataAcquisition(DataAcquisition):
+    """DataAcquisition which notes, per block, when available_samples() first reports data: when the trigger is noticed."""
+
+    def start_data_acquisition(self):
+        super().start_data_acquisition()
+        self.noticed = [None]
+
+    def next_data_acquisition_block(self):
+        super().next_data_acquisition_block()
+        self.noticed.append(None)
+
+    def available_samples(self):
+        available = super().available_samples()
+        if available != 0 and self.noticed[-1] is None:
+            self.noticed[-1] = perf_counter()
+        return available
+
+
+def vibrometer_trigger_latency(repeats,spin_time=None,poll_interval=None):
+    """Latencies (s) between the device triggering a block and Vibrometer noticing it."""
+    from ..Vibrometer import Vibrometer
+
+    device = make_device()
+    vib = Vibrometer(DeviceCommunication("simulated",device))
+    vib.block_count = BLOCK_COUNT
+    vib.block_size  = BLOCK_SIZE
+    if spin_time is not None:
+        vib.trigger_spin_time = spin_time
+    if poll_interval is not None:
+        vib.trigger_poll_interval = poll_interval
+
+    latencies = []
+    try:
+        for _ in range(repeats):
+            first = len(device.trigger_times)
+            blocks = vib.iter_blocks(timeout=10)
+            vib.start_acq(block=True)
+            for block in blocks:
+                latencies.append(block.trigger_time - device.trigger_times[first+block.block_id])
+    finally:
+        vib.close()
+    return latencies
+
+def csv_trigger_latency(repeats,directory):
+    """Latencies (s) between the device triggering a block and acquire_to_csv noticing it. Writing a block to CSV is far
+    slower than acquiring it, so the device delivers a block the moment it is triggered, and the triggers are further apart
+    than in the Vibrometer runs."""
+    device = make_device(trigger_interval=0.1,realtime=False)
+    communication = DeviceCommunication("simulated",device)
+
+    latencies = []
+    for run in range(repeats):
+        daq_config = DaqConfig(communication,init_connection=True)
+        daq_config.block_count = BLOCK_COUNT
+        daq_config.block_size  = BLOCK_SIZE
+
+        first = len(device.trigger_times)
+        acquisition = NoticingDataAcquisition(communication,10*CHUNK_SIZE)
+        acquire_to_csv.__acquire_data_to_csv(communication,acquisition,daq_config,None,CHUNK_SIZE,2000,
+                                             os.path.join(directory,f"run{run}_{{block_id}}.csv"))
+        latencies += [noticed - device.trigger_times[first+block_id]
+                      for block_id,noticed in enumerate(acquisition.noticed[:BLOCK_COUNT])]
+    return latencies
+
+def ready_latency(repeats):
+    """Latencies (s) between the acquisition thread becoming ready and a blocking start_acq() returning."""
+    from ..Vibrometer import Vibrometer
+
+    vib = Vibrometer(DeviceCommunication("simulated",make_device()))
+    vib.block_count = 1
+    vib.block_size  = BLOCK_SIZE
+
+    latencies = []
+    try:
+        for _ in range(repeats):
+            ready = []
+            blocks = vib.iter_blocks(timeout=10)
+            vib.add_ready_callback(lambda: ready.append(perf_counter()))
+            vib.start_acq(block=True)
+            latencies.append(perf_counter() - ready[0])
+            for _ in blocks:
+                pass
+    finally:
+        vib.close()
+    return latencies
+
+
+def report(name,latencies):
+    ms = [1000*latency for latency in latencies]
+    print(f"{name:<40} median {median(ms):8.3f} ms   max {max(ms):8.3f} ms")
+
+
+def main(argv=None):
+    argv    = sys.argv[1:] if argv is None else argv
+    repeats = int(argv[0]) if len(argv) > 0 else 5
+
+    print(f"Trigger-to-first-read latency, {repeats} runs of {BLOCK_COUNT} blocks")
+    report("Vibrometer, fixed 10 ms poll",vibrometer_trigger_latency(repeats,spin_time=0.,poll_interval=0.01))
+    report("Vibrometer, TriggerPoll (spin + back-off)",vibrometer_trigger_latency(repeats))
+
+    directory = tempfile.mkdtemp(prefix="trigger_latency_")
+    try:
+        report("acquire_to_csv, TriggerPoll",csv_trigger_latency(repeats,directory))
+    finally:
+        rmtree(directory,ignore_errors=True)
+
+    print(f"Ready-to-start_acq latency, {repeats*BLOCK_COUNT} runs")
+    report("Vibrometer.start_acq(block=True)",ready_latency(repeats*BLOCK_COUNT))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,24 +29,24 @@ def output_functions_string(**func_dict):
     dtype = func_dict["dtype"]
     dcomm = func_dict["dcomm"]
     
-    return(f'        self.__{name} = ItemList(self.__communication, DeviceType.{dtype}, DeviceCommand.{dcomm})',
+    return(f'        self.__{name} = LazyItemList(self.__communication, DeviceType.{dtype}, DeviceCommand.{dcomm})',
            f'    # {hname}\n'
            f'    @property\n'
            f'    def {name}(self):\n'
            f'        """Gets the {hname}"""\n'
-           f'        return self.__{name}.current_item()\n'
+           f'        return self.__cached("{name}",self.__{name})\n'
            f'    \n'
            f'    @{name}.setter\n'
            f'    def {name}(self,new_value):\n'
            f'        """Sets the {hname}"""\n'
-           f'        if self.__{name}.is_item_available(new_value):\n'
-           f'            self.__{name}.set_current_item(new_value)\n'
+           f'        if new_value in self.all_{name}():\n'
+           f'            self.__set(self.__{name},new_value)\n'
            f'        else:\n'
            f'            raise ConfigurationError(f"{hname} mode not available: {{new_value}}. Available values: {{self.all_{name}()}}.")\n'
            f'    \n'
            f'    def all_{name}(self):\n'
            f'        """Gets all available settings for property {hname}"""\n'
-           f'        return self.__{name}.available_items()\n'
+           f'        return self.__available(self.__{name},DeviceCommand.{dcomm})\n'
            f'    \n')
 
 if __name__ == "__main__":
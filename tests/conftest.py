@@ -0,0 +1,39 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# The tests run against the simulated device (see SimulatedDevice), so they need neither the polytec library nor a vibrometer.
+# Run from the directory containing the package, or from the package itself:
+#
+#   python -m pytest -q
+
+import os
+
+# Has to be set before anything imports Backend.
+os.environ.setdefault("POLYTEC_BACKEND","simulated")
+
+import pytest
+
+from ..Backend import DeviceCommunication
+from ..SimulatedDevice import SimulatedDevice
+from ..Vibrometer import Vibrometer
+
+
+@pytest.fixture
+def make_vibrometer():
+    """Makes Vibrometers on a SimulatedDevice, make_vibrometer(**device_kwargs), and shuts their acquisition threads down
+    afterwards. The device triggers every 10 ms by default, so a run of a few blocks takes a fraction of a second."""
+    vibrometers = []
+
+    def make(block_count=4,block_size=2000,**device_kwargs):
+        device_kwargs.setdefault("trigger_delay",0.)
+        device_kwargs.setdefault("trigger_interval",0.01)
+        vibrometer = Vibrometer(DeviceCommunication("simulated",SimulatedDevice(**device_kwargs)))
+        vibrometer.block_count = block_count
+        vibrometer.block_size  = block_size
+        vibrometers.append(vibrometer)
+        return vibrometer
+
+    yield make
+
+    for vibrometer in vibrometers:
+        vibrometer.close()
+
@@ -0,0 +1,9 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+# Helpers shared by the tests, see conftest.py for the make_vibrometer fixture.
+
+def run(vibrometer):
+    """One run, returns the blocks that came through iter_blocks."""
+    blocks = vibrometer.iter_blocks(timeout=10)
+    vibrometer.start_acq(block=True)
+    return list(blocks)
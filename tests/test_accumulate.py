@@ -0,0 +1,42 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+import pytest
+
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_accumulate_matches_statistics_of_the_blocks(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=8,block_size=1000)
+
+    # The simulated device sends the same blocks every run, so a normal run gives the blocks the statistics are over.
+    run(vibrometer)
+    data = vibrometer.take_data()
+
+    vibrometer.accumulate          = True
+    vibrometer.accumulate_envelope = True
+    run(vibrometer)
+    statistics = vibrometer.statistics
+
+    for ch_name in ["Velocity","RSSI"]:
+        samples = data[ch_name]["Samples"].astype(np.float64)
+        running = statistics[ch_name]["Statistics"]
+        assert running.count == 8
+        assert np.allclose(running.sum,samples.sum(axis=0))
+        assert np.allclose(running.mean,samples.mean(axis=0))
+        assert np.allclose(running.variance(),samples.var(axis=0,ddof=1))
+        assert np.array_equal(running.min,data[ch_name]["Samples"].min(axis=0))
+        assert np.array_equal(running.max,data[ch_name]["Samples"].max(axis=0))
+    assert np.array_equal(statistics["Velocity"]["Statistics"].overrange_count,
+                          data["Velocity"]["Overrange"].sum(axis=0))
+
+    vibrometer.write_data(str(tmp_path/"accumulated.h5"),{"traces": {"accumulated": True}})
+    with HDF5Reader(str(tmp_path/"accumulated.h5")) as reader:
+        assert reader.accumulated
+        scalefactor = data["Velocity"]["ScaleFactor"]
+        assert np.allclose(reader.average_velocity(),data["Velocity"]["Samples"].mean(axis=0)*scalefactor)
+        assert np.allclose(reader.statistics("Velocity")["variance"],
+                           data["Velocity"]["Samples"].var(axis=0,ddof=1)*scalefactor**2)
+        with pytest.raises(ValueError):
+            reader.average_velocity(0,4)
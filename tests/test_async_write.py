@@ -0,0 +1,109 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from ..DataManagement import HDF5Writer
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_write_data_async_writes_every_run_in_order(make_vibrometer,tmp_path):
+    # Lost packets are random, so every run has a DataValidity channel of its own to recognise it by.
+    vibrometer = make_vibrometer(block_count=4,block_size=2000,packet_loss=0.5)
+    vibrometer.write_queue_size = 1
+
+    runs, futures, written = [], [], []
+    for num in range(5):
+        blocks = run(vibrometer)
+        runs.append([block.samples["DataValidity"].copy() for block in blocks])
+
+        filename = str(tmp_path/f"run{num}.h5")
+        future = vibrometer.write_data_async(filename,{"traces": {"run": num}})
+        future.add_done_callback(lambda future: written.append(future.result()))
+        futures.append(future)
+
+    vibrometer.flush_writes()
+    assert vibrometer.pending_writes == 0
+    assert written == [str(tmp_path/f"run{num}.h5") for num in range(5)]
+
+    for num,validity in enumerate(runs):
+        with HDF5Reader(futures[num].result()) as reader:
+            assert reader.metadata_value("traces","run") == num
+            assert np.array_equal(reader.blocks("DataValidity",0,4),np.array(validity))
+            assert np.array_equal(reader.valid_blocks(),[bool(block.all()) for block in validity])
+
+def test_write_data_async_reports_errors_through_the_future(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=2)
+
+    run(vibrometer)
+    failed = vibrometer.write_data_async(str(tmp_path/"missing"/"run.h5"))
+    run(vibrometer)
+    written = vibrometer.write_data_async(str(tmp_path/"run.h5"))
+
+    assert isinstance(failed.exception(timeout=10),OSError)
+    assert written.result(timeout=10) == str(tmp_path/"run.h5")
+
+def test_close_writes_the_queued_runs(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=2)
+
+    futures = []
+    for num in range(3):
+        run(vibrometer)
+        futures.append(vibrometer.write_data_async(str(tmp_path/f"run{num}.h5")))
+
+    vibrometer.close()
+    assert all(future.done() and future.exception() is None for future in futures)
+    assert vibrometer.pending_writes == 0
+
+
+# The writer thread is left running, with a run still queued.
+UNCLOSED_WRITER = """
+from {package}.Vibrometer import Vibrometer
+from {package}.SimulatedDevice import SimulatedDevice, DeviceCommunication
+from {package}.DataManagement import HDF5BackgroundWriter
+
+vib = Vibrometer(DeviceCommunication("simulated",SimulatedDevice(realtime=False,trigger_delay=0.,trigger_interval=0.01)))
+vib.block_count = 2
+blocks = vib.iter_blocks(timeout=10)
+vib.start_acq(block=True)
+list(blocks)
+data, settings = vib.take_data(), vib.to_dict()
+vib.close()
+
+writer = HDF5BackgroundWriter()
+writer.put({filename!r},{{"vibrometer": settings}},data)
+"""
+
+def test_unclosed_background_writer_does_not_keep_the_script_alive(tmp_path):
+    package     = __package__.rsplit(".",1)[0]
+    search_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    filename    = str(tmp_path/"run.h5")
+
+    code = UNCLOSED_WRITER.format(package=package,filename=filename)
+    result = subprocess.run([sys.executable,"-c",code],cwd=search_path,timeout=60,
+                            env=dict(os.environ,POLYTEC_BACKEND="simulated"))
+    assert result.returncode == 0
+
+    with HDF5Reader(filename) as reader:
+        assert reader.block_count == 2
+
+def test_failed_write_hands_the_run_back(make_vibrometer,tmp_path):
+    # Lost packets are random, so every run has a DataValidity channel of its own.
+    vibrometer = make_vibrometer(block_count=2,packet_loss=0.5)
+    vibrometer.reuse_buffers = True
+
+    validity = [block.samples["DataValidity"].copy() for block in run(vibrometer)]
+    error = vibrometer.write_data_async(str(tmp_path/"missing"/"run.h5")).exception(timeout=10)
+    assert isinstance(error,OSError)
+
+    # Released buffers would be reused, and overwritten, by the next run.
+    run(vibrometer)
+    assert np.array_equal(error.data["DataValidity"]["Samples"],validity)
+
+    HDF5Writer().write_run(str(tmp_path/"run.h5"),{"vibrometer": vibrometer.to_dict()},error.data)
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert np.array_equal(reader.blocks("DataValidity",0,2),validity)
@@ -0,0 +1,117 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import asyncio
+
+from queue import Empty, Full
+
+import numpy as np
+import pytest
+
+from ..AsyncVibrometer import AsyncVibrometer
+from ..BlockDispatcher import BlockDispatcher
+from .simulated import run
+
+
+def test_iter_blocks_yields_every_block_and_ends(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=5)
+    blocks = run(vibrometer)
+
+    assert [block.block_id for block in blocks] == list(range(5))
+    data = vibrometer.take_data()
+    for block in blocks:
+        assert np.array_equal(block.samples["Velocity"],data["Velocity"]["Samples"][block.block_id])
+    assert vibrometer.dropped_blocks == 0
+
+def test_accumulate_run_blocks_are_copies(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=3)
+    vibrometer.accumulate = True
+    blocks = run(vibrometer)
+
+    assert [block.block_id for block in blocks] == list(range(3))
+    first, second = blocks[0].samples["Velocity"], blocks[1].samples["Velocity"]
+    assert not np.shares_memory(first,second)
+
+def test_iter_blocks_every_run(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=3)
+    for _ in range(3):
+        assert len(run(vibrometer)) == 3
+
+def test_slow_consumer_drops_blocks_but_sees_the_end(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=6)
+    slow = vibrometer.iter_blocks(timeout=10,maxsize=2)
+
+    # Only start consuming once the run is over. Blocks that do not fit are dropped, and the oldest block makes room for the
+    # end of the run.
+    assert len(run(vibrometer)) == 6
+    assert [block.block_id for block in slow] == [1]
+    assert vibrometer.dropped_blocks == 5
+
+
+class StuckQueue:
+    """A subscriber which never takes anything, and has nothing to give back."""
+
+    def put_nowait(self,item):
+        raise Full
+
+    def get_nowait(self):
+        raise Empty
+
+def test_end_run_gives_up_on_stuck_subscriber():
+    dispatcher = BlockDispatcher()
+    dispatcher.subscribe(queue=StuckQueue())
+    queue = dispatcher.subscribe()
+    dispatcher.end_run()
+    assert queue.get_nowait() is BlockDispatcher.END_OF_RUN
+
+
+def test_async_blocks(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=4)
+    async_vibrometer = AsyncVibrometer(vibrometer)
+
+    async def acquire():
+        blocks = async_vibrometer.blocks()
+        await async_vibrometer.start_acq()
+        return [block.block_id async for block in blocks]
+
+    assert asyncio.run(acquire()) == list(range(4))
+
+def test_async_start_acq_timeout_leaves_the_run_armed(make_vibrometer):
+    # Reading the settings at the start of the run takes a while.
+    vibrometer = make_vibrometer(block_count=2,command_latency=0.02)
+    async_vibrometer = AsyncVibrometer(vibrometer)
+
+    async def acquire():
+        blocks = async_vibrometer.blocks()
+        with pytest.raises(TimeoutError):
+            await async_vibrometer.start_acq(timeout=0.01)
+        return [block.block_id async for block in blocks]
+
+    assert asyncio.run(acquire()) == [0,1]
+
+def test_async_start_acq_returns_when_the_run_ends_first(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=2)
+    async_vibrometer = AsyncVibrometer(vibrometer)
+
+    async def acquire():
+        # Nothing of the block is in the window, the run fails before the device is ready for data.
+        vibrometer.capture_windows = [(10.,11.)]
+        assert await async_vibrometer.start_acq(timeout=10) is False
+
+        vibrometer.capture_windows = None
+        blocks = async_vibrometer.blocks()
+        assert await async_vibrometer.start_acq(timeout=10) is True
+        return [block.block_id async for block in blocks]
+
+    assert asyncio.run(acquire()) == [0,1]
+
+def test_async_blocks_of_closed_loop_do_not_stall_the_acquisition(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=3)
+    async_vibrometer = AsyncVibrometer(vibrometer)
+
+    # Subscribed, but never iterated, and the loop is gone before the run.
+    async def subscribe():
+        async_vibrometer.blocks(maxsize=1)
+    asyncio.run(subscribe())
+
+    for _ in range(2):
+        assert len(run(vibrometer)) == 3
@@ -0,0 +1,55 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+
+from ..BufferPool import BufferPool
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_pool_hands_out_released_arrays_only():
+    pool = BufferPool(max_free=1)
+    first  = pool("Velocity","Samples",(2,8),np.int32)
+    second = pool("Velocity","Samples",(2,8),np.int32)
+    assert first is not second
+    assert (pool.hits,pool.misses) == (0,2)
+
+    # Only one free array is kept per layout, and arrays from elsewhere are ignored.
+    pool.release({"Velocity": {"Samples": first, "Overrange": None}})
+    pool.release({"Velocity": {"Samples": second, "Overrange": None}})
+    pool.release({"Velocity": {"Samples": np.zeros((2,8),dtype=np.int32), "Overrange": None}})
+
+    assert pool("Velocity","Samples",(2,8),np.int32) is first
+    assert pool("Velocity","Samples",(2,4),np.int32) is not second
+    assert pool("Velocity","Samples",(2,8),np.int32) is not second
+    assert (pool.hits,pool.misses) == (1,4)
+
+def test_written_runs_lend_their_buffers_to_the_next_run(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=3,block_size=1000)
+    vibrometer.reuse_buffers = True
+
+    for num in range(3):
+        blocks = run(vibrometer)
+        vibrometer.write_data(str(tmp_path/f"run{num}.h5"))
+
+        with HDF5Reader(str(tmp_path/f"run{num}.h5")) as reader:
+            for block in blocks:
+                assert np.array_equal(reader.block("Velocity",block.block_id),block.samples["Velocity"])
+
+    # Every array of the first run was allocated, those of the later runs came from the pool.
+    pool = vibrometer.buffer_pool
+    assert pool.hits == 2*pool.misses > 0
+
+def test_taken_data_is_not_reused_before_it_is_released(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=3,block_size=1000)
+    vibrometer.reuse_buffers = True
+
+    run(vibrometer)
+    taken = vibrometer.take_data()
+    run(vibrometer)
+    assert vibrometer.buffer_pool.hits == 0
+    assert vibrometer.take_data()["Velocity"]["Samples"] is not taken["Velocity"]["Samples"]
+
+    vibrometer.release_data(taken)
+    run(vibrometer)
+    assert vibrometer.take_data()["Velocity"]["Samples"] is taken["Velocity"]["Samples"]
@@ -0,0 +1,25 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+from ..Backend import DeviceCommand, DeviceCommunication, DeviceType
+from ..SimulatedDevice import SimulatedDevice
+from ..Vibrometer import Vibrometer
+
+
+def test_block_ranges_follow_block_count_and_size():
+    device     = SimulatedDevice()
+    vibrometer = Vibrometer(DeviceCommunication("simulated",device))
+    key        = (DeviceType.SignalProcessing,DeviceCommand.DaqBlockSize)
+
+    old_range = vibrometer.block_size_range()
+    vibrometer.available_trigger_modes()
+
+    # As if the device memory left for a block shrank with the block count.
+    device.ranges[key] = (1,5000)
+    assert vibrometer.block_size_range() == old_range
+    vibrometer.block_count = 10
+    assert tuple(vibrometer.block_size_range()) == (1,5000)
+
+    # Item lists do not follow, they stay cached.
+    queries = device.command_count
+    vibrometer.available_trigger_modes()
+    assert device.command_count == queries
@@ -0,0 +1,50 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+import pytest
+
+from ..Compression import Compression
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+@pytest.mark.parametrize("text",["none","gzip-9","gzip-4+shuffle","lzf","lzf+shuffle","bitshuffle"])
+def test_compression_string_round_trip(text):
+    if text == "bitshuffle":
+        pytest.importorskip("hdf5plugin")
+    assert str(Compression.from_string(text)) == text
+
+@pytest.mark.parametrize("kwargs",[{"method": "zstd"},{"method": "gzip", "level": 10},{"method": None, "shuffle": True}])
+def test_invalid_compression(kwargs):
+    with pytest.raises(ValueError):
+        Compression(**kwargs)
+
+@pytest.mark.parametrize("stream",[False,True])
+def test_per_channel_compression(make_vibrometer,tmp_path,stream):
+    vibrometer = make_vibrometer(block_count=3,block_size=1000)
+    vibrometer.set_compression(Compression("lzf"))
+    vibrometer.set_compression(Compression("gzip",9,shuffle=True),"Velocity")
+    vibrometer.set_compression(Compression(),"DataValidity")
+
+    filename = str(tmp_path/"run.h5")
+    if stream:
+        vibrometer.stream_data(filename)
+    blocks = run(vibrometer)
+    if stream:
+        vibrometer.wait_for_stream(timeout=10)
+    else:
+        vibrometer.write_data(filename)
+
+    with HDF5Reader(filename) as reader:
+        velocity = reader["Velocity/blocks"]
+        assert (velocity.compression,velocity.compression_opts,velocity.shuffle) == ("gzip",9,True)
+        assert reader["Velocity/overrange"].compression == "gzip"
+        assert reader["RSSI/blocks"].compression == "lzf"
+        assert reader["DataValidity/blocks"].compression is None
+
+        for block in blocks:
+            for ch_name,samples in block.samples.items():
+                assert np.array_equal(reader.block(ch_name,block.block_id),samples)
+
+    vibrometer.clear_compression("Velocity")
+    assert vibrometer.compression.keys() == {None,"DataValidity"}
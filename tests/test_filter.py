@@ -0,0 +1,52 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+
+from ..HDF5Reader import HDF5Reader
+from ..OnlineFilter import OnlineFilter
+from .simulated import run
+
+
+def offline(samples,taps,decimation):
+    """The filter of a block on its own, from a zero state: output k is the filtered input at sample k*decimation."""
+    count = len(samples)//decimation
+    return np.convolve(samples.astype(np.float64),taps)[:count*decimation:decimation]
+
+def test_filter_decimates_like_offline_filtering(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=3,block_size=1000)
+    vibrometer.chunk_size = 96 # Chunks that do not line up with the decimation windows
+    run(vibrometer)
+    data = vibrometer.take_data()
+
+    decimation = 4
+    taps = OnlineFilter.lowpass(decimation).describe()["coefficients"]
+    vibrometer.set_filter("Velocity",OnlineFilter(decimation,taps=taps,reset_per_block=True))
+    run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"filtered.h5"),{"traces": {"decimation": decimation}})
+
+    with HDF5Reader(str(tmp_path/"filtered.h5")) as reader:
+        assert reader.decimation("Velocity") == decimation
+        assert reader.decimation("RSSI") == 1
+        assert reader.filter_description("Velocity")["kind"] == "fir"
+
+        filtered = reader.blocks("Velocity",0,3)
+        assert filtered.shape == (3,2000//decimation)
+        for num in range(3):
+            assert np.allclose(filtered[num],offline(data["Velocity"]["Samples"][num],taps,decimation),rtol=1e-5,atol=1.)
+
+        # Unfiltered channels are untouched, the time axis follows the decimation.
+        assert np.array_equal(reader.blocks("RSSI",0,3),data["RSSI"]["Samples"])
+        t_array = reader.channel_t_array("Velocity")
+        assert len(t_array) == filtered.shape[1]
+        assert np.allclose(np.diff(t_array),decimation/1250000)
+
+def test_filter_flags_overrange_of_any_sample_in_the_window(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=2,block_size=1000)
+    run(vibrometer)
+    overrange = vibrometer.take_data()["Velocity"]["Overrange"]
+    assert overrange.any()
+
+    vibrometer.set_filter("Velocity",OnlineFilter(5))
+    run(vibrometer)
+    decimated = vibrometer.take_data()["Velocity"]["Overrange"]
+    assert np.array_equal(decimated,overrange.reshape(2,-1,5).any(axis=2))
@@ -0,0 +1,151 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import h5py
+import numpy as np
+import pytest
+
+from .. import DataManagement
+from ..DataManagement import BLOCK_LAYOUT_VERSION, HDF5Writer
+from ..HDF5Reader import HDF5Reader, series_to_one_file
+from .simulated import run
+
+
+def write_legacy(filename,channel_data,metadata,format_version=1):
+    """A file as written before the current layout. format_version 1: a dataset per run (<channel>/<num>, and
+    <channel>/overrange/<num>). format_version 2: the block layout. Both keep the metadata as <group>__<key> datasets in the
+    root."""
+    if format_version == 1:
+        with h5py.File(filename,"w") as legacy_file:
+            for ch_name,channel in channel_data.items():
+                ch_grp = legacy_file.create_group(ch_name)
+                ch_grp["unit"]        = channel["Unit"]
+                ch_grp["scalefactor"] = channel["ScaleFactor"]
+                ch_grp["ID"]          = channel["ID"]
+
+                data_type = "b" if channel["Unit"] == "bool" else "i"
+                for num,samples in enumerate(channel["Samples"]):
+                    ch_grp.create_dataset(f"{num}",data=samples,dtype=data_type)
+                    if channel["Overrange"] is not None:
+                        ch_grp.create_dataset(f"overrange/{num}",data=channel["Overrange"][num],dtype="b")
+    else:
+        writer = HDF5Writer()
+        writer.open_file(filename)
+        writer.write_channel_data(channel_data)
+        writer.close_file()
+
+    with h5py.File(filename,"a") as legacy_file:
+        if format_version == 1:
+            legacy_file.attrs.pop("format_version",None)
+        else:
+            legacy_file.attrs["format_version"] = format_version
+        for _key,_dict in metadata.items():
+            for _skey,_item in _dict.items():
+                legacy_file[_key+"__"+_skey] = _item
+
+@pytest.fixture
+def recorded_run(make_vibrometer,tmp_path):
+    """The data of a simulated run, its metadata, and the file write_data made of it."""
+    vibrometer = make_vibrometer(block_count=5,block_size=1000)
+    run(vibrometer)
+
+    metadata = {"traces": {"pre_exp_beamdump": 2, "comment": "back-compat", "delays": np.arange(3.)},
+                "vibrometer": vibrometer.to_dict()}
+    data = vibrometer.take_data()
+
+    writer = HDF5Writer()
+    writer.write_run(str(tmp_path/"current.h5"),metadata,data)
+    return data, metadata, str(tmp_path/"current.h5")
+
+
+@pytest.mark.parametrize("format_version",[1,BLOCK_LAYOUT_VERSION])
+def test_legacy_layouts_read_like_the_current_one(recorded_run,tmp_path,format_version):
+    data, metadata, filename = recorded_run
+    write_legacy(str(tmp_path/"legacy.h5"),data,metadata,format_version)
+
+    with HDF5Reader(filename) as current, HDF5Reader(str(tmp_path/"legacy.h5")) as legacy:
+        assert legacy.block_count == current.block_count == 5
+        assert sorted(legacy.channels) == sorted(current.channels)
+        for ch_name in current.channels:
+            assert np.array_equal(legacy.blocks(ch_name,1,4),current.blocks(ch_name,1,4))
+            assert np.array_equal(legacy.block(ch_name,2),data[ch_name]["Samples"][2])
+        assert np.array_equal(legacy.overrange("Velocity",3),data["Velocity"]["Overrange"][3])
+        assert np.array_equal(legacy.velocity(4),current.velocity(4))
+        assert np.allclose(legacy.average_velocity(),current.average_velocity())
+        assert np.allclose(legacy.average_velocity(1,3),current.average_velocity(1,3))
+        assert np.allclose(legacy.background_traces,current.background_traces)
+        assert np.array_equal(legacy.generate_t_array(),current.generate_t_array())
+
+def test_current_layout_is_chunked(recorded_run):
+    data, _, filename = recorded_run
+    with HDF5Reader(filename) as reader:
+        assert reader["Velocity/blocks"].shape == data["Velocity"]["Samples"].shape
+        assert reader["Velocity/blocks"].chunks[0] == 5
+        assert reader._chunk_rows("Velocity") == 5
+
+def test_series_to_one_file_in_si_units(make_vibrometer,tmp_path,monkeypatch):
+    vibrometer = make_vibrometer(block_count=5,block_size=1000,channels=("Velocity","RSSI","Trigger"))
+    # Chunks of a few blocks, which do not divide the block count.
+    monkeypatch.setattr(DataManagement,"CHUNK_BYTES",20000)
+    for param in [1,2]:
+        run(vibrometer)
+        vibrometer.write_data(str(tmp_path/f"series_{param}.h5"))
+
+    expected = []
+    for param in [1,2]:
+        with HDF5Reader(str(tmp_path/f"series_{param}.h5")) as reader:
+            assert 1 < reader._chunk_rows("Velocity") < 5
+            expected.append([(reader.velocity(num),reader.block("Trigger",num)) for num in range(5)])
+    series_to_one_file(str(tmp_path),"series",[1,2],postfix=".h5")
+
+    with h5py.File(str(tmp_path/"series.h5"),"r") as series:
+        for param,blocks in zip(["1","2"],expected):
+            assert len(series[f"{param}/Velocity"]) == 5
+            for num,(velocity,trigger) in enumerate(blocks):
+                assert np.array_equal(series[f"{param}/Velocity/{num}"][()],velocity)
+                assert np.array_equal(series[f"{param}/Trigger/{num}"][()],trigger)
+
+
+@pytest.mark.parametrize("format_version",[1,BLOCK_LAYOUT_VERSION])
+def test_legacy_metadata_reads_like_the_current_one(recorded_run,tmp_path,format_version):
+    data, metadata, filename = recorded_run
+    write_legacy(str(tmp_path/"legacy.h5"),data,metadata,format_version)
+
+    with HDF5Reader(filename) as current, HDF5Reader(str(tmp_path/"legacy.h5")) as legacy:
+        for reader in [current,legacy]:
+            assert reader.metadata_value("traces","comment") == "back-compat"
+            assert reader.metadata_value("traces","pre_exp_beamdump") == 2
+            assert np.array_equal(reader.metadata_value("traces","delays"),np.arange(3.))
+            assert reader.metadata_value("traces","missing",None) is None
+            with pytest.raises(KeyError):
+                reader.metadata_value("traces","missing")
+            assert reader.preexp_shots == 2
+
+        assert legacy.metadata.keys() == current.metadata.keys()
+        for group in current.metadata:
+            assert legacy.metadata[group].keys() == current.metadata[group].keys()
+            for key,value in current.metadata[group].items():
+                assert np.array_equal(legacy.metadata[group][key],value)
+
+def test_large_metadata_values_are_datasets(tmp_path):
+    writer = HDF5Writer()
+    writer.open_file(str(tmp_path/"metadata.h5"))
+    writer.write_metadata({"traces": {"small": np.arange(4), "large": np.arange(1000)}})
+    writer.close_file()
+
+    with h5py.File(str(tmp_path/"metadata.h5"),"r") as written:
+        assert "small" in written["metadata/traces"].attrs
+        assert isinstance(written["metadata/traces/large"],h5py.Dataset)
+
+def test_write_data_does_not_overwrite(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=2)
+    run(vibrometer)
+    (tmp_path/"run.h5").write_bytes(b"")
+
+    with pytest.raises(IOError,match="exists"):
+        vibrometer.write_data(str(tmp_path/"run.h5"))
+    assert vibrometer.has_data
+    assert (tmp_path/"run.h5").read_bytes() == b""
+
+    vibrometer.write_data(str(tmp_path/"run.h5"),overwrite=True)
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert reader.block_count == 2
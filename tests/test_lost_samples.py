@@ -0,0 +1,53 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+
+from ..DataValidity import LostSampleIndex, window_ranges
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_window_ranges():
+    windows = np.array([[10,20],[30,40]])
+    ranges  = np.array([[0,5],[8,12],[15,35],[38,50]])
+    assert window_ranges(ranges,windows).tolist() == [[0,2],[5,15],[18,20]]
+    assert window_ranges(np.array([[0,10],[20,30]]),windows).shape == (0,2)
+
+def test_to_windows_drops_blocks_lost_outside_windows():
+    index = LostSampleIndex()
+    index.add(0,[[0,5]])
+    index.add(1,[[12,14]])
+    for block_id in range(2):
+        index.to_windows(block_id,np.array([[10,20]]))
+    assert len(index) == 1
+    assert index.ranges(1).tolist() == [[2,4]]
+
+def test_lost_ranges_index_stored_samples(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=6,block_size=4000,packet_loss=0.3,packet_size=64)
+    vibrometer.capture_windows = [(1e-3,2e-3),(3e-3,3.5e-3)]
+    blocks = run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"run.h5"),{"traces": {"packet_loss": 0.3}})
+
+    assert len(vibrometer.lost_samples) > 0
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        for block in blocks:
+            valid = reader.blocks("DataValidity",block.block_id,block.block_id+1)[0]
+            lost  = np.zeros(len(valid),dtype=bool)
+            for start,stop in block.lost_ranges:
+                lost[start:stop] = True
+            assert np.array_equal(lost,~valid.astype(bool))
+            assert np.array_equal(reader.lost_samples(block.block_id),block.lost_ranges)
+
+def test_follow_reads_lost_ranges_of_streamed_run(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=8,block_size=4000,packet_loss=0.3,packet_size=64)
+    vibrometer.stream_data(str(tmp_path/"run.h5"),swmr=True)
+    blocks = run(vibrometer)
+    assert any(len(block.lost_ranges) > 0 for block in blocks)
+    vibrometer.wait_for_stream(timeout=10)
+
+    with HDF5Reader(str(tmp_path/"run.h5"),swmr=True) as reader:
+        followed = list(reader.follow(timeout=10))
+        assert [block.block_id for block in followed] == [block.block_id for block in blocks]
+        for block,read in zip(blocks,followed):
+            assert np.array_equal(read.lost_ranges,block.lost_ranges)
+        assert reader.lost_samples(len(blocks)).shape == (0,2)
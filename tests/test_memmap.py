@@ -0,0 +1,44 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import os
+
+import numpy as np
+import pytest
+
+from ..HDF5Reader import HDF5Reader
+from ..MemmapAllocator import MemmapAllocator
+from .simulated import run
+
+
+def test_memmap_buffers_hold_the_run(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=4,block_size=1000)
+    vibrometer.memmap_dir = str(tmp_path)
+    assert vibrometer.memmap_dir == str(tmp_path)
+
+    blocks = run(vibrometer)
+    data = vibrometer.take_data()
+    assert isinstance(data["Velocity"]["Samples"],np.memmap)
+    # The files are unlinked as soon as they are mapped.
+    assert os.listdir(tmp_path) == []
+
+    vibrometer.write_run(str(tmp_path/"run.h5"),{"vibrometer": vibrometer.to_dict()},data)
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        for block in blocks:
+            assert np.array_equal(reader.block("Velocity",block.block_id),block.samples["Velocity"])
+            assert np.array_equal(reader.overrange("Velocity",block.block_id),block.overrange("Velocity"))
+
+    vibrometer.memmap_dir = None
+    assert vibrometer.memmap_dir is None
+
+def test_memmap_allocator_keeps_files_without_delete(tmp_path):
+    allocator = MemmapAllocator(str(tmp_path),delete=False)
+    array = allocator("Velocity","Samples",(2,8),np.int32)
+    array[:] = 7
+    array.flush()
+
+    filenames = os.listdir(tmp_path)
+    assert len(filenames) == 1
+    assert np.array_equal(np.fromfile(tmp_path/filenames[0],dtype=np.int32),np.full(16,7))
+
+    with pytest.raises(IOError):
+        MemmapAllocator(str(tmp_path/"missing"))
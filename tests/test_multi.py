@@ -0,0 +1,56 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import h5py
+import numpy as np
+import pytest
+
+from ..MultiVibrometer import MultiVibrometer
+
+
+def test_aligned_run_to_one_file(make_vibrometer,tmp_path):
+    multi = MultiVibrometer({"left": make_vibrometer(block_count=3), "right": make_vibrometer(block_count=3)})
+    try:
+        blocks = multi.iter_aligned_blocks(timeout=10)
+        multi.start_acq(timeout=10)
+        assert [block_id for block_id,aligned in blocks] == [0,1,2]
+
+        multi.write_data(str(tmp_path/"multi.h5"),{"traces": {"heads": 2}})
+    finally:
+        multi.close()
+
+    with h5py.File(str(tmp_path/"multi.h5"),"r") as written:
+        assert written["left/Velocity/blocks"].shape[0] == written["right/Velocity/blocks"].shape[0] == 3
+        assert np.array_equal(written["trigger_skew/block_id"][()],[0,1,2])
+        assert len(written["trigger_skew/skew"]) == 3
+
+def test_write_data_takes_nothing_unless_every_head_has_data(make_vibrometer,tmp_path):
+    left, right = make_vibrometer(block_count=2), make_vibrometer(block_count=2)
+    multi = MultiVibrometer({"left": left, "right": right})
+    try:
+        blocks = left.iter_blocks(timeout=10)
+        left.start_acq(block=True)
+        list(blocks)
+
+        with pytest.raises(Exception,match="right"):
+            multi.write_data(str(tmp_path/"multi.h5"))
+        assert left.has_data
+    finally:
+        multi.close()
+
+def test_start_acq_timeout_bounds_the_wait(make_vibrometer):
+    # Every device command takes 50 ms, so arming takes far longer than the timeout.
+    slow  = make_vibrometer(block_count=2,command_latency=0.05)
+    multi = MultiVibrometer({"fast": make_vibrometer(block_count=2), "slow": slow})
+    try:
+        stopped = multi.iter_aligned_blocks(timeout=10)
+        with pytest.raises(TimeoutError):
+            multi.start_acq(timeout=0.05)
+        assert list(stopped) == []
+
+        # The stopped runs end like any other, the same heads arm and complete the next one.
+        blocks = multi.iter_aligned_blocks(timeout=10)
+        multi.start_acq(timeout=10)
+        assert [block_id for block_id,aligned in blocks] == [0,1]
+        assert slow.has_data
+    finally:
+        multi.close()
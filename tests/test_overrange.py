@@ -0,0 +1,31 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_packed_overrange_reads_like_unpacked(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=3,block_size=1003)
+
+    # The simulated device sends the same blocks every run.
+    run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"unpacked.h5"))
+
+    vibrometer.pack_overrange = True
+    blocks = run(vibrometer)
+    data = vibrometer.take_data()
+    velocity = data["Velocity"]
+    assert velocity["Samples"].dtype == np.int32
+    assert velocity["OverrangePacked"]
+    assert velocity["Overrange"].shape == (3,(velocity["Samples"].shape[1]+7)//8)
+    vibrometer.write_run(str(tmp_path/"packed.h5"),{"vibrometer": vibrometer.to_dict()},data)
+
+    with HDF5Reader(str(tmp_path/"unpacked.h5")) as unpacked, HDF5Reader(str(tmp_path/"packed.h5")) as packed:
+        for num in range(3):
+            overrange = unpacked.overrange("Velocity",num)
+            assert overrange.any()
+            assert np.array_equal(packed.overrange("Velocity",num),overrange)
+            assert np.array_equal(blocks[num].overrange("Velocity"),overrange)
+            assert np.array_equal(packed.block("Velocity",num),unpacked.block("Velocity",num))
@@ -0,0 +1,83 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import os
+
+import numpy as np
+import pytest
+
+from ..HDF5Reader import HDF5Reader
+from ..ProcessVibrometer import ProcessVibrometer
+from .simulated import run
+
+
+def shared_segments():
+    """Names of the shared memory segments in existence, where the platform lists them (semaphores live there too)."""
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+@pytest.fixture
+def process_vibrometer():
+    """A ProcessVibrometer on the simulated device of its child process, which inherits POLYTEC_BACKEND."""
+    segments   = shared_segments()
+    vibrometer = ProcessVibrometer("simulated")
+    vibrometer.block_size = 2000
+
+    yield vibrometer
+
+    vibrometer.close()
+    # Every segment of every run is gone with the child.
+    assert shared_segments() <= segments
+
+
+def test_run_iterate_write_and_rearm(process_vibrometer,tmp_path):
+    vibrometer = process_vibrometer
+    vibrometer.block_count = 3
+
+    blocks = run(vibrometer)
+    assert [block.block_id for block in blocks] == [0,1,2]
+    assert vibrometer.has_data
+
+    vibrometer.write_data(str(tmp_path/"run0.h5"))
+    assert not vibrometer.has_data
+    with HDF5Reader(str(tmp_path/"run0.h5")) as reader:
+        assert reader.block_count == 3
+        for block in blocks:
+            assert np.array_equal(reader.block("Velocity",block.block_id),block.samples["Velocity"])
+
+    # The next run gets segments of its own, while the blocks of the last one are still around.
+    second = run(vibrometer)
+    assert [block.block_id for block in second] == [0,1,2]
+    written = vibrometer.write_data_async(str(tmp_path/"run1.h5"))
+    assert written.result(timeout=10) == str(tmp_path/"run1.h5")
+    with HDF5Reader(str(tmp_path/"run1.h5")) as reader:
+        assert np.array_equal(reader.block("Velocity",2),second[2].samples["Velocity"])
+
+def test_stop_mid_run_and_rearm(process_vibrometer):
+    vibrometer = process_vibrometer
+    vibrometer.block_count = 100
+
+    blocks = vibrometer.iter_blocks(timeout=10)
+    vibrometer.start_acq(block=True,timeout=10)
+    assert next(blocks).block_id == 0
+    assert vibrometer.stop_acq() is False
+
+    # The rest of the stopped run ends right away, nothing of it is kept.
+    assert len(list(blocks)) < 99
+    assert not vibrometer.ready_for_data
+    assert not vibrometer.has_data
+
+    vibrometer.block_count = 2
+    assert len(run(vibrometer)) == 2
+    assert vibrometer.has_data
+
+def test_start_acq_timeout(process_vibrometer):
+    vibrometer = process_vibrometer
+    vibrometer.block_count = 2
+
+    # The child cannot have announced the run yet.
+    with pytest.raises(TimeoutError):
+        vibrometer.start_acq(block=True,timeout=0.)
+    vibrometer.stop_acq()
+
+    assert len(run(vibrometer)) == 2
@@ -0,0 +1,105 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import pytest
+
+from ..Backend import DeviceCommand, DeviceCommunication, DeviceType
+from ..DaqConfig import ConfigurationError
+from ..SimulatedDevice import SimulatedDevice
+from ..Vibrometer import Vibrometer
+
+
+@pytest.fixture
+def device():
+    return SimulatedDevice()
+
+@pytest.fixture
+def vibrometer(device):
+    return Vibrometer(DeviceCommunication("simulated",device))
+
+
+@pytest.mark.parametrize("name,value",[("block_count",7),("block_size",1234),("trigger_mode","Analog"),
+                                       ("pre_post_trigger",-100),("bandwidth","100 kHz"),("range","2 m/s"),
+                                       ("high_pass_filter","100 Hz"),("qtec",0),("focus_position",100)])
+def test_settings_read_back_what_was_written(vibrometer,name,value):
+    vibrometer.snapshot_settings()
+    setattr(vibrometer,name,value)
+    assert getattr(vibrometer,name) == value
+
+    # The cache and the device agree on everything, not just on what was written.
+    cached = vibrometer.to_dict()
+    vibrometer.refresh_settings()
+    assert vibrometer.to_dict() == cached
+
+@pytest.mark.parametrize("name,value",[("bandwidth","100 kHz"),("block_size",1234),("qtec",0)])
+def test_setters_drop_the_settings_of_every_device_type(vibrometer,device,name,value):
+    vibrometer.snapshot_settings()
+
+    # As if the write changed the sample rate too.
+    rate = vibrometer.daq_sample_rate
+    device.values[(DeviceType.SignalProcessing,DeviceCommand.DaqSampleRate)] = rate//2
+    assert vibrometer.daq_sample_rate == rate
+
+    setattr(vibrometer,name,value)
+    assert vibrometer.daq_sample_rate == rate//2
+
+def test_reads_are_served_from_the_cache(vibrometer,device):
+    vibrometer.snapshot_settings()
+    commands = device.command_count
+    vibrometer.to_dict()
+    assert device.command_count == commands
+
+
+class SharedMemoryDevice(SimulatedDevice):
+    """The blocks share the memory of the device: the block count range follows the block size."""
+
+    MEMORY = 1000000
+
+    def set(self,device_type,command,value):
+        super().set(device_type,command,value)
+        if (device_type,command) == (DeviceType.SignalProcessing,DeviceCommand.DaqBlockSize):
+            self.ranges[(DeviceType.SignalProcessing,DeviceCommand.DaqBlockCount)] = (0,self.MEMORY//value)
+
+@pytest.fixture
+def shared_memory_vibrometer():
+    vibrometer = Vibrometer(DeviceCommunication("simulated",SharedMemoryDevice()))
+    vibrometer.block_size = 4000
+    return vibrometer
+
+def test_settings_from_dict_validates_against_the_new_block_size(shared_memory_vibrometer):
+    assert shared_memory_vibrometer.block_count_range() == (0,250)
+
+    report = shared_memory_vibrometer.settings_from_dict({"block_count": 500, "block_size": 1000})
+    assert list(report["changed"]) == ["block_size","block_count"]
+    assert (shared_memory_vibrometer.block_count,shared_memory_vibrometer.block_size) == (500,1000)
+
+def test_invalid_settings_from_dict_changes_nothing(shared_memory_vibrometer):
+    before = shared_memory_vibrometer.to_dict()
+    with pytest.raises(ConfigurationError):
+        shared_memory_vibrometer.settings_from_dict({"block_count": 5000, "block_size": 1000, "bandwidth": "100 kHz"})
+
+    shared_memory_vibrometer.refresh_settings()
+    assert shared_memory_vibrometer.to_dict() == before
+    assert shared_memory_vibrometer.block_count_range() == (0,250)
+
+def test_settings_from_dict_only_writes_what_changed(vibrometer,device):
+    vibrometer.snapshot_settings()
+    current = vibrometer.to_dict()
+
+    report = vibrometer.settings_from_dict({"block_count": current["block_count"], "bandwidth": "100 kHz",
+                                            "block_size": "1234", "serial": "X"})
+    assert list(report["changed"]) == ["block_size","bandwidth"]
+    assert report["changed"]["block_size"]["old"] == current["block_size"]
+    assert report["changed"]["block_size"]["new"] == 1234
+    assert report["unchanged"] == ["block_count"]
+    assert report["ignored"] == ["serial"]
+
+    # Applying the same dictionary again finds nothing to write. The writes dropped the cached settings, read them first.
+    vibrometer.to_dict()
+    commands = device.command_count
+    report = vibrometer.settings_from_dict({"block_size": 1234, "bandwidth": "100 kHz"})
+    assert report["changed"] == dict()
+    assert device.command_count == commands
+
+def test_settings_from_dict_converts_values(vibrometer):
+    with pytest.raises(ValueError):
+        vibrometer.settings_from_dict({"block_count": "many"})
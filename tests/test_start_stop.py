@@ -0,0 +1,45 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+from ..Backend import DeviceCommunication
+from ..SimulatedDevice import SimulatedDevice
+from ..Vibrometer import Vibrometer
+from .simulated import run
+
+
+def test_stop_acq_ends_the_run_and_the_next_start_acq_arms_afresh():
+    # No trigger comes before the run is stopped.
+    device     = SimulatedDevice(trigger_delay=60.,trigger_interval=0.01)
+    vibrometer = Vibrometer(DeviceCommunication("simulated",device))
+    vibrometer.block_count = 2
+    try:
+        blocks = vibrometer.iter_blocks(timeout=10)
+        vibrometer.start_acq(block=True,timeout=10)
+        assert vibrometer.stop_acq() is False
+        assert list(blocks) == []
+        assert not vibrometer.has_data
+
+        # No longer ready for data, so the callback waits for the next run.
+        ready = []
+        vibrometer.add_ready_callback(lambda: ready.append(True))
+        assert ready == []
+
+        device.trigger_delay = 0.
+        assert len(run(vibrometer)) == 2
+        assert ready == [True]
+        assert vibrometer.has_data
+    finally:
+        vibrometer.close()
+
+def test_failed_run_does_not_stall_the_next_one(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=2)
+
+    # Nothing of the block is in the window, the run fails while it is being set up.
+    vibrometer.capture_windows = [(10.,11.)]
+    blocks = vibrometer.iter_blocks(timeout=10)
+    vibrometer.start_acq()
+    assert list(blocks) == []
+
+    vibrometer.capture_windows = None
+    blocks = vibrometer.iter_blocks(timeout=10)
+    vibrometer.start_acq(block=True,timeout=10)
+    assert len(list(blocks)) == 2
@@ -0,0 +1,49 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import os
+import subprocess
+import sys
+import threading
+
+from ..Backend import DeviceCommunication
+from ..SimulatedDevice import SimulatedDevice
+from ..Vibrometer import Vibrometer
+from .simulated import run
+
+
+def test_construction_leaves_the_device_alone(make_vibrometer):
+    device  = SimulatedDevice(trigger_delay=0.,trigger_interval=0.01)
+    threads = threading.active_count()
+    vibrometer = Vibrometer(DeviceCommunication("simulated",device))
+    try:
+        # Only the operation mode is switched off, the ItemLists are built on first use.
+        assert device.command_count <= 2
+        assert threading.active_count() == threads
+
+        commands = device.command_count
+        vibrometer.block_count
+        assert device.command_count == commands+1
+
+        # The acquisition thread comes with the first run.
+        vibrometer.block_count = 2
+        assert len(run(vibrometer)) == 2
+        assert threading.active_count() > threads
+    finally:
+        vibrometer.close()
+
+
+IMPORT_VIBROMETER = """
+import sys
+from {package}.Vibrometer import Vibrometer
+assert "h5py" not in sys.modules
+from {package}.DataManagement import HDF5Reader
+assert "h5py" in sys.modules
+"""
+
+def test_vibrometer_does_not_import_h5py():
+    package     = __package__.rsplit(".",1)[0]
+    search_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    result = subprocess.run([sys.executable,"-c",IMPORT_VIBROMETER.format(package=package)],cwd=search_path,timeout=60,
+                            env=dict(os.environ,POLYTEC_BACKEND="simulated"))
+    assert result.returncode == 0
@@ -0,0 +1,140 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+
+def test_streamed_run_is_on_disk_and_not_in_memory(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=5,block_size=1000)
+    vibrometer.stream_data(str(tmp_path/"run.h5"),{"traces": {"comment": "streamed"}})
+    blocks = run(vibrometer)
+    vibrometer.wait_for_stream(timeout=10)
+
+    assert not vibrometer.has_data
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert reader.block_count == 5
+        assert reader.metadata_value("traces","comment") == "streamed"
+        for block in blocks:
+            for ch_name,samples in block.samples.items():
+                assert np.array_equal(reader.block(ch_name,block.block_id),samples)
+            assert np.array_equal(reader.overrange("Velocity",block.block_id),block.overrange("Velocity"))
+
+def test_stopped_stream_leaves_the_blocks_written_so_far(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=100,block_size=1000)
+    vibrometer.stream_data(str(tmp_path/"run.h5"))
+
+    blocks = vibrometer.iter_blocks(timeout=10)
+    vibrometer.start_acq(block=True,timeout=10)
+    received = [next(blocks) for _ in range(3)]
+    vibrometer.stop_acq()
+    vibrometer.wait_for_stream(timeout=10)
+
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert 3 <= reader.block_count < 100
+        for block in received:
+            assert np.array_equal(reader.block("Velocity",block.block_id),block.samples["Velocity"])
+
+    # The next run is held in memory again.
+    assert len(run(vibrometer)) == 100
+    assert vibrometer.has_data
+
+
+# Follows a file streamed in SWMR mode from another process, like it is meant to be read. In the writing process itself,
+# closing a reader would close the writer's objects of the file too. Prints a JSON line for every follow, one until the
+# first TimeoutError, then one after the stream was closed.
+FOLLOW_STREAM = """
+import json, sys
+from time import perf_counter, sleep
+from {package}.HDF5Reader import HDF5Reader
+
+start = perf_counter()
+while True:
+    try:
+        reader = HDF5Reader({filename!r},swmr=True)
+        break
+    except OSError:
+        if perf_counter()-start > 10:
+            raise
+        sleep(0.01)
+
+def follow(start):
+    report = {{"closed": reader.stream_closed, "blocks": [], "sums": [], "timed_out": False}}
+    try:
+        for block in reader.follow(start,timeout={timeout},poll_interval=0.01):
+            report["blocks"].append(block.block_id)
+            report["sums"].append(int(block.samples["Velocity"].sum()))
+    except TimeoutError:
+        report["timed_out"] = True
+    report["block_count"] = int(reader.block_count)
+    print(json.dumps(report),flush=True)
+    return report
+
+report = follow(0)
+if report["timed_out"]:
+    while not reader.stream_closed:
+        sleep(0.01)
+    follow(len(report["blocks"]))
+reader.close()
+"""
+
+def follow_stream(filename,timeout):
+    """Start following filename in another process, see FOLLOW_STREAM."""
+    package     = __package__.rsplit(".",1)[0]
+    search_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    code = FOLLOW_STREAM.format(package=package,filename=filename,timeout=timeout)
+    return subprocess.Popen([sys.executable,"-c",code],cwd=search_path,stdout=subprocess.PIPE,text=True,
+                            env=dict(os.environ,POLYTEC_BACKEND="simulated"))
+
+def test_follow_reads_a_swmr_stream_while_it_is_written(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=50,block_size=1000,trigger_interval=0.02)
+    vibrometer.stream_data(str(tmp_path/"run.h5"),swmr=True)
+    follower = follow_stream(str(tmp_path/"run.h5"),timeout=10)
+
+    blocks = run(vibrometer)
+    vibrometer.wait_for_stream(timeout=10)
+    report = json.loads(follower.stdout.readline())
+    assert follower.wait(timeout=10) == 0
+
+    # The follower was there before the run was over.
+    assert not report["closed"]
+    assert report["blocks"] == [block.block_id for block in blocks] == list(range(50))
+    assert report["sums"] == [int(block.samples["Velocity"].sum()) for block in blocks]
+    assert report["block_count"] == 50
+
+def test_follow_times_out_and_ends_with_a_stopped_stream(make_vibrometer,tmp_path):
+    # One block right away, the next trigger is a minute later.
+    vibrometer = make_vibrometer(block_count=5,block_size=1000,trigger_interval=60.)
+    vibrometer.stream_data(str(tmp_path/"run.h5"),swmr=True)
+    follower = follow_stream(str(tmp_path/"run.h5"),timeout=0.5)
+    vibrometer.start_acq(block=True,timeout=10)
+
+    report = json.loads(follower.stdout.readline())
+    assert report["timed_out"]
+    assert report["blocks"] == [0]
+    assert not report["closed"]
+
+    vibrometer.stop_acq()
+    vibrometer.wait_for_stream(timeout=10)
+    report = json.loads(follower.stdout.readline())
+    assert follower.wait(timeout=10) == 0
+    assert report["closed"] and not report["timed_out"]
+    assert report["blocks"] == []
+    assert report["block_count"] == 1
+
+def test_files_not_streamed_in_swmr_mode_are_closed(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=3,block_size=1000)
+    run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"run.h5"))
+
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert reader.stream_closed
+        assert reader.refresh() == 3
+        assert [block.block_id for block in reader.follow()] == [0,1,2]
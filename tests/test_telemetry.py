@@ -0,0 +1,45 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import json
+
+from ..Telemetry import LatencyHistogram
+from .simulated import run
+
+
+def test_latency_histogram_buckets():
+    histogram = LatencyHistogram()
+    for seconds in [3e-5,5e-5,0.3,20.]:
+        histogram.record(seconds)
+
+    summary = histogram.to_dict()
+    assert summary["buckets"]["5e-05"] == 2
+    assert summary["buckets"]["0.5"] == 1
+    assert summary["buckets"]["+Inf"] == 1
+    assert sum(summary["buckets"].values()) == summary["count"] == 4
+    assert summary["max"] == 20.
+
+def test_telemetry_of_a_run(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=4,block_size=2000,packet_loss=0.5)
+    vibrometer.telemetry_enabled = True
+    run(vibrometer)
+    data = vibrometer.take_data()
+
+    snapshot = vibrometer.telemetry_snapshot()
+    assert snapshot["samples"] == sum(channel["Samples"].size for channel in data.values())
+    assert snapshot["bytes"] == sum(channel["Samples"].nbytes for channel in data.values())
+    assert snapshot["lost_samples"] == (data["DataValidity"]["Samples"] == 0).sum() > 0
+    assert snapshot["calls"]["wait_for_trigger"]["count"] == len(snapshot["trigger_wait"]) == 4
+    assert snapshot["calls"]["read_data"]["count"] >= 4
+    assert snapshot["buffer_fill"]["max"] >= 0
+    assert json.loads(vibrometer.telemetry.to_json())["samples"] == snapshot["samples"]
+
+    exposition = vibrometer.telemetry.to_prometheus(labels={"head": "top"})
+    assert f'vibrometer_samples_total{{head="top"}} {snapshot["samples"]}' in exposition
+    assert 'vibrometer_call_seconds_count{head="top",call="read_data"}' in exposition
+
+def test_disabled_telemetry_times_nothing(make_vibrometer):
+    vibrometer = make_vibrometer(block_count=2)
+    run(vibrometer)
+    snapshot = vibrometer.telemetry_snapshot()
+    assert snapshot["calls"] == dict()
+    assert snapshot["samples"] == 0
@@ -0,0 +1,43 @@
+# (c) Jasper Smits 2022, released under LGPLv3
+
+import numpy as np
+import pytest
+
+from ..HDF5Reader import HDF5Reader
+from .simulated import run
+
+WINDOWS = [(0.,1e-3),(2e-3,2.5e-3)]
+
+
+@pytest.mark.parametrize("freq_factor",[1,2])
+def test_channel_t_array_covers_capture_windows(make_vibrometer,tmp_path,freq_factor):
+    vibrometer = make_vibrometer(block_count=2,block_size=4000,sample_rate=625000*freq_factor,base_sample_rate=625000)
+    vibrometer.capture_windows = WINDOWS
+    run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"run.h5"),{"traces": {"windows": str(WINDOWS)}})
+
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        for ch_name,sample_rate in [("Velocity",625000*freq_factor),("DataValidity",625000*freq_factor),("RSSI",625000)]:
+            t_array = reader.channel_t_array(ch_name)
+            assert len(t_array) == reader.blocks(ch_name,0,1).shape[1]
+            assert np.allclose(np.diff(t_array)[np.diff(t_array) < 2/sample_rate],1/sample_rate)
+
+            # Every sample lies in a window, and every window is covered up to the last sample before its end.
+            inside = np.zeros(len(t_array),dtype=bool)
+            for start,stop in WINDOWS:
+                in_window = (t_array >= start-1e-9) & (t_array < stop-1e-9)
+                assert in_window.any()
+                assert t_array[in_window][0]  == pytest.approx(start,abs=1/sample_rate)
+                assert t_array[in_window][-1] == pytest.approx(stop-1/sample_rate,abs=1/sample_rate)
+                inside |= in_window
+            assert inside.all()
+
+def test_generate_t_array_full_block(make_vibrometer,tmp_path):
+    vibrometer = make_vibrometer(block_count=1,block_size=1000,sample_rate=1250000,base_sample_rate=625000)
+    vibrometer.pre_post_trigger = 400
+    run(vibrometer)
+    vibrometer.write_data(str(tmp_path/"run.h5"),{"traces": {"pre_post_trigger": 400}})
+
+    with HDF5Reader(str(tmp_path/"run.h5")) as reader:
+        assert np.allclose(reader.generate_t_array(),(np.arange(2000)-400)/1250000)
+        assert np.allclose(reader.generate_t_array(freq_factor=False),(np.arange(1000)-200)/625000)